@@ -0,0 +1,311 @@
+"""Micro-benchmarks of the database handlers against a synthetic dataset.
+
+The dataset is generated once per size into an SQLite file and reused by later
+runs. Every run works on a fresh copy of it, so benchmarks which write do not
+change the dataset. Redmine is replaced by a stub which answers from memory.
+
+Usage:
+    python -m benchmarks.handlers --users 10000 --time-entries 1000000 --output results.json
+
+Results are printed as JSON with the timing of every benchmark in seconds.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from tracktime.database import create_database_engine
+from tracktime.handlers import find_or_create_user, flush_time_entry_outbox, \
+    get_actual_issues, queue_time_entry, sync_user_with_redmine
+from tracktime.models import initialize_tables, Issue, select_recent_issues, TimeEntry, \
+    TimeEntryRecord, User, UserRecentIssue
+
+_CHUNK_SIZE = 10000
+
+
+class StubRedmine:
+    """Redmine wrapper which answers from memory without requests."""
+
+    url = 'http://redmine.invalid'
+
+    def __init__(self, time_entries=None, issues=None):
+        """Initialize stub.
+
+        :param dict time_entries: Rows of time entries in Redmine by ID user
+        :param dict issues: Names of issues in Redmine by ID issue
+        """
+        self.time_entries = time_entries or {}
+        self.issues = issues or {}
+        self._ids = itertools.count(10 ** 9)
+
+    def get_user_id(self, authkey):
+        """Return ID user in Redmine which is ID user in the dataset."""
+        return int(authkey)
+
+    def get_all_time_entry(self, user, spent_on=None, from_date=None, updated_since=None):
+        """Return time entries of the user as the wrapper builds them."""
+        return list(self.iter_time_entries(user, spent_on, from_date, updated_since))
+
+    def iter_time_entries(self, user, spent_on=None, from_date=None, updated_since=None):
+        """Yield time entries of the user as the wrapper builds them."""
+        for row in self.time_entries.get(user.redmine_user_id, []):
+            if spent_on is None or row['spent_on'] == spent_on:
+                yield TimeEntryRecord(row['id'], row['issue_id'], row['spent_on'], row['hours'],
+                                      row['comments'])
+
+    def get_issues(self, user, issue_ids):
+        """Return the issues by ids."""
+        return [Issue(issue_id, self.issues[issue_id]) for issue_id in issue_ids
+                if issue_id in self.issues]
+
+    def save_time_entry(self, time_entry):
+        """Return a new ID of the time entry."""
+        return next(self._ids)
+
+
+def generate_dataset(path, users, issues, time_entries, seed=0):
+    """Generate the dataset into the SQLite file.
+
+    :param str path: Path of the database file
+    :param int users: Number of users
+    :param int issues: Number of issues
+    :param int time_entries: Number of time entries
+    :param int seed: Seed of the random generator
+    """
+    rnd = random.Random(seed)
+    engine = create_database_engine('sqlite:///{}'.format(path))
+    initialize_tables(engine)
+
+    today = date.today()
+    _insert(engine, User.__table__, (
+        {'id': i, 'authkey': str(i), 'redmine_user_id': i, 'synced_at': None}
+        for i in range(1, users + 1)))
+    _insert(engine, Issue.__table__, (
+        {'id': i, 'name': 'Issue {}'.format(i)} for i in range(1, issues + 1)))
+    _insert(engine, TimeEntry.__table__, (
+        {
+            'id': i,
+            'user_id': rnd.randint(1, users),
+            'issue_id': _issue_of(rnd, issues),
+            'spent_on': today - timedelta(days=rnd.randint(0, 365)),
+            'hours': rnd.choice((0.5, 1, 2, 4, 8)),
+            'comments': 'Time entry {}'.format(i)
+        } for i in range(1, time_entries + 1)))
+
+    table = UserRecentIssue.__table__
+    engine.execute(table.insert().from_select(
+        [c.name for c in table.columns], select_recent_issues()))
+    engine.dispose()
+
+
+def _issue_of(rnd, issues):
+    """Choose issues with a long tail, as users track most time in a few issues."""
+    return min(int(rnd.paretovariate(1.2)), issues)
+
+
+def _insert(engine, table, rows):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, _CHUNK_SIZE))
+        if not chunk:
+            return
+        engine.execute(table.insert(), chunk)
+
+
+def load_time_entries(engine, user_ids):
+    """Load time entries of the users as rows.
+
+    :param sqlalchemy.engine.Engine engine:
+    :param user_ids:
+    :rtype: dict
+    """
+    table = TimeEntry.__table__
+    time_entries = {user_id: [] for user_id in user_ids}
+    s = table.select().where(table.c.user_id.in_(list(user_ids)))
+    for row in engine.execute(s):
+        time_entries[row['user_id']].append(dict(row))
+    return time_entries
+
+
+def run_benchmark(name, func, args, warmup=10):
+    """Call the function with every argument and return the timing.
+
+    At least one call is measured, so ``warmup`` is reduced when there are not
+    enough arguments.
+
+    :param str name: Name of the benchmark
+    :param callable func: Function of one argument
+    :param list args: Arguments of calls
+    :param int warmup: Number of calls which are not measured
+    :rtype: dict
+    :raises ValueError: If there are no arguments
+    """
+    if not args:
+        raise ValueError('Benchmark {} has no calls'.format(name))
+    warmup = min(warmup, len(args) - 1)
+
+    for arg in args[:warmup]:
+        func(arg)
+
+    timings = []
+    for arg in args[warmup:]:
+        started_at = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - started_at)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        'name': name,
+        'calls': len(timings),
+        'total': total,
+        'mean': total / len(timings),
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'p95': timings[int(len(timings) * 0.95)],
+        'max': timings[-1],
+        'ops_per_second': len(timings) / total if total else None
+    }
+
+
+def run(users, issues, time_entries, repeat, sync_repeat, data_dir, seed=0):
+    """Run all benchmarks.
+
+    :param int users: Number of users in the dataset
+    :param int issues: Number of issues in the dataset
+    :param int time_entries: Number of time entries in the dataset
+    :param int repeat: Number of calls of fast benchmarks
+    :param int sync_repeat: Number of calls of the sync benchmark
+    :param str data_dir: Directory of generated datasets
+    :param int seed: Seed of the random generator
+    :rtype: dict
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(data_dir, exist_ok=True)
+    dataset = os.path.join(data_dir, 'dataset-{}-{}-{}-{}.db'.format(
+        users, issues, time_entries, seed))
+    if not os.path.exists(dataset):
+        logger.info('Generate dataset %s', dataset)
+        started_at = time.perf_counter()
+        generate_dataset(dataset + '.tmp', users, issues, time_entries, seed)
+        os.replace(dataset + '.tmp', dataset)
+        logger.info('Dataset is generated in %.1f seconds', time.perf_counter() - started_at)
+
+    work_dir = tempfile.mkdtemp(prefix='tracktime-benchmark-')
+    try:
+        path = os.path.join(work_dir, 'benchmark.db')
+        shutil.copyfile(dataset, path)
+        engine = create_database_engine('sqlite:///{}'.format(path))
+        initialize_tables(engine)
+
+        rnd = random.Random(seed)
+        user_ids = [rnd.randint(1, users) for _ in range(repeat)]
+        new_user_ids = [users + i for i in range(1, repeat // 10 + 1)]
+        today = date.today()
+        states = [{
+            'user_id': user_id,
+            'issue_id': _issue_of(rnd, issues),
+            'spent_on': today,
+            'hours': 1.0,
+            'comments': 'Benchmark'
+        } for user_id in user_ids]
+
+        sync_user_ids = rnd.sample(range(1, users + 1), min(sync_repeat, users))
+        r_time_entries = load_time_entries(engine, sync_user_ids)
+        new_issue_ids = itertools.count(issues + 1)
+        new_time_entry_ids = itertools.count(time_entries + 10 ** 6)
+        r_issues = {}
+        for rows in r_time_entries.values():
+            for row in rnd.sample(rows, len(rows) // 10):
+                row['hours'] += 1
+            issue_id = next(new_issue_ids)
+            r_issues[issue_id] = 'Issue {}'.format(issue_id)
+            rows.extend({
+                'id': next(new_time_entry_ids),
+                'issue_id': issue_id,
+                'spent_on': today,
+                'hours': 1.0,
+                'comments': 'New time entry'
+            } for _ in range(5))
+        redmine = StubRedmine(r_time_entries, r_issues)
+
+        results = [
+            run_benchmark('find_or_create_user',
+                          lambda user_id: find_or_create_user(user_id, engine=engine),
+                          user_ids + new_user_ids),
+            run_benchmark('get_actual_issues',
+                          lambda user_id: get_actual_issues(user_id, engine=engine), user_ids),
+            run_benchmark('queue_time_entry',
+                          lambda state: queue_time_entry(state, engine=engine), states),
+            run_benchmark('flush_time_entry_outbox',
+                          lambda _: flush_time_entry_outbox(redmine, engine, limit=1),
+                          states),
+            run_benchmark('sync_user_with_redmine',
+                          lambda user_id: sync_user_with_redmine(
+                              user_id, redmine=redmine, engine=engine, window=timedelta(days=7)),
+                          sync_user_ids, warmup=min(10, len(sync_user_ids) // 10)),
+        ]
+        engine.dispose()
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        'created_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dataset': {
+            'users': users,
+            'issues': issues,
+            'time_entries': time_entries,
+            'seed': seed
+        },
+        'benchmarks': results
+    }
+
+
+def main(argv=None):
+    """Run benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--issues', type=int, default=2000)
+    parser.add_argument('--time-entries', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=1000, help='Calls of fast benchmarks')
+    parser.add_argument('--sync-repeat', type=int, default=100, help='Calls of the sync')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(),
+                                                           'tracktime-benchmarks'))
+    parser.add_argument('--output', help='File of results. Default is stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('tracktime').setLevel(logging.WARNING)
+
+    results = run(args.users, args.issues, args.time_entries, args.repeat, args.sync_repeat,
+                  args.data_dir, args.seed)
+    for result in results['benchmarks']:
+        logging.info('%-24s median %8.3f ms  p95 %8.3f ms  %8.1f ops/s', result['name'],
+                     result['median'] * 1000, result['p95'] * 1000, result['ops_per_second'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,590 @@
+"""End-to-end load test of the bot with local stand-ins of Redmine and Telegram.
+
+The fake Redmine serves the REST API used by the bot from memory with the
+configured latency and rate of errors. The fake Telegram serves the Bot API,
+records every request of the bot and answers it immediately. The driver wires
+the bot as ``__main__`` does, waits for the startup synchronization of all
+users and then replays ``/track`` conversations through the real handlers,
+up to ``--concurrency`` conversations at the same time.
+
+The bot workers, the sync scheduler, the outbound dispatcher and the debounce
+of the hours edits default to the defaults of ``__main__``, so the percentiles
+include their costs. Every option can be overridden, e.g. ``--chat-interval 0``
+to measure the bot without the per-chat pacing or ``--sync-rate 0`` to start the
+syncs without the rate limit. The startup synchronization waits ``--timeout``
+seconds plus the time which the sync rate takes to start the syncs of all users.
+
+Usage:
+    python -m benchmarks.load --users 2000 --concurrency 200 --output load.json
+
+Results are printed as JSON with percentiles of every conversation step in
+seconds and the number of Redmine calls per user.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+from telegram.utils.request import Request
+
+from tracktime.bot import create_tracktime_handler, sync_daily_users
+from tracktime.database import create_database_engine
+from tracktime.dispatcher import OutboundDispatcher, set_default_dispatcher
+from tracktime.handlers import stale_user_ids
+from tracktime.models import initialize_tables, User
+from tracktime.scheduler import SyncScheduler
+
+STEPS = ['track', 'spent_on', 'issue', 'comments', 'hours', 'done']
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    """Base handler of the fake servers which answers JSON over keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if not body:
+            return {}
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body.decode('utf-8'))
+        return {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+
+    def _reply(self, status, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeRedmine:
+    """Stand-in of the Redmine REST API with time entries of generated users."""
+
+    def __init__(self, users, time_entries_per_user=20, issues_per_user=3, latency=0.05,
+                 error_rate=0, seed=0):
+        """Initialize server.
+
+        :param int users: Number of users, the API key of the user is its ID
+        :param int time_entries_per_user: Number of time entries of every user
+        :param int issues_per_user: Number of issues in which the user tracks time
+        :param float latency: Mean latency of a response in seconds
+        :param float error_rate: Share of requests which fail with the server error
+        :param int seed: Seed of the random generator
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = collections.Counter()
+        self.user_calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._rnd = random.Random(seed)
+        self._ids = itertools.count(users * time_entries_per_user + 1)
+
+        today = date.today()
+        self.issues = {}
+        self.user_issues = {}
+        self.time_entries = {}
+        time_entry_ids = itertools.count(1)
+        for user_id in range(1, users + 1):
+            issue_ids = [(user_id - 1) * issues_per_user + i + 1 for i in range(issues_per_user)]
+            for issue_id in issue_ids:
+                self.issues[issue_id] = 'Issue {}'.format(issue_id)
+            self.user_issues[user_id] = issue_ids
+            self.time_entries[user_id] = [{
+                'id': next(time_entry_ids),
+                'issue': {'id': self._rnd.choice(issue_ids)},
+                'user': {'id': user_id, 'name': 'User {}'.format(user_id)},
+                'project': {'id': 1, 'name': 'Project'},
+                'activity': {'id': 1, 'name': 'Development'},
+                'hours': self._rnd.choice((0.5, 1.0, 2.0, 4.0)),
+                'comments': 'Time entry',
+                'spent_on': str(today - timedelta(days=self._rnd.randint(0, 30)))
+            } for _ in range(time_entries_per_user)]
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        """Start serving in the background."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        redmine = self
+
+        class Handler(_JSONHandler):
+            def do_GET(self):
+                redmine._handle(self, 'GET')
+
+            def do_POST(self):
+                redmine._handle(self, 'POST')
+
+        return Handler
+
+    def _handle(self, request, method):
+        url = urlsplit(request.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = request._read_body() if method == 'POST' else {}
+        endpoint = '{} {}'.format(method, url.path)
+        user_id = self._user_id(request.headers.get('X-Redmine-API-Key'))
+
+        with self._lock:
+            self.calls[endpoint] += 1
+            if user_id is not None:
+                self.user_calls[user_id] += 1
+            delay = self._rnd.uniform(0, 2 * self.latency)
+            failed = self._rnd.random() < self.error_rate
+        time.sleep(delay)
+
+        if user_id is None:
+            return request._reply(401, {'errors': ['Unauthorized']})
+        if failed:
+            return request._reply(500, {'errors': ['Internal error']})
+
+        if endpoint == 'GET /users/current.json':
+            return request._reply(200, {'user': {
+                'id': user_id, 'login': 'user{}'.format(user_id), 'firstname': 'User',
+                'lastname': str(user_id), 'created_on': '2020-01-01T00:00:00Z'}})
+        if endpoint == 'GET /time_entries.json':
+            return request._reply(200, self._time_entries(user_id, query))
+        if endpoint == 'GET /issues.json':
+            issue_ids = [int(i) for i in query.get('issue_id', '').split(',') if i]
+            issues = [{'id': i, 'subject': self.issues[i]} for i in issue_ids if i in self.issues]
+            return request._reply(200, {
+                'issues': issues, 'total_count': len(issues), 'offset': 0, 'limit': len(issues)})
+        if endpoint == 'POST /time_entries.json':
+            time_entry = dict(body.get('time_entry', {}), id=next(self._ids))
+            return request._reply(201, {'time_entry': time_entry})
+        return request._reply(404, {'errors': ['Not found']})
+
+    def _user_id(self, authkey):
+        try:
+            user_id = int(authkey)
+        except (TypeError, ValueError):
+            return None
+        return user_id if user_id in self.time_entries else None
+
+    def _time_entries(self, user_id, query):
+        time_entries = self.time_entries[user_id]
+        spent_on = query.get('spent_on')
+        from_date = query.get('from') or query.get('from_date')
+        if spent_on:
+            time_entries = [t for t in time_entries if t['spent_on'] == spent_on]
+        if from_date:
+            time_entries = [t for t in time_entries if t['spent_on'] >= from_date]
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 25))
+        return {
+            'time_entries': time_entries[offset:offset + limit],
+            'total_count': len(time_entries),
+            'offset': offset,
+            'limit': limit
+        }
+
+
+class FakeTelegram:
+    """Stand-in of the Telegram Bot API which records the requests of the bot."""
+
+    def __init__(self):
+        """Initialize server."""
+        self.calls = collections.Counter()
+        self._chats = collections.defaultdict(list)
+        self._condition = threading.Condition()
+        self._message_ids = itertools.count(1)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/bot'.format(self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        """Start serving in the background."""
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait_for(self, chat_id, method, start, timeout=60):
+        """Wait for the request of the method to the chat.
+
+        :param int chat_id:
+        :param str method: Name of the method of the Bot API
+        :param int start: Index of the first request of the chat to look at
+        :param float timeout: Number of seconds to wait
+        :return: Index of the next request and the found request
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                calls = self._chats[chat_id]
+                for i in range(start, len(calls)):
+                    if calls[i]['method'] == method:
+                        return i + 1, calls[i]
+                start = len(calls)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No {} to chat {}'.format(method, chat_id))
+                self._condition.wait(remaining)
+
+    def _handler_class(self):
+        telegram = self
+
+        class Handler(_JSONHandler):
+            def do_POST(self):
+                telegram._handle(self)
+
+            do_GET = do_POST
+
+        return Handler
+
+    def _handle(self, request):
+        method = request.path.rsplit('/', 1)[-1]
+        params = request._read_body()
+        result = True
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Tracktime',
+                      'username': 'tracktime_bot'}
+        elif method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            message_id = params.get('message_id') or next(self._message_ids)
+            result = {
+                'message_id': int(message_id),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }
+
+        if 'chat_id' in params:
+            with self._condition:
+                self.calls[method] += 1
+                self._chats[int(params['chat_id'])].append({
+                    'method': method, 'params': params, 'result': result,
+                    'at': time.perf_counter()})
+                self._condition.notify_all()
+        request._reply(200, {'ok': True, 'result': result})
+
+
+class Driver:
+    """Replays conversations of users through the dispatcher of the bot."""
+
+    def __init__(self, updater, telegram, redmine, taps=3, timeout=60):
+        """Initialize driver.
+
+        :param telegram.ext.Updater updater: Updater with the handlers of the bot
+        :param FakeTelegram telegram:
+        :param FakeRedmine redmine:
+        :param int taps: Number of taps on the hours buttons in one conversation
+        :param float timeout: Number of seconds to wait for an answer of the bot
+        """
+        self.updater = updater
+        self.telegram = telegram
+        self.redmine = redmine
+        self.taps = taps
+        self.timeout = timeout
+        self.timings = collections.defaultdict(list)
+        self.failures = collections.Counter()
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def converse(self, user_id):
+        """Track time as the user and record the latency of every step.
+
+        :param int user_id:
+        """
+        step = STEPS[0]
+        try:
+            index = 0
+            started_at = self._message(user_id, '/track')
+            index, _ = self.telegram.wait_for(user_id, 'sendMessage', index, self.timeout)
+            index, reply = self.telegram.wait_for(user_id, 'sendMessage', index, self.timeout)
+            self._record(step, started_at, reply)
+            message_id = reply['result']['message_id']
+
+            step = 'spent_on'
+            started_at = self._callback(user_id, message_id, str(date.today()))
+            index, reply = self.telegram.wait_for(user_id, 'editMessageText', index, self.timeout)
+            self._record(step, started_at, reply)
+
+            step = 'issue'
+            issue_id = random.choice(self.redmine.user_issues[user_id])
+            started_at = self._callback(user_id, message_id, str(issue_id))
+            index, reply = self.telegram.wait_for(user_id, 'editMessageText', index, self.timeout)
+            self._record(step, started_at, reply)
+
+            step = 'comments'
+            started_at = self._message(user_id, 'Load test')
+            index, reply = self.telegram.wait_for(user_id, 'sendMessage', index, self.timeout)
+            self._record(step, started_at, reply)
+            message_id = reply['result']['message_id']
+
+            step = 'hours'
+            for _ in range(self.taps):
+                started_at = self._callback(user_id, message_id, '0.5')
+            index, reply = self.telegram.wait_for(user_id, 'editMessageText', index, self.timeout)
+            self._record(step, started_at, reply)
+
+            step = 'done'
+            started_at = self._callback(user_id, message_id, 'Done')
+            index, reply = self.telegram.wait_for(user_id, 'editMessageText', index, self.timeout)
+            self._record(step, started_at, reply)
+        except Exception:
+            logging.getLogger(__name__).exception('Conversation of user %s failed', user_id)
+            with self._lock:
+                self.failures[step] += 1
+
+    def _record(self, step, started_at, reply):
+        with self._lock:
+            self.timings[step].append(reply['at'] - started_at)
+
+    def _message(self, user_id, text):
+        message = self._message_data(user_id, next(self._update_ids), text)
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return self._put({'update_id': next(self._update_ids), 'message': message})
+
+    def _callback(self, user_id, message_id, data):
+        return self._put({
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._update_ids)),
+                'from': self._user_data(user_id),
+                'message': self._message_data(user_id, message_id, ''),
+                'chat_instance': str(user_id),
+                'data': data
+            }
+        })
+
+    def _put(self, data):
+        update = Update.de_json(data, self.updater.bot)
+        started_at = time.perf_counter()
+        self.updater.dispatcher.update_queue.put(update)
+        return started_at
+
+    def _message_data(self, user_id, message_id, text):
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user_data(user_id),
+            'text': text
+        }
+
+    @staticmethod
+    def _user_data(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User {}'.format(user_id)}
+
+
+def percentiles(timings):
+    """Return percentiles of the timings.
+
+    :param list timings:
+    :rtype: dict
+    """
+    if not timings:
+        return {'count': 0}
+    timings = sorted(timings)
+
+    def percentile(p):
+        return timings[min(int(len(timings) * p), len(timings) - 1)]
+
+    return {
+        'count': len(timings),
+        'p50': percentile(0.5),
+        'p90': percentile(0.9),
+        'p99': percentile(0.99),
+        'max': timings[-1]
+    }
+
+
+def run(args):
+    """Run the load test.
+
+    :param argparse.Namespace args: Options of the command line
+    :rtype: dict
+    """
+    logger = logging.getLogger(__name__)
+    redmine = FakeRedmine(args.users, args.time_entries_per_user, args.issues_per_user,
+                          args.redmine_latency, args.redmine_error_rate, args.seed)
+    telegram = FakeTelegram()
+    redmine.start()
+    telegram.start()
+
+    work_dir = tempfile.mkdtemp(prefix='tracktime-load-')
+    set_default_dispatcher(OutboundDispatcher(
+        rate=args.telegram_rate, burst=args.telegram_rate, chat_interval=args.chat_interval,
+        chat_burst=args.chat_burst, concurrency=args.telegram_concurrency))
+    scheduler = SyncScheduler(concurrency=args.sync_concurrency, rate=args.sync_rate)
+    try:
+        engine = create_database_engine(
+            'sqlite:///{}'.format(os.path.join(work_dir, 'load.db')),
+            workers=args.workers + args.sync_concurrency)
+        initialize_tables(engine)
+        engine.execute(User.__table__.insert(), [
+            {'id': user_id, 'authkey': str(user_id)} for user_id in range(1, args.users + 1)])
+
+        request = Request(con_pool_size=args.workers + args.telegram_concurrency + 4)
+        bot = Bot('100:load', base_url=telegram.url, request=request)
+        updater = Updater(bot=bot, workers=args.workers)
+        job_queue = updater.job_queue
+
+        started_at = datetime.utcnow()
+        sync_started_at = time.perf_counter()
+        sync_daily_users(
+            job_queue, redmine.url, engine,
+            sync_window=timedelta(days=7),
+            scheduler=scheduler,
+            sync_spread=timedelta(seconds=args.sync_spread),
+            stale_after=timedelta(0))
+        updater.dispatcher.add_handler(create_tracktime_handler(
+            engine, job_queue, redmine.url, 'track', 'cancel', scheduler=scheduler,
+            edit_delay=timedelta(seconds=args.edit_delay)))
+
+        job_queue.start()
+        dispatcher_thread = threading.Thread(target=updater.dispatcher.start, daemon=True)
+        dispatcher_thread.start()
+
+        sync_timeout = args.timeout
+        if args.sync_rate:
+            sync_timeout += args.users / args.sync_rate
+        stale_count, quiet_since = None, None
+        while True:
+            count = len(stale_user_ids(started_at, engine))
+            now = time.perf_counter()
+            if count != stale_count:
+                stale_count, quiet_since = count, now
+            if count == 0 or (now - sync_started_at > args.sync_spread and len(scheduler) == 0
+                              and now - quiet_since > 2):
+                break
+            if now - sync_started_at > sync_timeout:
+                raise TimeoutError('Startup synchronization did not finish')
+            time.sleep(0.1)
+        sync_duration = time.perf_counter() - sync_started_at
+        if stale_count:
+            logger.warning('%d users failed to synchronize', stale_count)
+        sync_calls = sum(redmine.user_calls.values())
+        logger.info('Users are synchronized in %.1f seconds', sync_duration)
+
+        driver = Driver(updater, telegram, redmine, args.taps, args.timeout)
+        conversations_started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(driver.converse, range(1, args.users + 1)))
+        conversations_duration = time.perf_counter() - conversations_started_at
+
+        updater.dispatcher.stop()
+        job_queue.stop()
+        dispatcher_thread.join()
+    finally:
+        scheduler.stop()
+        telegram.stop()
+        redmine.stop()
+        shutil.rmtree(work_dir)
+
+    user_calls = sorted(redmine.user_calls.get(user_id, 0)
+                        for user_id in range(1, args.users + 1))
+    return {
+        'created_at': datetime.utcnow().isoformat(),
+        'options': vars(args),
+        'sync': {
+            'duration': sync_duration,
+            'failed_users': stale_count,
+            'redmine_calls_per_user': sync_calls / args.users
+        },
+        'conversations': {
+            'count': args.users,
+            'duration': conversations_duration,
+            'per_second': args.users / conversations_duration,
+            'failures': dict(driver.failures)
+        },
+        'steps': {step: percentiles(driver.timings[step]) for step in STEPS},
+        'redmine': {
+            'calls': dict(redmine.calls),
+            'calls_per_user': {
+                'mean': sum(user_calls) / len(user_calls),
+                'p50': user_calls[len(user_calls) // 2],
+                'max': user_calls[-1]
+            }
+        },
+        'telegram': {'calls': dict(telegram.calls)}
+    }
+
+
+def main(argv=None):
+    """Run the load test from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users, every user has one conversation')
+    parser.add_argument('--concurrency', type=int, default=200,
+                        help='Number of concurrent conversations')
+    parser.add_argument('--taps', type=int, default=3, help='Taps on the hours buttons')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--sync-concurrency', type=int, default=4)
+    parser.add_argument('--sync-rate', type=float, default=2,
+                        help='Syncs started per second, 0 is unlimited')
+    parser.add_argument('--sync-spread', type=float, default=5,
+                        help='Seconds across which the startup syncs are spread')
+    parser.add_argument('--edit-delay', type=float, default=1)
+    parser.add_argument('--telegram-rate', type=float, default=30)
+    parser.add_argument('--telegram-concurrency', type=int, default=4)
+    parser.add_argument('--chat-interval', type=float, default=1)
+    parser.add_argument('--chat-burst', type=int, default=3)
+    parser.add_argument('--time-entries-per-user', type=int, default=20)
+    parser.add_argument('--issues-per-user', type=int, default=3)
+    parser.add_argument('--redmine-latency', type=float, default=0.05)
+    parser.add_argument('--redmine-error-rate', type=float, default=0)
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='File of results. Default is stdout')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    logging.getLogger('tracktime').setLevel(logging.WARNING)
+    logging.getLogger('telegram').setLevel(logging.ERROR)
+
+    results = run(args)
+    for step in STEPS:
+        result = results['steps'][step]
+        if result['count']:
+            logging.info('%-10s p50 %8.1f ms  p99 %8.1f ms', step, result['p50'] * 1000,
+                         result['p99'] * 1000)
+    logging.info('Redmine calls per user %.1f', results['redmine']['calls_per_user']['mean'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Tests of the asynchronous sync with Redmine."""
+
+import asyncio
+from datetime import date
+
+import pytest
+
+from tracktime.aioredmine import AsyncRedmineWrapper
+from tracktime.database import create_database_engine
+from tracktime.handlers import find_or_create_user, get_user, save_user_key, \
+    sync_users_with_redmine_async
+from tracktime.models import initialize_tables, Issue, TimeEntry, User
+
+
+class StubAsyncRedmine(AsyncRedmineWrapper):
+    """Asynchronous wrapper whose responses are pages from memory.
+
+    Redmine rejects the authorization key on the page ``rejected_page``.
+    """
+
+    page_size = 2
+
+    def __init__(self, time_entries, rejected_page=None):
+        super().__init__('http://redmine.invalid')
+        self.time_entries = time_entries
+        self.rejected_page = rejected_page
+        self.requests = []
+
+    async def _get(self, authkey, path, params=None):
+        self.requests.append(path)
+        if path == '/users/current.json':
+            return {'user': {'id': 1}}
+        if path == '/issues.json':
+            ids = [int(i) for i in params['issue_id'].split(',')]
+            return {'issues': [{'id': i, 'subject': 'Issue {}'.format(i)} for i in ids]}
+
+        page = params['offset'] // self.page_size
+        if page == self.rejected_page:
+            return None
+        return {
+            'time_entries': self.time_entries[params['offset']:params['offset'] + params['limit']],
+            'total_count': len(self.time_entries)
+        }
+
+
+class StubBucket:
+    """Token bucket which counts taken tokens."""
+
+    def __init__(self):
+        self.tokens = 0
+
+    def try_acquire(self):
+        self.tokens += 1
+        return 0
+
+
+def make_time_entries(count):
+    return [{
+        'id': i,
+        'issue': {'id': 100 + i},
+        'spent_on': str(date.today()),
+        'hours': 1.0,
+        'comments': 'Entry'
+    } for i in range(1, count + 1)]
+
+
+def run(coroutine_function, *args):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine_function(*args))
+    finally:
+        loop.close()
+
+
+async def get_all_time_entry(time_entries, rejected_page):
+    redmine = StubAsyncRedmine(time_entries, rejected_page)
+    try:
+        return await redmine.get_all_time_entry(User(1, 'key', redmine_user_id=1))
+    finally:
+        await redmine.close()
+
+
+async def sync_users(user_ids, engine, time_entries, rejected_page, rate_limit):
+    redmine = StubAsyncRedmine(time_entries, rejected_page)
+    try:
+        failed_user_ids = await sync_users_with_redmine_async(
+            user_ids, redmine, engine, rate_limit=rate_limit)
+        return failed_user_ids, redmine.requests
+    finally:
+        await redmine.close()
+
+
+class StubRedmine:
+    """Synchronous wrapper which accepts every authorization key."""
+
+    def get_user_id(self, authkey):
+        return 1
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_database_engine('sqlite:///{}'.format(tmp_path / 'test.db'))
+    initialize_tables(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def user_ids(engine):
+    for user_id in (1, 2, 3):
+        find_or_create_user(user_id, engine=engine)
+        save_user_key(user_id, 'key{}'.format(user_id), redmine=StubRedmine(), engine=engine)
+    return [1, 2, 3]
+
+
+def test_get_all_time_entry_returns_pages_received_before_rejection():
+    time_entries = run(get_all_time_entry, make_time_entries(5), 2)
+
+    assert [time_entry.id for time_entry in time_entries] == [1, 2, 3, 4]
+
+
+def test_sync_takes_rate_budget_for_every_user(engine, user_ids):
+    bucket = StubBucket()
+
+    failed_user_ids, _ = run(sync_users, user_ids, engine, make_time_entries(5), None, bucket)
+
+    assert failed_user_ids == []
+    assert bucket.tokens == len(user_ids)
+    assert engine.execute(TimeEntry.__table__.count()).scalar() == 5
+    assert engine.execute(Issue.__table__.count()).scalar() == 5
+
+
+def test_sync_keeps_pages_and_forgets_user_id_when_authkey_rejected(engine, user_ids):
+    failed_user_ids, requests = run(sync_users, [1], engine, make_time_entries(5), 1, None)
+
+    assert failed_user_ids == []
+    assert engine.execute(TimeEntry.__table__.count()).scalar() == 2
+    user = get_user(1, engine=engine)
+    assert user.redmine_user_id is None
+    assert user.synced_at is None
+    assert '/users/current.json' not in requests
@@ -0,0 +1,155 @@
+"""Tests of the debounced edits of the hours message."""
+
+import threading
+from datetime import timedelta
+
+import pytest
+from telegram.ext import Dispatcher
+
+from tracktime import bot
+
+edit_hours_later = getattr(bot, '__edit_hours_later')
+close_edit = getattr(bot, '__close_edit')
+locked_edit = getattr(bot, '__locked_edit')
+
+
+class SyncDispatcher:
+    """Dispatcher which runs asynchronous handlers in the calling thread."""
+
+    def run_async(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+
+class FakeJob:
+    """Job of the job queue which is run by the test."""
+
+    def __init__(self, callback, name):
+        self.callback = callback
+        self.name = name
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+    def run(self):
+        self.callback(None, self)
+
+
+class FakeJobQueue:
+    """Job queue which keeps jobs until the test runs them."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, name=None):
+        job = FakeJob(callback, name)
+        self.jobs.append(job)
+        return job
+
+    def get_jobs_by_name(self, name):
+        return [job for job in self.jobs if job.name == name and not job.removed]
+
+
+class FakeChat:
+
+    id = 1
+
+
+class FakeMessage:
+
+    chat = FakeChat()
+    message_id = 10
+
+
+class SentEdits:
+    """Edits of the message which are sent, an edit waits while ``paused`` is cleared."""
+
+    def __init__(self):
+        self.hours = []
+        self.started = threading.Event()
+        self.paused = threading.Event()
+        self.paused.set()
+
+    def __call__(self, message, status, has_done_button=True):
+        self.started.set()
+        self.paused.wait(5)
+        self.hours.append(status.get('hours'))
+
+
+@pytest.fixture
+def edits(monkeypatch):
+    sent = SentEdits()
+    monkeypatch.setattr(Dispatcher, 'get_instance', classmethod(lambda cls: SyncDispatcher()))
+    monkeypatch.setattr(bot, 'edit_set_hours_time_entry', sent)
+    yield sent
+    bot._edits.clear()
+
+
+def schedule(job_queue, hours):
+    message = FakeMessage()
+    with locked_edit(message.chat.id, message.message_id) as edit:
+        edit_hours_later(job_queue, edit, message, {'hours': hours}, True, timedelta(seconds=1))
+    return job_queue.jobs[-1]
+
+
+def test_only_latest_edit_is_sent(edits):
+    job_queue = FakeJobQueue()
+    first = schedule(job_queue, 1)
+    second = schedule(job_queue, 2)
+
+    assert first.removed
+    first.run()
+    second.run()
+
+    assert edits.hours == [2]
+
+
+def test_fired_edit_superseded_by_later_tap_is_dropped(edits):
+    job_queue = FakeJobQueue()
+    first = schedule(job_queue, 1)
+
+    message = FakeMessage()
+    with locked_edit(message.chat.id, message.message_id) as edit:
+        thread = threading.Thread(target=first.run)
+        thread.start()
+        edit_hours_later(job_queue, edit, message, {'hours': 2}, True, timedelta(seconds=1))
+    thread.join(5)
+    job_queue.jobs[-1].run()
+
+    assert edits.hours == [2]
+
+
+def test_fired_edit_is_dropped_after_close(edits):
+    job_queue = FakeJobQueue()
+    first = schedule(job_queue, 1)
+
+    close_edit(job_queue, FakeMessage.chat.id, FakeMessage.message_id)
+    first.run()
+
+    assert edits.hours == []
+
+
+def test_close_waits_for_edit_which_is_being_sent(edits):
+    job_queue = FakeJobQueue()
+    first = schedule(job_queue, 1)
+    second = schedule(job_queue, 2)
+
+    edits.paused.clear()
+    thread = threading.Thread(target=second.run)
+    thread.start()
+    assert edits.started.wait(5)
+
+    closed = threading.Event()
+    closer = threading.Thread(target=lambda: (
+        close_edit(job_queue, FakeMessage.chat.id, FakeMessage.message_id), closed.set()))
+    closer.start()
+    assert not closed.wait(0.1)
+
+    edits.paused.set()
+    thread.join(5)
+    closer.join(5)
+    first.run()
+
+    assert closed.is_set()
+    assert edits.hours == [2]
+    assert bot._edits == {}
@@ -0,0 +1,145 @@
+"""Tests of the dispatcher of outbound requests to Telegram."""
+
+import pytest
+from telegram.error import RetryAfter
+
+from tracktime.dispatcher import OutboundDispatcher
+from tracktime.scheduler import PRIORITY_BACKGROUND
+
+
+class FakeClock:
+    """Clock which is moved by the test."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FlakyRequest:
+    """Request which is rejected with "retry after" a number of times."""
+
+    def __init__(self, rejections, retry_after=5):
+        self.rejections = rejections
+        self.retry_after = retry_after
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.rejections:
+            raise RetryAfter(self.retry_after)
+        return 'sent'
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def dispatcher(clock):
+    """Dispatcher without threads whose requests are run by the test one by one."""
+    return OutboundDispatcher(rate=1000, burst=1000, chat_interval=1, chat_burst=2,
+                              concurrency=0, max_retries=2, clock=clock)
+
+
+def pick(dispatcher):
+    with dispatcher._condition:
+        return dispatcher._pick(dispatcher._clock())
+
+
+def send_next(dispatcher):
+    chat_id, entry, timeout = pick(dispatcher)
+    assert entry is not None, 'no request is ready, the next one in {}s'.format(timeout)
+    dispatcher._send(chat_id, entry)
+    return entry[3]
+
+
+def test_interactive_requests_run_before_background(dispatcher):
+    dispatcher.submit(1, lambda: 'background', priority=PRIORITY_BACKGROUND)
+    dispatcher.submit(2, lambda: 'interactive')
+
+    assert send_next(dispatcher).result() == 'interactive'
+    assert send_next(dispatcher).result() == 'background'
+
+
+def test_requests_to_one_chat_run_one_by_one(dispatcher):
+    dispatcher.submit(1, lambda: 'first')
+    dispatcher.submit(1, lambda: 'second')
+
+    chat_id, entry, _ = pick(dispatcher)
+    assert pick(dispatcher) == (None, None, None)
+
+    dispatcher._send(chat_id, entry)
+    assert entry[3].result() == 'first'
+    assert send_next(dispatcher).result() == 'second'
+
+
+def test_new_messages_are_paced_by_the_bucket_of_the_chat(dispatcher, clock):
+    futures = [dispatcher.submit(1, lambda i=i: i) for i in range(3)]
+
+    send_next(dispatcher)
+    send_next(dispatcher)
+    assert pick(dispatcher) == (None, None, 1)
+
+    edit = dispatcher.submit(2, lambda: 'edit', paced=False)
+    assert send_next(dispatcher) is edit
+
+    clock.now += 1
+    send_next(dispatcher)
+    assert [future.result() for future in futures] == [0, 1, 2]
+
+
+def test_edits_are_not_paced(dispatcher):
+    futures = [dispatcher.submit(1, lambda i=i: i, paced=False) for i in range(5)]
+
+    for future in futures:
+        assert send_next(dispatcher) is future
+
+
+def test_background_messages_wait_for_the_full_bucket(dispatcher, clock):
+    dispatcher.submit(1, lambda: 'interactive')
+    send_next(dispatcher)
+    notification = dispatcher.submit(1, lambda: 'background', priority=PRIORITY_BACKGROUND)
+
+    assert pick(dispatcher) == (None, None, 1)
+
+    clock.now += 1
+    assert send_next(dispatcher) is notification
+
+
+def test_request_rejected_with_retry_after_is_run_again_after_delay(dispatcher, clock):
+    request = FlakyRequest(rejections=1, retry_after=5)
+    future = dispatcher.submit(1, request)
+
+    send_next(dispatcher)
+    assert not future.done()
+    assert len(dispatcher) == 1
+    assert pick(dispatcher) == (None, None, 5)
+
+    clock.now += 5
+    send_next(dispatcher)
+    assert future.result() == 'sent'
+    assert request.calls == 2
+
+
+def test_request_rejected_with_retry_after_fails_after_max_retries(dispatcher, clock):
+    request = FlakyRequest(rejections=3, retry_after=5)
+    future = dispatcher.submit(1, request)
+
+    for _ in range(3):
+        send_next(dispatcher)
+        clock.now += 5
+
+    assert isinstance(future.exception(), RetryAfter)
+    assert request.calls == 3
+    assert len(dispatcher) == 0
+
+
+def test_threads_send_requests():
+    dispatcher = OutboundDispatcher(concurrency=2)
+    try:
+        assert dispatcher.send(1, lambda: 'sent') == 'sent'
+    finally:
+        dispatcher.stop()
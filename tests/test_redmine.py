@@ -0,0 +1,335 @@
+"""Tests of the bulk requests of issues to Redmine."""
+
+import math
+from datetime import date, datetime, timedelta
+
+import pytest
+from redminelib.exceptions import AuthError
+from sqlalchemy import select
+
+from tracktime.database import create_database_engine
+from tracktime import handlers
+from tracktime.handlers import backfill_user_with_redmine, claim_outbox_time_entries, \
+    find_or_create_user, flush_time_entry_outbox, get_user, queue_time_entry, save_user_key, \
+    sync_user_with_redmine
+from tracktime.models import initialize_tables, BackfillCheckpoint, Issue, OutboxTimeEntry, \
+    TimeEntry, TimeEntryRecord, UserRecentIssue
+from tracktime.redmine import RedmineWrapper
+
+
+class StubIssue:
+    """Issue resource of redminelib."""
+
+    def __init__(self, id):
+        self.id = id
+        self.subject = 'Issue {}'.format(id)
+
+
+class StubIssueManager:
+    """Issue manager of redminelib which records requests."""
+
+    def __init__(self):
+        self.calls = []
+
+    def filter(self, issue_id, status_id, limit):
+        ids = [int(i) for i in issue_id.split(',')]
+        self.calls.append(ids)
+        return [StubIssue(i) for i in ids]
+
+
+class StubClient:
+    """Client of redminelib with the issue manager only."""
+
+    def __init__(self):
+        self.issue = StubIssueManager()
+
+
+class StubPool:
+    """Pool which returns the same client for every key."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, url, authkey):
+        return self.client
+
+
+class StubUser:
+    """User of the bot with the authorization key only."""
+
+    authkey = 'key'
+
+
+class StubRedmine:
+    """Redmine wrapper which answers from memory and records calls.
+
+    When ``rejected_after`` is set Redmine rejects the authorization key after
+    that number of time entries. Results of saves of time entries are taken from
+    ``save_results``: an ID of the saved time entry, None if Redmine rejects the
+    time entry or an exception which is raised. When ``interrupted_at`` is set
+    the request of the page at that offset fails once with a connection error.
+    """
+
+    url = 'http://redmine.invalid'
+    page_size = 10
+
+    def __init__(self, time_entries, rejected_after=None, save_results=(),
+                 interrupted_at=None):
+        self.time_entries = time_entries
+        self.rejected_after = rejected_after
+        self.rejected = False
+        self.save_results = list(save_results)
+        self.interrupted_at = interrupted_at
+        self.page_calls = []
+        self.get_user_id_calls = 0
+        self.get_issues_calls = []
+        self.saved_time_entries = []
+
+    def get_user_id(self, authkey):
+        self.get_user_id_calls += 1
+        return None if self.rejected else 1
+
+    def iter_time_entries(self, user, spent_on=None, from_date=None, updated_since=None):
+        if user.redmine_user_id is None:
+            return
+        for i, time_entry in enumerate(self.time_entries):
+            if i == self.rejected_after:
+                self.rejected = True
+                raise AuthError()
+            yield time_entry
+
+    def get_time_entry_page(self, user, offset=0, from_date=None):
+        self.page_calls.append((offset, from_date))
+        if offset == self.interrupted_at:
+            self.interrupted_at = None
+            raise ConnectionError()
+        time_entries = sorted(
+            (time_entry for time_entry in self.time_entries
+             if from_date is None or time_entry.spent_on >= from_date),
+            key=lambda time_entry: (time_entry.spent_on, time_entry.id))
+        return time_entries[offset:offset + self.page_size], len(time_entries)
+
+    def get_issues(self, user, issue_ids):
+        self.get_issues_calls.append(set(issue_ids))
+        return [Issue(issue_id, 'Issue {}'.format(issue_id)) for issue_id in issue_ids]
+
+    def save_time_entry(self, time_entry):
+        self.saved_time_entries.append(
+            (time_entry.user.authkey, time_entry.issue_id, time_entry.hours))
+        result = self.save_results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def make_time_entries(count, issues=300, days=30):
+    today = date.today()
+    return [
+        TimeEntryRecord(i, 1000 + i % issues, today - timedelta(days=i % days), 1.0, 'Entry')
+        for i in range(1, count + 1)
+    ]
+
+
+def time_entry_ids(engine):
+    return sorted(r[0] for r in engine.execute(select([TimeEntry.id])))
+
+
+def outbox_rows(engine):
+    return engine.execute(OutboxTimeEntry.__table__.select()).fetchall()
+
+
+def make_due(engine):
+    table = OutboxTimeEntry.__table__
+    engine.execute(table.update().values(next_attempt_at=datetime.utcnow()))
+
+
+def queue(engine, user_id):
+    engine.execute(Issue.__table__.insert().values(id=7, name='Issue 7'))
+    return queue_time_entry({
+        'user_id': user_id,
+        'issue_id': 7,
+        'spent_on': date.today(),
+        'hours': 2.0,
+        'comments': 'Outbox'
+    }, chat_id=42, engine=engine)
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_database_engine('sqlite:///{}'.format(tmp_path / 'test.db'))
+    initialize_tables(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def user_id(engine):
+    find_or_create_user(1, engine=engine)
+    save_user_key(1, 'key', redmine=StubRedmine([]), engine=engine)
+    return 1
+
+
+@pytest.mark.parametrize('count', [1, 99, 100, 101, 250])
+@pytest.mark.parametrize('chunk_size', [1, 10, 100, 1000])
+def test_get_issues_requests_grow_with_chunks(count, chunk_size):
+    client = StubClient()
+    redmine = RedmineWrapper('http://redmine.invalid', pool=StubPool(client))
+    issue_ids = list(range(1, count + 1))
+
+    issues = redmine.get_issues(StubUser(), issue_ids, chunk_size=chunk_size)
+
+    assert len(client.issue.calls) == math.ceil(count / chunk_size)
+    assert all(len(ids) <= chunk_size for ids in client.issue.calls)
+    assert sorted(issue.id for issue in issues) == issue_ids
+
+
+def test_get_issues_without_ids_makes_no_requests():
+    client = StubClient()
+    redmine = RedmineWrapper('http://redmine.invalid', pool=StubPool(client))
+
+    assert redmine.get_issues(StubUser(), []) == []
+    assert client.issue.calls == []
+
+
+def test_sync_requests_missing_issues_once(engine, user_id):
+    redmine = StubRedmine(make_time_entries(1000))
+
+    sync_user_with_redmine(user_id, redmine=redmine, engine=engine)
+
+    assert redmine.get_issues_calls == [{1000 + i for i in range(300)}]
+
+    sync_user_with_redmine(user_id, redmine=redmine, engine=engine)
+
+    assert len(redmine.get_issues_calls) == 1
+
+
+def test_sync_forgets_user_id_once_when_authkey_rejected(engine, user_id):
+    redmine = StubRedmine(make_time_entries(10), rejected_after=4)
+
+    sync_user_with_redmine(user_id, redmine=redmine, engine=engine)
+
+    assert time_entry_ids(engine) == [1, 2, 3, 4]
+    user = get_user(user_id, engine=engine)
+    assert user.redmine_user_id is None
+    assert user.synced_at is None
+    assert redmine.get_user_id_calls == 0
+
+    sync_user_with_redmine(user_id, redmine=redmine, engine=engine)
+
+    assert redmine.get_user_id_calls == 1
+
+
+def test_backfill_resumes_from_checkpoint_and_counts_entries_once(engine, user_id):
+    time_entries = make_time_entries(30, issues=3, days=10)
+    redmine = StubRedmine(time_entries, interrupted_at=20)
+
+    with pytest.raises(ConnectionError):
+        backfill_user_with_redmine(user_id, redmine=redmine, engine=engine, chunk_size=10)
+
+    checkpoint = engine.execute(BackfillCheckpoint.__table__.select()).fetchone()
+    saved = sorted(time_entries, key=lambda time_entry: (time_entry.spent_on, time_entry.id))
+    assert checkpoint.time_entry_count == 20
+    assert checkpoint.spent_on == saved[19].spent_on
+    assert checkpoint.completed_at is None
+    assert len(time_entry_ids(engine)) == 20
+
+    redmine.page_calls = []
+    count = backfill_user_with_redmine(user_id, redmine=redmine, engine=engine, chunk_size=10)
+
+    assert redmine.page_calls[0] == (0, saved[19].spent_on)
+    assert count == 10
+    checkpoint = engine.execute(BackfillCheckpoint.__table__.select()).fetchone()
+    assert checkpoint.time_entry_count == 30
+    assert checkpoint.completed_at is not None
+    assert time_entry_ids(engine) == list(range(1, 31))
+
+
+def test_flush_moves_accepted_time_entry_from_outbox(engine, user_id):
+    redmine = StubRedmine([], save_results=[500])
+    queue(engine, user_id)
+
+    assert flush_time_entry_outbox(redmine, engine) == []
+
+    assert redmine.saved_time_entries == [('key', 7, 2.0)]
+    assert outbox_rows(engine) == []
+    assert time_entry_ids(engine) == [500]
+    recent = engine.execute(UserRecentIssue.__table__.select()).fetchall()
+    assert [(row['user_id'], row['issue_id']) for row in recent] == [(user_id, 7)]
+
+
+def test_flush_drops_rejected_time_entry_and_reports_it(engine, user_id):
+    redmine = StubRedmine([], save_results=[None])
+    queue(engine, user_id)
+
+    failed = flush_time_entry_outbox(redmine, engine)
+
+    assert [(status['chat_id'], status['issue_name']) for status in failed] == [(42, 'Issue 7')]
+    assert outbox_rows(engine) == []
+    assert time_entry_ids(engine) == []
+
+
+def test_flush_retries_failed_request_with_backoff(engine, user_id):
+    redmine = StubRedmine([], save_results=[ConnectionError('down'), 500])
+    queue(engine, user_id)
+
+    before = datetime.utcnow()
+    assert flush_time_entry_outbox(redmine, engine, backoff=timedelta(seconds=30)) == []
+
+    row, = outbox_rows(engine)
+    assert row['attempts'] == 1
+    assert row['next_attempt_at'] >= before + timedelta(seconds=30)
+    assert 'down' in row['last_error']
+
+    assert flush_time_entry_outbox(redmine, engine) == []
+    assert len(redmine.saved_time_entries) == 1
+
+    make_due(engine)
+    assert flush_time_entry_outbox(redmine, engine) == []
+    assert len(redmine.saved_time_entries) == 2
+    assert outbox_rows(engine) == []
+    assert time_entry_ids(engine) == [500]
+
+
+def test_flush_drops_time_entry_after_all_attempts(engine, user_id):
+    redmine = StubRedmine([], save_results=[ConnectionError('down')] * 2)
+    queue(engine, user_id)
+
+    assert flush_time_entry_outbox(redmine, engine, max_attempts=2) == []
+    make_due(engine)
+    failed = flush_time_entry_outbox(redmine, engine, max_attempts=2)
+
+    assert [status['chat_id'] for status in failed] == [42]
+    assert outbox_rows(engine) == []
+
+
+def test_flush_keeps_accepted_time_entry_when_db_write_fails(engine, user_id, monkeypatch):
+    redmine = StubRedmine([], save_results=[500])
+    queue(engine, user_id)
+    move = handlers.move_outbox_time_entry
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('disk is full')
+
+    monkeypatch.setattr(handlers, 'move_outbox_time_entry', fail)
+    assert flush_time_entry_outbox(redmine, engine) == []
+
+    row, = outbox_rows(engine)
+    assert row['time_entry_id'] == 500
+    assert time_entry_ids(engine) == []
+
+    monkeypatch.setattr(handlers, 'move_outbox_time_entry', move)
+    make_due(engine)
+    assert flush_time_entry_outbox(redmine, engine, max_attempts=1) == []
+
+    assert len(redmine.saved_time_entries) == 1
+    assert outbox_rows(engine) == []
+    assert time_entry_ids(engine) == [500]
+
+
+def test_claimed_time_entries_are_not_claimed_again(engine, user_id):
+    queue(engine, user_id)
+
+    claimed = claim_outbox_time_entries(lease=timedelta(minutes=10), engine=engine)
+
+    assert [entry['attempts'] for entry in claimed] == [1]
+    assert claim_outbox_time_entries(engine=engine) == []
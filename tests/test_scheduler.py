@@ -0,0 +1,155 @@
+"""Tests of the scheduler of synchronizations."""
+
+import threading
+
+import pytest
+
+from tracktime.scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, SyncScheduler, \
+    TokenBucket
+
+
+class FakeClock:
+    """Clock which is moved by the test."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class Log:
+    """Tasks which record their runs."""
+
+    def __init__(self):
+        self.runs = []
+
+    def task(self, name):
+        return lambda: self.runs.append(name)
+
+
+@pytest.fixture
+def scheduler():
+    """Scheduler without threads whose tasks are run by the test one by one."""
+    return SyncScheduler(concurrency=0, background_concurrency=1, max_background_queue=3)
+
+
+def start_next(scheduler):
+    with scheduler._condition:
+        entry = scheduler._pick()
+    if entry is not None:
+        entry[3]()
+    return entry
+
+
+def run_all(scheduler):
+    while True:
+        entry = start_next(scheduler)
+        if entry is None:
+            return
+        scheduler._done(entry)
+
+
+def test_tasks_run_in_order_of_priority_then_submission(scheduler):
+    log = Log()
+    scheduler.submit('b1', log.task('b1'))
+    scheduler.submit('i1', log.task('i1'), priority=PRIORITY_INTERACTIVE)
+    scheduler.submit('b2', log.task('b2'))
+    scheduler.submit('i2', log.task('i2'), priority=PRIORITY_INTERACTIVE)
+
+    run_all(scheduler)
+
+    assert log.runs == ['i1', 'i2', 'b1', 'b2']
+
+
+def test_queued_task_is_not_queued_twice(scheduler):
+    log = Log()
+    assert scheduler.submit('a', log.task('a'))
+    assert not scheduler.submit('a', log.task('a'))
+    assert len(scheduler) == 1
+
+    run_all(scheduler)
+
+    assert log.runs == ['a']
+    assert scheduler.submit('a', log.task('a'))
+
+
+def test_resubmitted_interactive_task_jumps_ahead(scheduler):
+    log = Log()
+    scheduler.submit('a', log.task('a'))
+    scheduler.submit('b', log.task('b'))
+
+    assert scheduler.submit('b', log.task('b'), priority=PRIORITY_INTERACTIVE)
+    assert not scheduler.submit('b', log.task('b'), priority=PRIORITY_BACKGROUND)
+    assert len(scheduler) == 2
+
+    run_all(scheduler)
+
+    assert log.runs == ['b', 'a']
+    assert len(scheduler) == 0
+    assert not scheduler.is_full()
+
+
+def test_background_tasks_do_not_take_threads_of_interactive_tasks(scheduler):
+    log = Log()
+    scheduler.submit('b1', log.task('b1'))
+    scheduler.submit('b2', log.task('b2'))
+
+    running = start_next(scheduler)
+    assert start_next(scheduler) is None
+
+    scheduler.submit('i1', log.task('i1'), priority=PRIORITY_INTERACTIVE)
+    scheduler._done(start_next(scheduler))
+    assert log.runs == ['b1', 'i1']
+
+    scheduler._done(running)
+    run_all(scheduler)
+    assert log.runs == ['b1', 'i1', 'b2']
+
+
+def test_full_queue_rejects_background_tasks_only(scheduler):
+    log = Log()
+    for name in ('b1', 'b2', 'b3'):
+        assert scheduler.submit(name, log.task(name))
+
+    assert scheduler.is_full()
+    assert not scheduler.submit('b4', log.task('b4'))
+    assert scheduler.submit('i1', log.task('i1'), priority=PRIORITY_INTERACTIVE)
+
+    scheduler._done(start_next(scheduler))
+    scheduler._done(start_next(scheduler))
+    assert not scheduler.is_full()
+    assert scheduler.submit('b4', log.task('b4'))
+
+    run_all(scheduler)
+    assert log.runs == ['i1', 'b1', 'b2', 'b3', 'b4']
+
+
+def test_threads_run_submitted_tasks():
+    done = threading.Event()
+    scheduler = SyncScheduler(concurrency=2)
+    try:
+        scheduler.submit('a', done.set, priority=PRIORITY_INTERACTIVE, budget='redmine')
+        assert done.wait(5)
+    finally:
+        scheduler.stop()
+
+
+def test_token_bucket_adds_tokens_with_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+    clock.now += 0.25
+    assert bucket.try_acquire() == pytest.approx(0.25)
+
+    clock.now += 0.25
+    assert bucket.try_acquire() == 0
+
+    clock.now += 10
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
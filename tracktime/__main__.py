@@ -6,24 +6,96 @@
 
 The application must be configured through the environment.
 
+The bot is started by `python -m tracktime`. The whole history of time entries
+of users is copied from Redmine by `python -m tracktime backfill`, see
+`python -m tracktime backfill --help`. The backfill uses only the environment of
+Redmine and the database.
+
 Environment:
     TELEGRAM_TOKEN : The telegram token.
     REDMINE_URL : Redmine URI that should track time entry.
     DSN_DB: Optional. Default `sqlite:///sqlite.db`. Database data source name.
+    DB_ECHO: Optional. Default `false`. Log all SQL statements when `true`.
+    DB_POOL_SIZE: Optional. Default is `WORKERS` plus `SYNC_CONCURRENCY`. Number of kept
+        database connections.
+    DB_MAX_OVERFLOW: Optional. Default is `WORKERS` plus `SYNC_CONCURRENCY`. Number of
+        database connections over the pool size.
+    DB_BUSY_TIMEOUT: Optional. Default `30`. Seconds SQLite waits for a locked database.
+    DB_SLOW_QUERY_MS: Optional. When set, statements are timed and aggregated, statements
+        slower than this number of milliseconds are logged and the aggregate is written
+        to `DB_QUERY_LOG_DIR` on the signal `SIGUSR1`.
+    DB_QUERY_LOG_DIR: Optional. Default is the current directory. Directory of the
+        aggregates of statements.
+    WORKERS: Optional. Default `4`. Number of workers which process conversation steps.
+    SYNC_WINDOW_DAYS: Optional. Default `7`. Number of days which are synchronized
+        with Redmine every day in addition to time entries updated since the last sync.
+    SYNC_CONCURRENCY: Optional. Default `4`. Number of workers which run synchronizations
+        and other background jobs.
+    SYNC_BACKGROUND_CONCURRENCY: Optional. Default is one less than `SYNC_CONCURRENCY`.
+        Number of workers which run daily synchronizations, the rest run synchronizations
+        requested by users.
+    SYNC_MAX_QUEUE: Optional. Default `100`. Number of queued daily synchronizations after
+        which new ones are deferred.
+    SYNC_RATE: Optional. Default `2`. Number of synchronizations started per second.
+    SYNC_SPREAD_MINUTES: Optional. Default `60`. Number of minutes across which the daily
+        synchronizations of users are spread.
+    SYNC_DAILY_AT: Optional. Default `00:00`. Local time of day of the daily synchronization.
+    SYNC_ON_STARTUP: Optional. Default `true`. Synchronize stale users on startup.
+    SYNC_STALE_HOURS: Optional. Default `24`. Number of hours after the last successful
+        synchronization after which the user is synchronized on startup.
+    SYNC_ASYNC_CONCURRENCY: Optional. When set, the daily synchronization runs on an event
+        loop with this number of users synchronized concurrently.
+    TELEGRAM_RATE: Optional. Default `30`. Number of requests per second sent to Telegram.
+    TELEGRAM_CHAT_INTERVAL: Optional. Default `1`. Number of seconds between requests
+        to one chat after its burst is spent.
+    TELEGRAM_CHAT_BURST: Optional. Default `3`. Number of requests to one chat which are
+        sent without waiting.
+    TELEGRAM_CONCURRENCY: Optional. Default `4`. Number of requests sent to Telegram
+        concurrently.
     PROXY_URL: Optional. URI proxy through which the bot will work.
     PROXY_USERNAME: Optional. Proxy username.
     PROXY_PASSWORD: Optional. Proxy password.
+    WEBHOOK_PORT: Optional. When set, the bot receives updates by webhook on this port
+        instead of long polling. TLS must be terminated in front of the bot.
+    WEBHOOK_LISTEN: Optional. Default `127.0.0.1`. Address the webhook listens on.
+    WEBHOOK_PATH: Optional. Default is empty. Path of the webhook.
+    WEBHOOK_URL: Optional. Public URL of the webhook which is registered in Telegram.
+        When it is not set the webhook must be registered by hand, so updates can be
+        POSTed to the listener locally, e.g.
+        `curl -d @update.json -H 'Content-Type: application/json' 127.0.0.1:8443/path`.
+    WEBHOOK_MAX_CONNECTIONS: Optional. Default `40`. Maximum number of concurrent
+        connections from Telegram to the webhook.
+    METRICS_PORT: Optional. When set, metrics are served in the Prometheus text format
+        on this port.
+    METRICS_LISTEN: Optional. Default `127.0.0.1`. Address the metrics endpoint listens on.
+    PROFILE_SAMPLE_RATE: Optional. When set, this share of conversation steps and syncs is
+        profiled and a profile is written to `PROFILE_DIR` on the signal `SIGUSR2`.
+    PROFILE_TRACEMALLOC_FRAMES: Optional. When set, allocations are traced with this number
+        of frames and the allocation sites are added to the profile.
+    PROFILE_TOP: Optional. Default `30`. Number of functions and allocation sites in a profile.
+    PROFILE_DIR: Optional. Default is the current directory. Directory of profiles.
 """
 
+import argparse
 import logging
 import os
+import sys
+from datetime import datetime, time, timedelta
 
-from sqlalchemy import create_engine
 from telegram.ext import Updater
 
 from tracktime.bot import create_help_handler, create_setting_handler, create_tracktime_handler, \
     sync_daily_users
+from tracktime.database import create_database_engine
+from tracktime.dispatcher import OutboundDispatcher, set_default_dispatcher
+from tracktime.handlers import all_user_ids, backfill_users_with_redmine
+from tracktime.metrics import DISPATCHER_QUEUE_DEPTH, instrument_engine, JOB_QUEUE_DEPTH, \
+    RUN_ASYNC_WORKERS, SCHEDULER_QUEUE_DEPTH, start_http_server
 from tracktime.models import initialize_tables
+from tracktime.profiling import install_signal_handler, Profiler, set_default_profiler
+from tracktime.querylog import dump_on_signal, QueryLog
+from tracktime.redmine import RedmineWrapper
+from tracktime.scheduler import SyncScheduler
 
 logging.basicConfig(
     format='%(asctime)s %(levelname)-8s %(message)s',
@@ -43,16 +115,57 @@ def run(config):
     :param config: Configuration dictionary.
 
     Key `proxy` is optional. If key `proxy` is not exists then bot create
-    a standard connection. Example:
+    a standard connection. Key `webhook` is optional. If key `webhook` is not
+    exists then bot uses long polling. Key `metrics` is optional. If key `metrics`
+    is not exists then metrics are not served. Key `profiling` is optional. If key
+    `profiling` is not exists then nothing is profiled. Example:
 
         config = {
             'token': 'TELEGRAM_TOKEN',
             'redmine_url': 'REDMINE_URL',
             'dsn_db': 'DSN_DB',
+            'db_echo': False,  # Optional
+            'db_pool_size': 4,  # Optional
+            'db_max_overflow': 4,  # Optional
+            'db_busy_timeout': 30,  # Optional
+            'db_slow_query_ms': 500,  # Optional
+            'db_query_log_dir': '.',  # Optional
+            'workers': 4,  # Optional
+            'sync_window_days': 7,  # Optional
+            'sync_concurrency': 4,  # Optional
+            'sync_background_concurrency': 3,  # Optional
+            'sync_max_queue': 100,  # Optional
+            'sync_rate': 2,  # Optional
+            'sync_spread_minutes': 60,  # Optional
+            'sync_async_concurrency': 100,  # Optional
+            'sync_daily_at': time(0),  # Optional
+            'sync_on_startup': True,  # Optional
+            'sync_stale_hours': 24,  # Optional
+            'telegram_rate': 30,  # Optional
+            'telegram_chat_interval': 1,  # Optional
+            'telegram_chat_burst': 3,  # Optional
+            'telegram_concurrency': 4,  # Optional
             'proxy': {  # Optional
                 'url': 'PROXY_URL',
                 'username': 'PROXY_USERNAME',
                 'password': 'PROXY_PASSWORD'
+            },
+            'webhook': {  # Optional
+                'port': 8443,
+                'listen': '127.0.0.1',  # Optional
+                'path': 'WEBHOOK_PATH',  # Optional
+                'url': 'WEBHOOK_URL',  # Optional
+                'max_connections': 40  # Optional
+            },
+            'metrics': {  # Optional
+                'port': 9090,
+                'listen': '127.0.0.1'  # Optional
+            },
+            'profiling': {  # Optional
+                'sample_rate': 0.01,  # Optional
+                'tracemalloc_frames': 10,  # Optional
+                'top': 30,  # Optional
+                'output_dir': '.'  # Optional
             }
         }
 
@@ -67,24 +180,59 @@ def run(config):
             }
         }
 
-    updater = Updater(config['token'], workers=4, request_kwargs=request_kwargs)
+    dispatcher = OutboundDispatcher(
+        rate=config.get('telegram_rate', 30),
+        burst=config.get('telegram_rate', 30),
+        chat_interval=config.get('telegram_chat_interval', 1),
+        chat_burst=config.get('telegram_chat_burst', 3),
+        concurrency=config.get('telegram_concurrency', 4))
+    set_default_dispatcher(dispatcher)
 
-    engine = create_engine(config['dsn_db'], echo=True)
-    initialize_tables(engine)
+    if 'profiling' in config:
+        __start_profiling(config['profiling'])
+
+    workers = config.get('workers', 4)
+    updater = Updater(config['token'], workers=workers, request_kwargs=request_kwargs)
+
+    sync_concurrency = config.get('sync_concurrency', 4)
+    scheduler = SyncScheduler(
+        concurrency=sync_concurrency,
+        rate=config.get('sync_rate', 2),
+        background_concurrency=config.get('sync_background_concurrency'),
+        max_background_queue=config.get('sync_max_queue', 100))
+
+    engine = __create_engine(config, workers + sync_concurrency)
+
+    if 'metrics' in config:
+        __start_metrics(config['metrics'], updater, scheduler, dispatcher, engine, workers)
 
-    sync_daily_users(updater.job_queue, config['redmine_url'], engine)
+    sync_window = timedelta(days=config.get('sync_window_days', 7))
+    sync_spread = timedelta(minutes=config.get('sync_spread_minutes', 60))
+    sync_daily_users(
+        updater.job_queue,
+        config['redmine_url'],
+        engine,
+        sync_window=sync_window,
+        scheduler=scheduler,
+        sync_spread=sync_spread,
+        async_concurrency=config.get('sync_async_concurrency'),
+        daily_time=config.get('sync_daily_at', time(0)),
+        startup_sync=config.get('sync_on_startup', True),
+        stale_after=timedelta(hours=config.get('sync_stale_hours', 24)))
 
     setting_handler = create_setting_handler(
         engine=engine,
         job_queue=updater.job_queue,
         start_command_name='start',
-        redmine_url=config['redmine_url'])
+        redmine_url=config['redmine_url'],
+        scheduler=scheduler)
     tracktime_handler = create_tracktime_handler(
         engine=engine,
         job_queue=updater.job_queue,
         redmine_url=config['redmine_url'],
         start_command_name='track',
-        cancel_command_name='cancel')
+        cancel_command_name='cancel',
+        scheduler=scheduler)
     help_handler = create_help_handler(command_name='help')
 
     dp = updater.dispatcher
@@ -93,17 +241,152 @@ def run(config):
     dp.add_handler(help_handler)
     dp.add_error_handler(__error)
 
-    updater.start_polling()
+    if 'webhook' in config:
+        __start_webhook(updater, config['webhook'])
+    else:
+        updater.start_polling()
     updater.idle()
 
 
+def backfill(config, user_ids=None, chunk_size=1000, restart=False):
+    """Copy the whole history of time entries from Redmine to db.
+
+    The backfill of every user is resumed from its checkpoint, so the command
+    can be interrupted and run again.
+
+    :param dict config: Configuration of the application, see :func:`run`.
+        Only the keys of Redmine and the database are used.
+    :param list user_ids: Optional. IDs of users in telegram. By default all users
+    :param int chunk_size: Number of time entries which are committed together
+    :param bool restart: Start backfills from the beginning even if they were completed
+    :return: IDs of users whose backfill failed
+    """
+    engine = __create_engine(config, 1)
+    if user_ids is None:
+        user_ids = all_user_ids(engine)
+
+    logging.info('Backfill of %s users is started', len(user_ids))
+    failed_user_ids = backfill_users_with_redmine(
+        user_ids,
+        redmine=RedmineWrapper(config['redmine_url']),
+        engine=engine,
+        chunk_size=chunk_size,
+        restart=restart)
+    logging.info('Backfill is completed, failed users: %s', len(failed_user_ids))
+    return failed_user_ids
+
+
+def __create_engine(config, workers):
+    """Create the database engine and the tables.
+
+    :param dict config: Configuration of the application
+    :param int workers: Number of threads which use the engine concurrently
+    :rtype: sqlalchemy.engine.Engine
+    """
+    engine = create_database_engine(
+        config['dsn_db'],
+        workers=workers,
+        echo=config.get('db_echo', False),
+        pool_size=config.get('db_pool_size'),
+        max_overflow=config.get('db_max_overflow'),
+        busy_timeout=config.get('db_busy_timeout', 30))
+    if 'db_slow_query_ms' in config:
+        query_log = QueryLog(
+            slow_threshold=config['db_slow_query_ms'] / 1000,
+            output_dir=config.get('db_query_log_dir', '.'))
+        query_log.instrument(engine)
+        dump_on_signal(query_log)
+    initialize_tables(engine)
+    return engine
+
+
+def __start_metrics(metrics, updater, scheduler, dispatcher, engine, workers):
+    """Start serving metrics.
+
+    :param dict metrics: Configuration of the metrics endpoint
+    :param telegram.ext.Updater updater:
+    :param tracktime.scheduler.SyncScheduler scheduler:
+    :param tracktime.dispatcher.OutboundDispatcher dispatcher:
+    :param sqlalchemy.engine.Engine engine:
+    :param int workers: Number of run_async workers
+    """
+    instrument_engine(engine)
+    RUN_ASYNC_WORKERS.set(workers)
+    JOB_QUEUE_DEPTH.set_function(updater.job_queue.queue.qsize)
+    SCHEDULER_QUEUE_DEPTH.set_function(lambda: len(scheduler))
+    DISPATCHER_QUEUE_DEPTH.set_function(lambda: len(dispatcher))
+    start_http_server(metrics['port'], metrics.get('listen', '127.0.0.1'))
+
+
+def __start_profiling(profiling):
+    """Start profiling and dump the profile on the signal.
+
+    :param dict profiling: Configuration of profiling
+    """
+    profiler = Profiler(
+        sample_rate=profiling.get('sample_rate', 0),
+        top=profiling.get('top', 30),
+        output_dir=profiling.get('output_dir', '.'))
+    if profiling.get('tracemalloc_frames'):
+        profiler.start_tracemalloc(profiling['tracemalloc_frames'])
+    set_default_profiler(profiler)
+    install_signal_handler()
+
+
+def __start_webhook(updater, webhook):
+    """Start receiving updates by webhook.
+
+    :param telegram.ext.Updater updater:
+    :param dict webhook: Configuration of the webhook
+    """
+    updater.start_webhook(
+        listen=webhook.get('listen', '127.0.0.1'),
+        port=webhook['port'],
+        url_path=webhook.get('path', ''))
+
+    if webhook.get('url'):
+        updater.bot.set_webhook(
+            url=webhook['url'], max_connections=webhook.get('max_connections', 40))
+
+
 def __get_env_config():
     config = {
-        'token': os.environ['TELEGRAM_TOKEN'],
+        'token': os.getenv('TELEGRAM_TOKEN'),
         'redmine_url': os.environ['REDMINE_URL'],
-        'dsn_db': os.getenv('DSN_DB', 'sqlite:///sqlite.db')
+        'dsn_db': os.getenv('DSN_DB', 'sqlite:///sqlite.db'),
+        'db_echo': os.getenv('DB_ECHO', 'false').lower() in ('1', 'true', 'yes'),
+        'db_busy_timeout': float(os.getenv('DB_BUSY_TIMEOUT', 30)),
+        'workers': int(os.getenv('WORKERS', 4)),
+        'sync_window_days': int(os.getenv('SYNC_WINDOW_DAYS', 7)),
+        'sync_concurrency': int(os.getenv('SYNC_CONCURRENCY', 4)),
+        'sync_max_queue': int(os.getenv('SYNC_MAX_QUEUE', 100)),
+        'sync_daily_at': datetime.strptime(os.getenv('SYNC_DAILY_AT', '00:00'), '%H:%M').time(),
+        'sync_on_startup': os.getenv('SYNC_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes'),
+        'sync_stale_hours': float(os.getenv('SYNC_STALE_HOURS', 24)),
+        'sync_rate': float(os.getenv('SYNC_RATE', 2)),
+        'sync_spread_minutes': float(os.getenv('SYNC_SPREAD_MINUTES', 60)),
+        'telegram_rate': float(os.getenv('TELEGRAM_RATE', 30)),
+        'telegram_chat_interval': float(os.getenv('TELEGRAM_CHAT_INTERVAL', 1)),
+        'telegram_chat_burst': int(os.getenv('TELEGRAM_CHAT_BURST', 3)),
+        'telegram_concurrency': int(os.getenv('TELEGRAM_CONCURRENCY', 4))
     }
 
+    if 'DB_POOL_SIZE' in os.environ:
+        config['db_pool_size'] = int(os.getenv('DB_POOL_SIZE'))
+
+    if 'DB_MAX_OVERFLOW' in os.environ:
+        config['db_max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW'))
+
+    if 'DB_SLOW_QUERY_MS' in os.environ:
+        config['db_slow_query_ms'] = float(os.getenv('DB_SLOW_QUERY_MS'))
+        config['db_query_log_dir'] = os.getenv('DB_QUERY_LOG_DIR', '.')
+
+    if 'SYNC_BACKGROUND_CONCURRENCY' in os.environ:
+        config['sync_background_concurrency'] = int(os.getenv('SYNC_BACKGROUND_CONCURRENCY'))
+
+    if 'SYNC_ASYNC_CONCURRENCY' in os.environ:
+        config['sync_async_concurrency'] = int(os.getenv('SYNC_ASYNC_CONCURRENCY'))
+
     config_proxy = {}
     if 'PROXY_URL' in os.environ:
         config_proxy['url'] = os.getenv('PROXY_URL')
@@ -117,9 +400,56 @@ def __get_env_config():
     if len(config_proxy) == 3:
         config['proxy'] = config_proxy
 
+    if 'WEBHOOK_PORT' in os.environ:
+        config['webhook'] = {
+            'port': int(os.getenv('WEBHOOK_PORT')),
+            'listen': os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+            'path': os.getenv('WEBHOOK_PATH', ''),
+            'url': os.getenv('WEBHOOK_URL'),
+            'max_connections': int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+        }
+
+    config_profiling = {}
+    if 'PROFILE_SAMPLE_RATE' in os.environ:
+        config_profiling['sample_rate'] = float(os.getenv('PROFILE_SAMPLE_RATE'))
+
+    if 'PROFILE_TRACEMALLOC_FRAMES' in os.environ:
+        config_profiling['tracemalloc_frames'] = int(os.getenv('PROFILE_TRACEMALLOC_FRAMES'))
+
+    if config_profiling:
+        config_profiling['top'] = int(os.getenv('PROFILE_TOP', 30))
+        config_profiling['output_dir'] = os.getenv('PROFILE_DIR', '.')
+        config['profiling'] = config_profiling
+
+    if 'METRICS_PORT' in os.environ:
+        config['metrics'] = {
+            'port': int(os.getenv('METRICS_PORT')),
+            'listen': os.getenv('METRICS_LISTEN', '127.0.0.1')
+        }
+
     return config
 
 
+def __backfill_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m tracktime backfill',
+        description='Copy the whole history of time entries from Redmine to db.')
+    parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                        help='ID user in telegram. Can be repeated. Default is all users')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Number of time entries which are committed together')
+    parser.add_argument('--restart', action='store_true',
+                        help='Start from the beginning even if the backfill was completed')
+    args = parser.parse_args(argv)
+
+    failed_user_ids = backfill(
+        __get_env_config(), args.user_ids, chunk_size=args.chunk_size, restart=args.restart)
+    return 1 if failed_user_ids else 0
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['backfill']:
+        sys.exit(__backfill_main(sys.argv[2:]))
+
     config = __get_env_config()
     run(config)
@@ -0,0 +1,171 @@
+"""This module contain the asynchronous wrapper for the Redmine REST API."""
+
+import aiohttp
+from redminelib.exceptions import AuthError
+
+from tracktime.metrics import redmine_call
+from tracktime.models import Issue, TimeEntryRecord
+
+
+class AsyncRedmineWrapper:
+    """Asynchronous counterpart of :class:`tracktime.redmine.RedmineWrapper` for syncs.
+
+    All requests share one :class:`aiohttp.ClientSession`, so connections are kept
+    alive and reused between users. The wrapper must be created and used on the
+    same event loop and closed by :meth:`close` when it is not needed.
+    """
+
+    page_size = 100
+
+    def __init__(self, redmine_url, max_connections=100, timeout=60):
+        """Initialize wrapper.
+
+        :param str redmine_url: The redmine url
+        :param int max_connections: Maximum number of open connections to Redmine
+        :param float timeout: Number of seconds to wait for a response
+        """
+        self.url = redmine_url.rstrip('/')
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max_connections),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def close(self):
+        """Close connections to Redmine."""
+        await self.session.close()
+
+    async def check_authkey(self, authkey):
+        """Check authorization key.
+
+        :param string authkey: Authorization key to check
+        :return: True if authorization key is correct
+        """
+        return await self.get_user_id(authkey) is not None
+
+    @redmine_call('get_user_id')
+    async def get_user_id(self, authkey):
+        """Get ID user in Redmine which owns the authorization key.
+
+        :param string authkey: Authorization key in Redmine
+        :return: ID user or None if authorization key is not correct
+        """
+        response = await self._get(authkey, '/users/current.json')
+        if response is None:
+            return None
+        return response['user']['id']
+
+    @redmine_call('get_all_time_entry')
+    async def get_all_time_entry(self, user, spent_on=None, from_date=None, updated_since=None):
+        """Get all time entry from redmine for user.
+
+        Time entries are requested page by page with the same filters as
+        :meth:`tracktime.redmine.RedmineWrapper.get_all_time_entry`. If Redmine
+        rejects the authorization key then the time entries which were received
+        before are returned.
+
+        :param tracktime.models.User user:
+        :param datetime.date spent_on: Optional. Only time entries spent on this date
+        :param datetime.date from_date: Optional. Only time entries spent on this date or later
+        :param datetime.date updated_since: Optional. Only time entries updated on this date
+            or later
+        :return: List of :class:`tracktime.models.TimeEntryRecord`
+        """
+        time_entries = list()
+        try:
+            async for time_entry in self.iter_time_entries(
+                    user, spent_on, from_date, updated_since):
+                time_entries.append(time_entry)
+        except AuthError:
+            pass
+        return time_entries
+
+    async def iter_time_entries(self, user, spent_on=None, from_date=None, updated_since=None):
+        """Yield time entries of the user from Redmine requesting them page by page.
+
+        The counterpart of :meth:`tracktime.redmine.RedmineWrapper.iter_time_entries`:
+        nothing is requested when the ID user in Redmine is not known and the user
+        is not changed when Redmine rejects the authorization key.
+
+        :param tracktime.models.User user:
+        :param datetime.date spent_on: Optional. Only time entries spent on this date
+        :param datetime.date from_date: Optional. Only time entries spent on this date or later
+        :param datetime.date updated_since: Optional. Only time entries updated on this date
+            or later
+        :return: Asynchronous iterator of :class:`tracktime.models.TimeEntryRecord`
+        :raises redminelib.exceptions.AuthError: If Redmine rejected the authorization key
+        """
+        if user.redmine_user_id is None:
+            return
+
+        params = {'user_id': user.redmine_user_id}
+        if spent_on is not None:
+            params['spent_on'] = str(spent_on)
+        if from_date is not None:
+            params['from'] = str(from_date)
+        if updated_since is not None:
+            params['updated_on'] = '>={}'.format(updated_since)
+
+        offset = 0
+        while True:
+            time_entries, count, total_count = await self._get_time_entry_page(
+                user.authkey, offset, params)
+            for time_entry in time_entries:
+                yield time_entry
+
+            offset += count
+            if not count or offset >= total_count:
+                return
+
+    @redmine_call('get_time_entry_page')
+    async def _get_time_entry_page(self, authkey, offset, params):
+        """Request one page of time entries.
+
+        :return: Tuple of the list of records, the number of time entries in the page
+            and the total number of time entries
+        :raises redminelib.exceptions.AuthError: If Redmine rejected the authorization key
+        """
+        response = await self._get(
+            authkey, '/time_entries.json', dict(params, limit=self.page_size, offset=offset))
+        if response is None:
+            raise AuthError()
+
+        time_entries = [
+            TimeEntryRecord.from_redmine(r_time_entry)
+            for r_time_entry in response['time_entries'] if 'issue' in r_time_entry
+        ]
+        return time_entries, len(response['time_entries']), response.get('total_count', 0)
+
+    @redmine_call('get_issues')
+    async def get_issues(self, user, issue_ids, chunk_size=100):
+        """Get issues from Redmine by ids using bulk requests.
+
+        :param tracktime.models.User user:
+        :param issue_ids: IDs of issues in Redmine
+        :param int chunk_size: Maximum number of issues in one request
+        :rtype: list
+        """
+        issue_ids = sorted(issue_ids)
+        issues = list()
+        for i in range(0, len(issue_ids), chunk_size):
+            chunk = issue_ids[i:i + chunk_size]
+            response = await self._get(user.authkey, '/issues.json', {
+                'issue_id': ','.join(str(issue_id) for issue_id in chunk),
+                'status_id': '*',
+                'limit': len(chunk)
+            })
+            if response is None:
+                break
+            issues.extend(Issue(r_issue['id'], r_issue['subject'])
+                          for r_issue in response['issues'])
+        return issues
+
+    async def _get(self, authkey, path, params=None):
+        """Make a GET request to Redmine.
+
+        :return: Decoded JSON response or None if authorization key is rejected
+        """
+        headers = {'X-Redmine-API-Key': authkey}
+        async with self.session.get(self.url + path, params=params, headers=headers) as response:
+            if response.status in (401, 403):
+                return None
+            response.raise_for_status()
+            return await response.json()
@@ -1,35 +1,51 @@
 """This module contains the functions for creating handlers for a Telegram."""
+import asyncio
 import logging
-from datetime import date, datetime, timedelta
+import random
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
 
 from telegram.ext import CallbackQueryHandler, CommandHandler, \
     ConversationHandler, Filters, MessageHandler, run_async
 
-from tracktime.handlers import all_user_ids, find_or_create_user, get_actual_issues, \
-    save_time_entry, save_user_key, sync_user_with_redmine
+from tracktime.aioredmine import AsyncRedmineWrapper
+from tracktime.handlers import all_user_ids, find_or_create_user, flush_time_entry_outbox, \
+    get_actual_issues, queue_time_entry, save_user_key, stale_user_ids, sync_user_with_redmine, \
+    sync_users_with_redmine_async
 from tracktime.messages import delete_message, edit_save_time_entry, \
     edit_set_comment_time_entry, edit_set_hours_time_entry, \
     edit_set_issue_time_entry, reply_cancel_time_entry, reply_help, \
     reply_invalid_redmine_key, reply_save_redmine_settings, \
     reply_set_hours_time_entry, reply_set_redmine_key, \
     reply_set_spent_on_time_entry, reply_start_redmine_settings, \
-    reply_start_time_entry, reply_welcome
+    reply_start_time_entry, reply_welcome, send_failed_time_entry
+from tracktime.metrics import conversation_step
+from tracktime.profiling import profiled
 from tracktime.redmine import RedmineWrapper
+from tracktime.scheduler import default_scheduler, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
 
+_outbox_lock = threading.Lock()
+_edits_lock = threading.Lock()
+_edits = {}
 
-def create_setting_handler(engine, job_queue, start_command_name, redmine_url):
+
+def create_setting_handler(engine, job_queue, start_command_name, redmine_url, scheduler=None):
     """Create a handler to configure the settings for the user.
 
     :param sqlalchemy.engine.Engine engine: Engine database
     :param telegram.ext.JobQueue job_queue:
     :param str start_command_name: Start command name in the chat
     :param str redmine_url: Url redmine resources
+    :param tracktime.scheduler.SyncScheduler scheduler: Optional. Scheduler of
+        synchronizations. By default the shared scheduler is used.
     :return: Handler of Telegram
 
     """
     SET_KEY = 1
 
     redmine = RedmineWrapper(redmine_url)
+    scheduler = scheduler if scheduler is not None else default_scheduler()
 
     @run_async
     def start(bot, update):
@@ -49,7 +65,8 @@ def create_setting_handler(engine, job_queue, start_command_name, redmine_url):
             reply_invalid_redmine_key(update.message)
             return ConversationHandler.END
 
-        __sync_user(user_id, job_queue=job_queue, redmine=redmine, engine=engine)
+        __sync_user(
+            user_id, job_queue=job_queue, redmine=redmine, engine=engine, scheduler=scheduler)
         reply_save_redmine_settings(update.message)
         reply_welcome(update.message)
         return ConversationHandler.END
@@ -61,35 +78,54 @@ def create_setting_handler(engine, job_queue, start_command_name, redmine_url):
 
 
 def create_tracktime_handler(engine, job_queue, redmine_url, start_command_name,
-                             cancel_command_name):
+                             cancel_command_name, scheduler=None,
+                             outbox_interval=timedelta(minutes=1),
+                             edit_delay=timedelta(seconds=1)):
     """Create a handler to build and save a time entry.
 
+    The saved time entry is queued to the outbox and the user gets the answer
+    immediately. Time entries from the outbox are saved to Redmine in the
+    background, the user is notified only if it failed.
+
     :param sqlalchemy.engine.Engine engine:  Engine database
     :param telegram.ext.JobQueue job_queue:
     :param str redmine_url: Url redmine resources
     :param str start_command_name: Start command name in chat
     :param str cancel_command_name: Cancel command name in chat
+    :param tracktime.scheduler.SyncScheduler scheduler: Optional. Scheduler of
+        synchronizations. By default the shared scheduler is used.
+    :param datetime.timedelta outbox_interval: Interval of retries of the outbox
+    :param datetime.timedelta edit_delay: Quiet period after the last tap on the hours
+        buttons after which the message is edited
     :return: Handler in Telegram
 
     """
     SPENT_ON, ISSUE, COMMENTS, HOURS = range(10, 14)
 
     redmine = RedmineWrapper(redmine_url)
+    scheduler = scheduler if scheduler is not None else default_scheduler()
+
+    def flush_time_entry_outbox(bot, job):
+        __flush_time_entry_outbox(bot, scheduler, redmine, engine)
+
+    job_queue.run_repeating(flush_time_entry_outbox, outbox_interval, first=0)
 
     @run_async
+    @__conversation_step('start')
     def start(bot, update, user_data):
         reply_start_time_entry(update.message)
 
         user_id = int(update.message.from_user.id)
         message = reply_set_spent_on_time_entry(update.message, {})
 
-        __sync_user_on_today(user_id, job_queue, redmine, engine)
+        __sync_user_on_today(user_id, scheduler, redmine, engine)
 
         user_data['message_id'] = message.message_id
         user_data['user_id'] = user_id
         return SPENT_ON
 
     @run_async
+    @__conversation_step('spent_on')
     def spent_on(bot, update, user_data):
         spent_date = datetime.strptime(update.callback_query.data, '%Y-%m-%d')
         user_data['spent_on'] = spent_date.date()
@@ -100,10 +136,11 @@ def create_tracktime_handler(engine, job_queue, redmine_url, start_command_name,
             user_data['issues'][issue.id] = issue.name
 
         message = update.callback_query.message
-        edit_set_issue_time_entry(message, user_data, issues)
+        edit_set_issue_time_entry(message, user_data, issues, user_id=update.effective_user.id)
         return ISSUE
 
     @run_async
+    @__conversation_step('issue')
     def issue(bot, update, user_data):
         issue_id = int(update.callback_query.data)
 
@@ -115,6 +152,7 @@ def create_tracktime_handler(engine, job_queue, redmine_url, start_command_name,
         return COMMENTS
 
     @run_async
+    @__conversation_step('comments')
     def comments(bot, update, user_data):
         user_data['comments'] = update.message.text
 
@@ -125,34 +163,52 @@ def create_tracktime_handler(engine, job_queue, redmine_url, start_command_name,
         return HOURS
 
     @run_async
+    @__conversation_step('add_hours')
     def add_hours(bot, update, user_data):
-        hours = user_data.get('hours', 0)
-        hours += float(update.callback_query.data)
-        user_data['hours'] = hours
-
         message = update.callback_query.message
-        edit_set_hours_time_entry(message, user_data, has_done_button=True)
+        with __locked_edit(message.chat.id, message.message_id) as edit:
+            hours = user_data.get('hours', 0)
+            hours += float(update.callback_query.data)
+            user_data['hours'] = hours
+
+            __edit_hours_later(job_queue, edit, message, user_data, True, edit_delay)
         return HOURS
 
     @run_async
+    @__conversation_step('reset_hours')
     def reset_hours(bot, update, user_data):
-        del (user_data['hours'])
-
         message = update.callback_query.message
-        edit_set_hours_time_entry(message, user_data, has_done_button=False)
+        with __locked_edit(message.chat.id, message.message_id) as edit:
+            user_data.pop('hours', None)
+
+            __edit_hours_later(job_queue, edit, message, user_data, False, edit_delay)
         return HOURS
 
     @run_async
+    @__conversation_step('done')
     def done(bot, update, user_data):
-        if not save_time_entry(user_data, redmine, engine=engine):
-            return ConversationHandler.END
+        message = update.callback_query.message
+        if user_data.get('issue_id') is None:
+            # A stale or repeated "Done": the conversation is at an earlier step or ended
+            return None if 'message_id' in user_data else ConversationHandler.END
+
+        with __locked_edit(message.chat.id, message.message_id) as edit:
+            if not user_data.get('hours'):
+                __edit_hours_later(job_queue, edit, message, user_data, False, timedelta(0))
+                return HOURS
+
+        __close_edit(job_queue, message.chat.id, message.message_id)
+        queue_time_entry(user_data, update.effective_chat.id, engine=engine)
 
-        edit_save_time_entry(update.callback_query.message, user_data)
+        edit_save_time_entry(message, user_data)
         user_data.clear()
+        __flush_time_entry_outbox(bot, scheduler, redmine, engine)
         return ConversationHandler.END
 
     @run_async
+    @__conversation_step('cancel')
     def cancel(bot, update, user_data):
+        __close_edit(job_queue, update.message.chat.id, user_data['message_id'])
         delete_message(update.message.chat, user_data['message_id'])
         reply_cancel_time_entry(update.message)
         user_data.clear()
@@ -191,68 +247,282 @@ def create_help_handler(command_name):
     return CommandHandler(command_name, help)
 
 
-def __sync_user(user_id, time_offset=0, job_queue=None, redmine=None, engine=None):
+def __sync_user(user_id, time_offset=0, job_queue=None, redmine=None, engine=None, window=None,
+                scheduler=None, priority=PRIORITY_INTERACTIVE):
     """Create a job to synchronize the user in Redmine with the database.
 
+    The job queues the synchronization into the scheduler, which runs it when
+    there is a free slot. When the scheduler does not accept background tasks
+    the job is deferred by ``time_offset`` or a minute.
+
     :param int user_id:
     :param int time_offset:
     :param telegram.ext.JobQueue job_queue:
     :param tracktime.redmine.RedmineWrapper redmine:
     :param sqlalchemy.engine.Engine engine:
+    :param datetime.timedelta window: Optional. Sliding window of the incremental sync.
+        The whole history is synchronized when it is not set.
+    :param tracktime.scheduler.SyncScheduler scheduler:
+    :param int priority: Priority of the synchronization in the scheduler
 
     """
     logger = logging.getLogger(__name__)
+    job_name = 'sync_user_{}'.format(user_id)
 
-    @run_async
-    def sync_time_entries(bot, job):
+    def sync_time_entries():
         logger.info('Start sync time entries for user {}'.format(user_id))
-        sync_user_with_redmine(user_id, redmine=redmine, engine=engine)
+        sync_user_with_redmine(user_id, redmine=redmine, engine=engine, window=window)
         logger.info('Finish sync {}'.format(user_id))
 
-    job_name = 'sync_user_{}'.format(user_id)
+    def schedule_sync_time_entries(bot, job):
+        if priority == PRIORITY_BACKGROUND and scheduler.is_full():
+            logger.info('Defer sync time entries for user {}'.format(user_id))
+            job_queue.run_once(schedule_sync_time_entries, time_offset or 60, name=job_name)
+            return
+        scheduler.submit(job_name, sync_time_entries, priority=priority, budget=redmine.url)
+
     if len(job_queue.get_jobs_by_name(job_name)) == 0:
-        job_queue.run_once(sync_time_entries, time_offset, name=job_name)
+        job_queue.run_once(schedule_sync_time_entries, time_offset, name=job_name)
 
 
-def sync_daily_users(job_queue=None, redmine_url=None, engine=None):
+def sync_daily_users(job_queue=None, redmine_url=None, engine=None, sync_window=None,
+                     scheduler=None, sync_spread=timedelta(hours=1), async_concurrency=None,
+                     daily_time=time(0), startup_sync=True, stale_after=timedelta(days=1)):
     """Create daily jobs to synchronize saved users in the database with Redmine.
 
+    Synchronizations of users are spread randomly across ``sync_spread`` and
+    run by the scheduler in the background lane. When ``async_concurrency`` is
+    set then all users are synchronized by one background task on an event loop
+    instead, up to ``async_concurrency`` users at the same time. They take the
+    same rate budget of Redmine as synchronizations run by the scheduler.
+
+    On startup only users which were not synchronized successfully for
+    ``stale_after`` are synchronized, so restarts do not resynchronize everyone.
+
     :param telegram.ext.JobQueue job_queue:
     :param str redmine_url:
     :param sqlalchemy.engine.Engine engine:
+    :param datetime.timedelta sync_window: Optional. Sliding window of the incremental sync.
+        When it is not set the whole history of users is synchronized every day.
+    :param tracktime.scheduler.SyncScheduler scheduler: Optional. By default the shared
+        scheduler is used.
+    :param datetime.timedelta sync_spread: Period across which synchronizations are spread
+    :param int async_concurrency: Optional. Number of users synchronized concurrently
+        on the event loop
+    :param datetime.time daily_time: Time of day of the daily synchronization
+    :param bool startup_sync: Synchronize stale users on startup when ``True``
+    :param datetime.timedelta stale_after: Period after the last successful
+        synchronization after which the user is synchronized on startup
 
     """
     redmine = RedmineWrapper(redmine_url)
+    scheduler = scheduler if scheduler is not None else default_scheduler()
+    logger = logging.getLogger(__name__)
+
+    def sync_time_entries_async(user_ids):
+        async def sync():
+            async_redmine = AsyncRedmineWrapper(redmine_url, max_connections=async_concurrency)
+            try:
+                return await sync_users_with_redmine_async(
+                    user_ids, async_redmine, engine, sync_window, concurrency=async_concurrency,
+                    rate_limit=scheduler.rate_limit(redmine.url))
+            finally:
+                await async_redmine.close()
+
+        logger.info('Start async sync time entries for {} users'.format(len(user_ids)))
+        loop = asyncio.new_event_loop()
+        try:
+            failed_user_ids = loop.run_until_complete(sync())
+        finally:
+            loop.close()
+        logger.info('Finish async sync, failed users {}'.format(failed_user_ids))
+
+    def schedule_time_entries(user_ids):
+        for user_id in user_ids:
+            time_offset = random.uniform(0, sync_spread.total_seconds())
+            __sync_user(user_id, time_offset, job_queue, redmine, engine, sync_window,
+                        scheduler, PRIORITY_BACKGROUND)
+
+    def submit_sync(task_name, find_user_ids):
+        def task():
+            user_ids = find_user_ids()
+            if async_concurrency:
+                sync_time_entries_async(user_ids)
+            else:
+                schedule_time_entries(user_ids)
+
+        if not scheduler.submit(task_name, task, priority=PRIORITY_BACKGROUND):
+            logger.warning('Skip {}, the scheduler is full or it is already queued'.format(
+                task_name))
 
-    @run_async
     def sync_all_time_entries(bot, job):
-        time_offset = timedelta()
-        for user_id in all_user_ids(engine):
-            __sync_user(user_id, time_offset, job_queue, redmine, engine)
-            time_offset += timedelta(minutes=1)
+        submit_sync('sync_all_users', lambda: all_user_ids(engine))
 
-    job_queue.run_once(sync_all_time_entries, 0)
-    job_queue.run_daily(sync_all_time_entries, 0)
+    def sync_stale_time_entries(bot, job):
+        stale_before = datetime.utcnow() - stale_after
+        submit_sync('sync_stale_users', lambda: stale_user_ids(stale_before, engine))
 
+    if startup_sync:
+        job_queue.run_once(sync_stale_time_entries, 0)
+    job_queue.run_daily(sync_all_time_entries, daily_time)
 
-def __sync_user_on_today(user_id, job_queue=None, redmine=None, engine=None):
-    """Create a job to partial synchronize the user for today in the database with Redmine.
 
-    :param int user_id:
+def __conversation_step(step):
+    """Decorate the conversation step with metrics and sampled profiling.
+
+    :param str step: Name of the conversation step
+    """
+    def decorator(func):
+        return conversation_step(step)(profiled('step.{}'.format(step))(func))
+
+    return decorator
+
+
+@contextmanager
+def __locked_edit(chat_id, message_id):
+    """Hold the lock of the debounced edits of the message.
+
+    The state of edits is created if it does not exist. Every message has its
+    own lock, so taps in different chats do not wait for each other.
+
+    :param int chat_id:
+    :param int message_id:
+    :rtype: _PendingEdit
+    """
+    key = (chat_id, message_id)
+    while True:
+        with _edits_lock:
+            edit = _edits.get(key)
+            if edit is None:
+                edit = _edits[key] = _PendingEdit()
+        with edit.lock:
+            if not edit.removed:
+                yield edit
+                return
+
+
+def __edit_hours_later(job_queue, edit, message, status, has_done_button, delay):
+    """Edit the message with hours after the quiet period.
+
+    A pending edit of the same message is dropped, so only the latest state is
+    sent when the user taps the buttons quickly. The edit runs on a worker, so
+    the job queue is not blocked by Telegram. An edit which already fired is
+    skipped if a later edit was scheduled or the message was closed by
+    :func:`__close_edit` meanwhile. The caller must hold the lock of the edits
+    by :func:`__locked_edit`.
+
+    :param telegram.ext.JobQueue job_queue:
+    :param _PendingEdit edit: State of edits of the message
+    :param telegram.Message message: A message to which you need to edit
+    :param dict status: Data dictionary which contains time entry information
+    :param bool has_done_button:
+    :param datetime.timedelta delay: Quiet period before the edit
+    """
+    __cancel_edit_later(job_queue, message.chat.id, message.message_id)
+    status = dict(status)
+    key = (message.chat.id, message.message_id)
+    edit.version += 1
+    version = edit.version
+
+    @run_async
+    def edit_hours(bot, job):
+        with edit.lock:
+            if edit.closed or edit.version != version:
+                return
+            try:
+                edit_set_hours_time_entry(message, status, has_done_button=has_done_button)
+            finally:
+                with _edits_lock:
+                    if _edits.get(key) is edit:
+                        del _edits[key]
+                edit.removed = True
+
+    job_queue.run_once(
+        edit_hours, delay, name=__edit_job_name(message.chat.id, message.message_id))
+
+
+def __close_edit(job_queue, chat_id, message_id):
+    """Drop pending edits of the message and wait for the edit which is being sent.
+
+    After the call no edit of hours is sent to the message, so the final text
+    of the message is not overwritten.
+
+    :param telegram.ext.JobQueue job_queue:
+    :param int chat_id:
+    :param int message_id:
+    """
+    __cancel_edit_later(job_queue, chat_id, message_id)
+    with _edits_lock:
+        edit = _edits.pop((chat_id, message_id), None)
+    if edit is not None:
+        with edit.lock:
+            edit.closed = True
+
+
+class _PendingEdit:
+    """State of the debounced edits of one message."""
+
+    __slots__ = ('version', 'closed', 'removed', 'lock')
+
+    def __init__(self):
+        self.version = 0
+        self.closed = False
+        self.removed = False
+        self.lock = threading.Lock()
+
+
+def __cancel_edit_later(job_queue, chat_id, message_id):
+    """Drop the pending edit of the message.
+
     :param telegram.ext.JobQueue job_queue:
+    :param int chat_id:
+    :param int message_id:
+    """
+    for job in job_queue.get_jobs_by_name(__edit_job_name(chat_id, message_id)):
+        job.schedule_removal()
+
+
+def __edit_job_name(chat_id, message_id):
+    return 'edit_message_{}_{}'.format(chat_id, message_id)
+
+
+def __flush_time_entry_outbox(bot, scheduler=None, redmine=None, engine=None):
+    """Queue the save of time entries from the outbox to Redmine.
+
+    :param telegram.Bot bot:
+    :param tracktime.scheduler.SyncScheduler scheduler:
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param sqlalchemy.engine.Engine engine:
+
+    """
+    def flush_time_entries():
+        with _outbox_lock:
+            for status in flush_time_entry_outbox(redmine, engine):
+                if status['chat_id'] is not None:
+                    send_failed_time_entry(bot, status['chat_id'], status)
+
+    scheduler.submit('flush_time_entry_outbox', flush_time_entries,
+                     priority=PRIORITY_INTERACTIVE, budget=redmine.url)
+
+
+def __sync_user_on_today(user_id, scheduler=None, redmine=None, engine=None):
+    """Queue a partial synchronization of the user for today in the database with Redmine.
+
+    The synchronization is run by the scheduler in the interactive lane.
+
+    :param int user_id:
+    :param tracktime.scheduler.SyncScheduler scheduler:
     :param tracktime.redmine.RedmineWrapper redmine:
     :param sqlalchemy.engine.Engine engine:
 
     """
     logger = logging.getLogger(__name__)
+    job_name = 'sync_user_today_{}'.format(user_id)
 
-    @run_async
-    def sync_all_time_entries(bot, job):
+    def sync_all_time_entries():
         logger.info('Start sync time entries on today for user {}'.format(user_id))
         sync_user_with_redmine(user_id, date.today(), redmine, engine)
         logger.info('Finish sync on today {}'.format(user_id))
 
-    job_name = 'sync_user_today_{}'.format(user_id)
-
-    if len(job_queue.get_jobs_by_name(job_name)) == 0:
-        job_queue.run_once(sync_all_time_entries, 0, name=job_name)
+    scheduler.submit(
+        job_name, sync_all_time_entries, priority=PRIORITY_INTERACTIVE, budget=redmine.url)
@@ -0,0 +1,69 @@
+"""This module contains the factory of the database engine."""
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def create_database_engine(dsn, workers=4, echo=False, pool_size=None, max_overflow=None,
+                           pool_timeout=30, busy_timeout=30):
+    """Create the database engine configured for production.
+
+    The connection pool is sized by the number of workers which work with the
+    database concurrently. SQLite databases in a file are switched to the WAL
+    journal with ``synchronous=NORMAL`` and wait for locks up to ``busy_timeout``
+    seconds, so readers do not block the writer of a sync.
+
+    :param str dsn: Database data source name
+    :param int workers: Number of workers which use the database concurrently
+    :param bool echo: Log all statements when ``True``
+    :param int pool_size: Optional. Number of kept connections. Default is ``workers``
+    :param int max_overflow: Optional. Number of connections over the pool size.
+        Default is ``workers``
+    :param float pool_timeout: Number of seconds to wait for a free connection
+    :param float busy_timeout: Number of seconds SQLite waits for a locked database
+    :rtype: sqlalchemy.engine.Engine
+    """
+    url = make_url(dsn)
+    pool_size = pool_size if pool_size is not None else workers
+    max_overflow = max_overflow if max_overflow is not None else workers
+
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(
+            url,
+            echo=echo,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True)
+
+    if _is_sqlite_memory(url):
+        return create_engine(url, echo=echo)
+
+    engine = create_engine(
+        url,
+        echo=echo,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': busy_timeout
+        })
+    _set_sqlite_pragmas(engine, busy_timeout)
+    return engine
+
+
+def _is_sqlite_memory(url):
+    return url.database in (None, '', ':memory:')
+
+
+def _set_sqlite_pragmas(engine, busy_timeout):
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout={:d}'.format(int(busy_timeout * 1000)))
+        cursor.close()
@@ -0,0 +1,257 @@
+"""This module contains the dispatcher of outbound requests to Telegram."""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+from tracktime.scheduler import PRIORITY_INTERACTIVE, TokenBucket
+
+
+class OutboundDispatcher:
+    """Send requests to Telegram within its flood limits.
+
+    Requests are run by ``concurrency`` threads not faster than ``rate``
+    requests per second for the whole bot. Requests to one chat are run one by
+    one. New messages are paced by a token bucket of the chat: ``chat_burst``
+    messages are sent at once and then one message per ``chat_interval``
+    seconds, edits and deletions of messages are not paced. Interactive
+    messages take any token of the bucket, so a conversation step is not paced
+    until it sends a burst. Background messages wait until the bucket is full,
+    so notifications never take the burst of the next step. Among the chats
+    which are ready the request with the higher priority is run first. A
+    request which is rejected with "retry after" is run again after the
+    requested delay and the chat waits for it.
+    """
+
+    def __init__(self, rate=30, burst=30, chat_interval=1, chat_burst=3, concurrency=4,
+                 max_retries=3, clock=time.monotonic):
+        """Initialize dispatcher.
+
+        :param float rate: Number of requests per second for the whole bot
+        :param int burst: Number of requests which can be sent without waiting
+        :param float chat_interval: Number of seconds in which one message to a chat is added
+            to the bucket of the chat
+        :param int chat_burst: Number of messages to one chat which can be sent without waiting
+        :param int concurrency: Number of requests which run concurrently
+        :param int max_retries: Number of retries of the request rejected with "retry after"
+        :param callable clock: Function which returns the current time in seconds
+        """
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._clock = clock
+        self._bucket = TokenBucket(rate, burst, clock)
+        self._chats = {}
+        self._counter = itertools.count()
+        self._threads = []
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def send(self, chat_id, request, priority=PRIORITY_INTERACTIVE, paced=True):
+        """Run the request to the chat and wait for its result.
+
+        :param int chat_id: Chat to which the request is sent
+        :param callable request: Function without arguments which calls the Bot API
+        :param int priority: :data:`tracktime.scheduler.PRIORITY_INTERACTIVE` or
+            :data:`tracktime.scheduler.PRIORITY_BACKGROUND`
+        :param bool paced: The request sends a new message and takes a token of the chat
+        :return: The result of the request
+        """
+        return self.submit(chat_id, request, priority, paced).result()
+
+    def submit(self, chat_id, request, priority=PRIORITY_INTERACTIVE, paced=True):
+        """Queue the request to the chat.
+
+        :param int chat_id: Chat to which the request is sent
+        :param callable request: Function without arguments which calls the Bot API
+        :param int priority: :data:`tracktime.scheduler.PRIORITY_INTERACTIVE` or
+            :data:`tracktime.scheduler.PRIORITY_BACKGROUND`
+        :param bool paced: The request sends a new message and takes a token of the chat
+        :rtype: concurrent.futures.Future
+        """
+        future = Future()
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError('Dispatcher is stopped')
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(self.chat_burst, self._clock())
+            heapq.heappush(
+                chat.queue, [priority, next(self._counter), request, future, paced, 0])
+            self._start()
+            self._condition.notify_all()
+        return future
+
+    def __len__(self):
+        """Return the number of queued requests."""
+        with self._condition:
+            return sum(len(chat.queue) for chat in self._chats.values())
+
+    def stop(self):
+        """Stop the threads after the running requests, the queued requests are cancelled."""
+        with self._condition:
+            self._stopped = True
+            for chat in self._chats.values():
+                for entry in chat.queue:
+                    if not entry[3].cancel():
+                        entry[3].set_exception(RuntimeError('Dispatcher is stopped'))
+            self._chats.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _start(self):
+        while len(self._threads) < self.concurrency:
+            thread = threading.Thread(
+                target=self._run, name='OutboundDispatcher-{}'.format(len(self._threads)),
+                daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None, None
+                chat_id, entry, timeout = self._pick(self._clock())
+                if entry is not None:
+                    return chat_id, entry
+                self._condition.wait(timeout)
+
+    def _pick(self, now):
+        """Take the next request which can run, must be called with the condition held.
+
+        :param float now: The current time
+        :return: Tuple of ID chat, the entry of the request and None if a request can run,
+            otherwise None, None and the number of seconds until a request can run or None
+        """
+        ready_id, timeout = None, None
+        idle_ids = []
+        for chat_id, chat in self._chats.items():
+            if chat.busy:
+                continue
+            if not chat.queue:
+                if chat.ready_at <= now and self._tokens(chat, now) >= self.chat_burst:
+                    idle_ids.append(chat_id)
+                continue
+            delay = self._delay(chat, now)
+            if delay > 0:
+                timeout = delay if timeout is None else min(timeout, delay)
+            elif ready_id is None or chat.queue[0] < self._chats[ready_id].queue[0]:
+                ready_id = chat_id
+        for chat_id in idle_ids:
+            del self._chats[chat_id]
+
+        if ready_id is None:
+            return None, None, timeout
+        chat = self._chats[ready_id]
+        chat.busy = True
+        entry = heapq.heappop(chat.queue)
+        if entry[4]:
+            chat.tokens = self._tokens(chat, now) - 1
+            chat.updated_at = now
+        return ready_id, entry, None
+
+    def _tokens(self, chat, now):
+        if not self.chat_interval:
+            return self.chat_burst
+        return min(self.chat_burst, chat.tokens + (now - chat.updated_at) / self.chat_interval)
+
+    def _delay(self, chat, now):
+        """Return the number of seconds until the next request of the chat can run."""
+        priority, _, _, _, paced, _ = chat.queue[0]
+        if not paced:
+            required = 0
+        elif priority == PRIORITY_INTERACTIVE:
+            required = 1
+        else:
+            required = self.chat_burst
+        delay = max(required - self._tokens(chat, now), 0) * self.chat_interval
+        return max(chat.ready_at - now, delay)
+
+    def _done(self, chat_id, entry=None, delay=0):
+        with self._condition:
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                return
+            chat.busy = False
+            chat.ready_at = self._clock() + delay
+            if entry is not None:
+                heapq.heappush(chat.queue, entry)
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            chat_id, entry = self._next()
+            if entry is None:
+                return
+            self._send(chat_id, entry)
+
+    def _send(self, chat_id, entry):
+        """Run the request taken by :meth:`_next` and release its chat."""
+        _, _, request, future, _, retries = entry
+        if retries == 0 and not future.set_running_or_notify_cancel():
+            self._done(chat_id)
+            return
+
+        self._bucket.acquire()
+        try:
+            result = request()
+        except RetryAfter as e:
+            if retries < self.max_retries:
+                logging.getLogger(__name__).warning(
+                    'Retry request to chat %s after %s seconds', chat_id, e.retry_after)
+                entry[-1] += 1
+                self._done(chat_id, entry, e.retry_after)
+                return
+            future.set_exception(e)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        self._done(chat_id)
+
+
+class _Chat:
+    """Queue of requests to one chat."""
+
+    __slots__ = ('queue', 'busy', 'ready_at', 'tokens', 'updated_at')
+
+    def __init__(self, tokens, updated_at):
+        self.queue = []
+        self.busy = False
+        self.ready_at = 0
+        self.tokens = tokens
+        self.updated_at = updated_at
+
+
+_default_dispatcher = None
+_default_dispatcher_lock = threading.Lock()
+
+
+def default_dispatcher():
+    """Return the dispatcher through which the messages are sent.
+
+    :rtype: OutboundDispatcher
+    """
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        if _default_dispatcher is None:
+            _default_dispatcher = OutboundDispatcher()
+        return _default_dispatcher
+
+
+def set_default_dispatcher(dispatcher):
+    """Replace the dispatcher through which the messages are sent.
+
+    :param OutboundDispatcher dispatcher:
+    """
+    global _default_dispatcher
+    with _default_dispatcher_lock:
+        _default_dispatcher = dispatcher
@@ -1,11 +1,50 @@
 """This module contains the main application logic."""
 
-from sqlalchemy import desc, func, select
-from sqlalchemy.orm import Session, sessionmaker
+import asyncio
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 
-from tracktime.models import Issue, TimeEntry, User
+from redminelib.exceptions import AuthError
+from sqlalchemy import and_, bindparam, desc, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import scoped_session, sessionmaker
 
+from tracktime.metrics import db_time
+from tracktime.models import BackfillCheckpoint, Issue, OutboxTimeEntry, select_recent_issues, \
+    TimeEntry, User, UserRecentIssue
+from tracktime.profiling import profiled
 
+_BULK_CHUNK_SIZE = 500
+
+_session_registries = {}
+_session_registries_lock = threading.Lock()
+
+
+@contextmanager
+def session_scope(engine):
+    """Provide the session of the current thread bound to the engine.
+
+    Uncommitted changes are rolled back if an exception is raised and the session
+    is always closed on exit. Scopes must not be nested in the same thread.
+
+    :param sqlalchemy.engine.Engine engine:
+    :rtype: sqlalchemy.orm.Session
+    """
+    registry = _session_registry(engine)
+    session = registry()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        registry.remove()
+
+
+@db_time('find_or_create_user')
 def find_or_create_user(user_id, engine=None):
     """Find or create user if not exists.
 
@@ -13,17 +52,17 @@ def find_or_create_user(user_id, engine=None):
     :param sqlalchemy.engine.Engine engine:
     :rtype: User
     """
-    session = _create_session(engine=engine)
-    user = session.query(User).filter(User.id == user_id).one_or_none()
-    if user is None:
-        user = User(user_id)
-        session.add(user)
-        session.commit()
+    with session_scope(engine) as session:
+        user = session.query(User).filter(User.id == user_id).one_or_none()
+        if user is None:
+            user = User(user_id)
+            session.add(user)
+            session.commit()
 
-    session.close()
     return user
 
 
+@db_time('save_user_key')
 def save_user_key(user_id, redmine_key, redmine=None, engine=None):
     """Save the authorization key to the user if key valid.
 
@@ -33,19 +72,22 @@ def save_user_key(user_id, redmine_key, redmine=None, engine=None):
     :param sqlalchemy.engine.Engine engine:
     :rtype: bool
     """
-    session = _create_session(engine=engine)
-    user = session.query(User).filter(User.id == user_id).one()
-
-    valid_authkey = redmine.check_authkey(redmine_key)
-    if valid_authkey:
-        user.authkey = redmine_key
-        session.add(user)
-        session.commit()
+    with session_scope(engine) as session:
+        user = session.query(User).filter(User.id == user_id).one()
+
+        redmine_user_id = redmine.get_user_id(redmine_key)
+        valid_authkey = redmine_user_id is not None
+        if valid_authkey:
+            user.authkey = redmine_key
+            user.redmine_user_id = redmine_user_id
+            user.synced_at = None
+            session.add(user)
+            session.commit()
 
-    session.close()
     return valid_authkey
 
 
+@db_time('all_user_ids')
 def all_user_ids(engine):
     """Return all save user id.
 
@@ -55,46 +97,426 @@ def all_user_ids(engine):
     return [r[0] for r in engine.execute(select([User.id])).fetchall()]
 
 
-def sync_user_with_redmine(user_id, spent_on=None, redmine=None, engine=None):
+@db_time('stale_user_ids')
+def stale_user_ids(stale_before, engine):
+    """Return id of users which were not synchronized successfully since the time.
+
+    :param datetime.datetime stale_before: Time of the last successful sync in UTC
+    :param sqlalchemy.engine.Engine engine:
+    :rtype: list
+    """
+    s = select([User.id]).where(or_(User.synced_at.is_(None), User.synced_at < stale_before))
+    return [r[0] for r in engine.execute(s).fetchall()]
+
+
+@db_time('get_user')
+def get_user(user_id, engine=None):
+    """Get the user detached from the session.
+
+    :param int user_id:
+    :param sqlalchemy.engine.Engine engine:
+    :rtype: User
+    """
+    with session_scope(engine) as session:
+        return session.query(User).filter(User.id == user_id).one()
+
+
+@profiled('sync_user_with_redmine')
+@db_time('sync_user_with_redmine')
+def sync_user_with_redmine(user_id, spent_on=None, redmine=None, engine=None, window=None):
     """Copy all time entry from Redmine to db for user.
 
+    When the ``window`` is set and the user was synced before then only time
+    entries spent within the window or updated since the last sync are copied.
+    Otherwise the whole history is copied. The time of the sync is saved to the
+    user unless the sync was partial by ``spent_on``.
+
     :param int user_id:
+    :param datetime.date spent_on: Optional. Copy only time entries spent on this date
     :param tracktime.redmine.RedmineWrapper redmine:
     :param sqlalchemy.engine.Engine engine:
+    :param datetime.timedelta window: Optional. Sliding window of the incremental sync
     """
-    session = _create_session(engine=engine)
+    started_at = datetime.utcnow()
+    user = get_user(user_id, engine=engine)
+    if user.redmine_user_id is None:
+        user.redmine_user_id = redmine.get_user_id(user.authkey)
 
-    user = session.query(User).filter(User.id == user_id).one()
-    issues_ids = [r[0] for r in session.execute(select([Issue.id])).fetchall()]
-    time_entries = session.query(TimeEntry).filter(TimeEntry.user_id == user_id).all()
+    r_time_entries = _fetch_time_entries(redmine, user, spent_on, window)
 
-    for r_time_entry in redmine.get_all_time_entry(user, spent_on=spent_on):
-        if r_time_entry.issue_id not in issues_ids:
-            r_issue = redmine.get_issue(user, r_time_entry.issue_id)
-            issues_ids.append(r_time_entry.issue_id)
-            session.add(r_issue)
+    missing_issue_ids = find_missing_issue_ids(r_time_entries, engine=engine)
+    r_issues = redmine.get_issues(user, missing_issue_ids) if missing_issue_ids else []
 
-        time_entry = __get_time_entry(time_entries, r_time_entry.id)
-        if time_entry is None:
-            time_entry = r_time_entry
-            time_entries.append(time_entry)
+    synced_at = started_at if spent_on is None else None
+    save_synced_time_entries(user, r_time_entries, r_issues, synced_at, engine=engine)
+
+
+async def sync_users_with_redmine_async(user_ids, redmine=None, engine=None, window=None,
+                                        concurrency=100, executor=None, rate_limit=None):
+    """Copy time entries from Redmine to db for many users concurrently on the event loop.
+
+    Requests to Redmine of up to ``concurrency`` users are made concurrently by
+    the asynchronous wrapper while the blocking database work runs in the executor.
+    The result of every user is the same as :func:`sync_user_with_redmine` without
+    ``spent_on``.
+
+    :param list user_ids:
+    :param tracktime.aioredmine.AsyncRedmineWrapper redmine:
+    :param sqlalchemy.engine.Engine engine:
+    :param datetime.timedelta window: Optional. Sliding window of the incremental sync
+    :param int concurrency: Maximum number of users which are synced concurrently
+    :param concurrent.futures.Executor executor: Optional. Executor of the database work.
+        By default the default executor of the event loop is used.
+    :param tracktime.scheduler.TokenBucket rate_limit: Optional. Rate budget of Redmine,
+        one token is taken before the sync of every user
+    :return: IDs of users whose sync failed
+    """
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    logger = logging.getLogger(__name__)
+
+    def run_db(func, *args):
+        return loop.run_in_executor(executor, functools.partial(func, *args, engine=engine))
+
+    async def sync_user(user_id):
+        async with semaphore:
+            if rate_limit is not None:
+                await _acquire_async(rate_limit)
+
+            started_at = datetime.utcnow()
+            user = await run_db(get_user, user_id)
+            if user.redmine_user_id is None:
+                user.redmine_user_id = await redmine.get_user_id(user.authkey)
+
+            r_time_entries = list()
+            try:
+                for filters in time_entry_filters(user, None, window):
+                    async for r_time_entry in redmine.iter_time_entries(user, **filters):
+                        r_time_entries.append(r_time_entry)
+            except AuthError:
+                user.redmine_user_id = None
+            r_time_entries = _unique_time_entries(r_time_entries)
+
+            missing_issue_ids = await run_db(find_missing_issue_ids, r_time_entries)
+            r_issues = list()
+            if missing_issue_ids:
+                r_issues = await redmine.get_issues(user, missing_issue_ids)
+
+            await run_db(save_synced_time_entries, user, r_time_entries, r_issues, started_at)
+
+    results = await asyncio.gather(
+        *(sync_user(user_id) for user_id in user_ids), return_exceptions=True)
+
+    failed_user_ids = list()
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logger.error('Sync of user %s failed: %r', user_id, result)
+            failed_user_ids.append(user_id)
+    return failed_user_ids
+
+
+async def _acquire_async(bucket):
+    """Take one token from the bucket without blocking the event loop.
+
+    :param tracktime.scheduler.TokenBucket bucket:
+    """
+    delay = bucket.try_acquire()
+    while delay:
+        await asyncio.sleep(delay)
+        delay = bucket.try_acquire()
+
+
+def backfill_user_with_redmine(user_id, redmine=None, engine=None, chunk_size=1000,
+                               restart=False):
+    """Copy the whole history of time entries from Redmine to db for user.
+
+    Time entries are streamed page by page in the order of the date they are
+    spent on and saved by chunks, every chunk is committed together with the
+    checkpoint. An interrupted backfill is resumed from the date of the last
+    committed time entry, so memory does not depend on the size of the history
+    and at most one chunk is requested again. When the backfill is completed the
+    time of its start is saved as the time of the sync, so the incremental sync
+    copies time entries which were changed while the backfill ran.
+
+    :param int user_id:
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param sqlalchemy.engine.Engine engine:
+    :param int chunk_size: Number of time entries which are committed together
+    :param bool restart: Start the backfill from the beginning even if it was completed
+    :return: Number of time entries inserted by this call
+    :raises ValueError: If Redmine rejected the authorization key of the user
+    """
+    checkpoint = start_backfill(user_id, restart=restart, engine=engine)
+    if checkpoint.completed_at is not None:
+        return 0
+
+    user = get_user(user_id, engine=engine)
+    if user.redmine_user_id is None:
+        user.redmine_user_id = redmine.get_user_id(user.authkey)
+        if user.redmine_user_id is None:
+            raise ValueError('Redmine rejected the authorization key of user {}'.format(user_id))
+
+    count = 0
+    chunk = list()
+    for time_entry in _stream_time_entries(redmine, user, checkpoint.spent_on):
+        chunk.append(time_entry)
+        if len(chunk) >= chunk_size:
+            count += _save_backfill_chunk(redmine, user, chunk, engine)
+            chunk = list()
+    if chunk:
+        count += _save_backfill_chunk(redmine, user, chunk, engine)
+
+    complete_backfill(user, checkpoint.started_at, engine=engine)
+    return count
+
+
+def backfill_users_with_redmine(user_ids, redmine=None, engine=None, chunk_size=1000,
+                                restart=False):
+    """Copy the whole history of time entries from Redmine to db for users one by one.
+
+    A failure of the backfill of one user does not stop the backfill of others.
+
+    :param list user_ids:
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param sqlalchemy.engine.Engine engine:
+    :param int chunk_size: Number of time entries which are committed together
+    :param bool restart: Start backfills from the beginning even if they were completed
+    :return: IDs of users whose backfill failed
+    """
+    logger = logging.getLogger(__name__)
+    failed_user_ids = list()
+    for user_id in user_ids:
+        try:
+            count = backfill_user_with_redmine(
+                user_id, redmine=redmine, engine=engine, chunk_size=chunk_size, restart=restart)
+        except Exception as e:
+            logger.error('Backfill of user %s failed: %r', user_id, e)
+            failed_user_ids.append(user_id)
         else:
-            time_entry.hours = r_time_entry.hours
-            time_entry.comments = r_time_entry.comments
-            time_entry.spent_on = r_time_entry.spent_on
-        session.add(time_entry)
+            logger.info('Backfill of user %s added %s time entries', user_id, count)
+    return failed_user_ids
 
-    session.commit()
-    session.close()
 
+def _stream_time_entries(redmine, user, from_date=None):
+    """Yield time entries of the user in Redmine page by page.
 
-def __get_time_entry(time_entries, time_entry_id):
-    for time_entry in time_entries:
-        if time_entry_id == time_entry.id:
-            return time_entry
-    return None
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param User user:
+    :param datetime.date from_date: Optional. Only time entries spent on this date or later
+    """
+    offset = 0
+    while True:
+        time_entries, total_count = redmine.get_time_entry_page(user, offset, from_date)
+        yield from time_entries
+        offset += redmine.page_size
+        if offset >= total_count:
+            return
+
+
+def _save_backfill_chunk(redmine, user, time_entries, engine):
+    time_entries = _unique_time_entries(time_entries)
+    missing_issue_ids = find_missing_issue_ids(time_entries, engine=engine)
+    r_issues = redmine.get_issues(user, missing_issue_ids) if missing_issue_ids else []
+    return save_backfill_chunk(user, time_entries, r_issues, engine=engine)
+
+
+@db_time('start_backfill')
+def start_backfill(user_id, restart=False, engine=None):
+    """Find the checkpoint of the backfill of the user or create it if not exists.
+
+    The checkpoint is detached from the session.
+
+    :param int user_id:
+    :param bool restart: Replace the existing checkpoint with a new one
+    :param sqlalchemy.engine.Engine engine:
+    :rtype: BackfillCheckpoint
+    """
+    with session_scope(engine) as session:
+        query = session.query(BackfillCheckpoint).filter(BackfillCheckpoint.user_id == user_id)
+        checkpoint = query.one_or_none()
+        if checkpoint is not None and restart:
+            session.delete(checkpoint)
+            session.flush()
+            checkpoint = None
+        if checkpoint is None:
+            session.add(BackfillCheckpoint(user_id))
+            session.commit()
+
+        return query.one()
+
+
+@db_time('save_backfill_chunk')
+def save_backfill_chunk(user, time_entries, issues, engine=None):
+    """Save the chunk of the backfill of the user and move its checkpoint.
+
+    The checkpoint is moved to the date of the last time entry of the chunk, so
+    the chunk must be ordered by the date. Only time entries which are not saved
+    in db yet are added to the count of the checkpoint, so time entries which are
+    requested again after a resume are not counted twice.
+
+    :param User user:
+    :param list time_entries: Time entries of the user in Redmine in the order of the date
+    :param list issues: Issues in Redmine which are not saved in db
+    :param sqlalchemy.engine.Engine engine:
+    :return: Number of time entries which were inserted
+    """
+    with session_scope(engine) as session:
+        table = TimeEntry.__table__
+        exists_ids = _exists_ids(
+            session, table, [time_entry.id for time_entry in time_entries])
+        count = len(time_entries) - len(exists_ids)
+        _bulk_upsert(session, Issue.__table__,
+                     [{'id': issue.id, 'name': issue.name} for issue in issues])
+        _bulk_upsert(session, table, [{
+            'id': time_entry.id,
+            'user_id': user.id,
+            'issue_id': time_entry.issue_id,
+            'spent_on': time_entry.spent_on,
+            'hours': time_entry.hours,
+            'comments': time_entry.comments
+        } for time_entry in time_entries], update_columns=('spent_on', 'hours', 'comments'))
+        _refresh_recent_issues(
+            session, user.id, {time_entry.issue_id for time_entry in time_entries})
+
+        table = BackfillCheckpoint.__table__
+        session.execute(table.update().where(table.c.user_id == user.id).values(
+            spent_on=time_entries[-1].spent_on,
+            time_entry_count=table.c.time_entry_count + count))
+
+        session.commit()
+        return count
+
+
+@db_time('complete_backfill')
+def complete_backfill(user, started_at, engine=None):
+    """Mark the backfill of the user as completed.
+
+    The ID user in Redmine is saved to the user and the time of the start of the
+    backfill is saved as the time of the sync unless the user was synced later.
+
+    :param User user:
+    :param datetime.datetime started_at: Time of the start of the backfill
+    :param sqlalchemy.engine.Engine engine:
+    """
+    with session_scope(engine) as session:
+        table = User.__table__
+        session.execute(table.update().where(table.c.id == user.id).values(
+            redmine_user_id=user.redmine_user_id))
+        session.execute(table.update().where(and_(
+            table.c.id == user.id,
+            or_(table.c.synced_at.is_(None), table.c.synced_at < started_at)
+        )).values(synced_at=started_at))
+
+        table = BackfillCheckpoint.__table__
+        session.execute(table.update().where(table.c.user_id == user.id).values(
+            completed_at=datetime.utcnow()))
+
+        session.commit()
+
+
+def time_entry_filters(user, spent_on=None, window=None):
+    """Build filters of time entries in Redmine which need to be copied for the user.
 
+    :param User user:
+    :param datetime.date spent_on: Optional. Copy only time entries spent on this date
+    :param datetime.timedelta window: Optional. Sliding window of the incremental sync
+    :return: List of keyword arguments of :meth:`RedmineWrapper.get_all_time_entry`
+    """
+    if spent_on is None and window is not None and user.synced_at is not None:
+        return [{'from_date': date.today() - window},
+                {'updated_since': user.synced_at.date()}]
+    return [{'spent_on': spent_on}]
+
+
+@db_time('find_missing_issue_ids')
+def find_missing_issue_ids(time_entries, engine=None):
+    """Find IDs of issues of the time entries which are not saved in db.
+
+    :param list time_entries:
+    :param sqlalchemy.engine.Engine engine:
+    :rtype: set
+    """
+    issue_ids = list({time_entry.issue_id for time_entry in time_entries})
+    exists_ids = set()
+    with session_scope(engine) as session:
+        for i in range(0, len(issue_ids), _BULK_CHUNK_SIZE):
+            s = select([Issue.id]).where(Issue.id.in_(issue_ids[i:i + _BULK_CHUNK_SIZE]))
+            exists_ids.update(r[0] for r in session.execute(s))
+    return set(issue_ids) - exists_ids
+
+
+@db_time('save_synced_time_entries')
+def save_synced_time_entries(user, time_entries, issues, synced_at=None, engine=None):
+    """Save time entries and issues received from Redmine for the user.
+
+    Only new and changed time entries are written, they are written as rows
+    without building objects of the session. The ID user in Redmine is saved
+    to the user, and the time of the sync too if it is set and Redmine accepted
+    the authorization key of the user.
+
+    :param User user:
+    :param list time_entries: Records of time entries of the user in Redmine
+    :param list issues: Issues in Redmine which are not saved in db
+    :param datetime.datetime synced_at: Optional. Time of the start of the full sync
+    :param sqlalchemy.engine.Engine engine:
+    """
+    with session_scope(engine) as session:
+        _bulk_upsert(session, Issue.__table__,
+                     [{'id': issue.id, 'name': issue.name} for issue in issues])
+
+        s = select([TimeEntry.id, TimeEntry.spent_on, TimeEntry.hours, TimeEntry.comments])
+        s = s.where(TimeEntry.user_id == user.id)
+        local_time_entries = {row[0]: tuple(row[1:]) for row in session.execute(s)}
+
+        changed_time_entries = [{
+            'id': time_entry.id,
+            'user_id': user.id,
+            'issue_id': time_entry.issue_id,
+            'spent_on': time_entry.spent_on,
+            'hours': time_entry.hours,
+            'comments': time_entry.comments
+        } for time_entry in time_entries if local_time_entries.get(time_entry.id) != (
+            time_entry.spent_on, time_entry.hours, time_entry.comments)]
+        _bulk_upsert(session, TimeEntry.__table__, changed_time_entries,
+                     update_columns=('spent_on', 'hours', 'comments'))
+        _refresh_recent_issues(
+            session, user.id, {time_entry['issue_id'] for time_entry in changed_time_entries})
+
+        values = {'redmine_user_id': user.redmine_user_id}
+        if synced_at is not None and user.redmine_user_id is not None:
+            values['synced_at'] = synced_at
+        session.execute(User.__table__.update().where(User.id == user.id).values(values))
+
+        session.commit()
+
+
+def _fetch_time_entries(redmine, user, spent_on=None, window=None):
+    """Get time entries of the user which need to be copied from Redmine.
+
+    When Redmine rejects the authorization key the ID user in Redmine is
+    forgotten, so it is resolved again by the next sync, and the time entries
+    received before are returned.
+
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param User user:
+    :param datetime.date spent_on: Optional. Copy only time entries spent on this date
+    :param datetime.timedelta window: Optional. Sliding window of the incremental sync
+    :rtype: list
+    """
+    time_entries = list()
+    try:
+        for filters in time_entry_filters(user, spent_on, window):
+            time_entries.extend(redmine.iter_time_entries(user, **filters))
+    except AuthError:
+        user.redmine_user_id = None
+    return _unique_time_entries(time_entries)
+
+
+def _unique_time_entries(time_entries):
+    return list({time_entry.id: time_entry for time_entry in time_entries}.values())
 
+
+@db_time('get_actual_issues')
 def get_actual_issues(user_id, engine=None):
     """Get actual issues.
 
@@ -102,52 +524,330 @@ def get_actual_issues(user_id, engine=None):
     :param sqlalchemy.engine.Engine engine:
     :rtype: list
     """
-    s = select([TimeEntry.issue_id,
-                func.max(TimeEntry.id).label('max_te'),
-                func.count().label('count_te')])
-    s = s.where(TimeEntry.user_id == user_id)
-    s = s.group_by(TimeEntry.issue_id)
-    s = s.order_by(desc('max_te'), desc('count_te'))
+    s = select([UserRecentIssue.issue_id, UserRecentIssue.issue_name])
+    s = s.where(UserRecentIssue.user_id == user_id)
+    s = s.order_by(desc(UserRecentIssue.last_time_entry_id),
+                   desc(UserRecentIssue.time_entry_count))
     s = s.limit(10)
 
-    issue_ids = [row[0] for row in engine.execute(s)]
-
-    session = _create_session(engine=engine)
-    issues = session.query(Issue).filter(Issue.id.in_(issue_ids)).all()
-    session.close()
+    with session_scope(engine) as session:
+        issues = [Issue(row[0], row[1]) for row in session.execute(s)]
 
     return issues
 
 
-def save_time_entry(state, redmine=None, engine=None):
-    """Save time entry to Redmine and db.
+@db_time('queue_time_entry')
+def queue_time_entry(state, chat_id=None, engine=None):
+    """Save time entry to the outbox in db to save it to Redmine later.
 
     :param dict state:
+    :param int chat_id: Optional. ID chat to notify about a failure
+    :param sqlalchemy.engine.Engine engine:
+    :return: ID time entry in the outbox
+    """
+    with session_scope(engine) as session:
+        outbox_time_entry = OutboxTimeEntry(
+            user_id=state['user_id'],
+            issue_id=state['issue_id'],
+            spent_on=state['spent_on'],
+            hours=state['hours'],
+            comments=state['comments'],
+            chat_id=chat_id)
+        session.add(outbox_time_entry)
+        session.commit()
+        return outbox_time_entry.id
+
+
+@profiled('flush_time_entry_outbox')
+def flush_time_entry_outbox(redmine=None, engine=None, max_attempts=8,
+                            backoff=timedelta(seconds=30), max_backoff=timedelta(hours=1),
+                            limit=100, lease=timedelta(minutes=10)):
+    """Save time entries from the outbox to Redmine and db.
+
+    Time entries are claimed in a short transaction and saved to Redmine with
+    no session open. A time entry which Redmine accepted is moved from the
+    outbox to the time entries with ID from Redmine in a second transaction.
+    If it can not be written to db it stays in the outbox marked with that ID
+    and only the write is repeated later, so it is never saved in Redmine twice
+    unless the process stops before the result of the request is committed.
+    On an error of the connection the attempt is repeated later with
+    exponential backoff. The time entry is dropped from the outbox when Redmine
+    rejects it or all attempts failed.
+
     :param tracktime.redmine.RedmineWrapper redmine:
     :param sqlalchemy.engine.Engine engine:
-    :rtype: bool
+    :param int max_attempts: Maximum number of attempts to save a time entry
+    :param datetime.timedelta backoff: Delay after the first failed attempt
+    :param datetime.timedelta max_backoff: Maximum delay between attempts
+    :param int limit: Maximum number of time entries to save
+    :param datetime.timedelta lease: Period for which claimed time entries are not claimed
+        again, they are attempted again after it if the process stopped
+    :return: List of dictionaries with information about dropped time entries
+    """
+    failed = list()
+    for outbox_time_entry in claim_outbox_time_entries(limit, lease, engine=engine):
+        status = save_outbox_time_entry(outbox_time_entry, redmine=redmine, engine=engine,
+                                        max_attempts=max_attempts, backoff=backoff,
+                                        max_backoff=max_backoff)
+        if status is not None:
+            failed.append(status)
+    return failed
+
+
+@db_time('claim_outbox_time_entries')
+def claim_outbox_time_entries(limit=100, lease=timedelta(minutes=10), engine=None):
+    """Claim time entries of the outbox whose attempt is due.
+
+    The next attempt of claimed time entries is moved by the lease, so they are
+    not claimed again while they are saved. An attempt is counted for every
+    claimed time entry which Redmine did not accept yet.
+
+    :param int limit: Maximum number of time entries to claim
+    :param datetime.timedelta lease: Period for which claimed time entries are not claimed
+    :param sqlalchemy.engine.Engine engine:
+    :return: List of dictionaries with ID time entry in the outbox, the authorization key
+        of its user, the number of attempts, ID time entry in Redmine if it was accepted
+        and the information about the time entry in ``status``
+    """
+    now = datetime.utcnow()
+    with session_scope(engine) as session:
+        q = session.query(OutboxTimeEntry).filter(OutboxTimeEntry.next_attempt_at <= now)
+        q = q.order_by(OutboxTimeEntry.id).limit(limit).with_for_update(skip_locked=True)
+        claimed = list()
+        for outbox_time_entry in q.all():
+            outbox_time_entry.next_attempt_at = now + lease
+            if outbox_time_entry.time_entry_id is None:
+                outbox_time_entry.attempts += 1
+            claimed.append({
+                'id': outbox_time_entry.id,
+                'authkey': outbox_time_entry.user.authkey,
+                'attempts': outbox_time_entry.attempts,
+                'time_entry_id': outbox_time_entry.time_entry_id,
+                'status': _outbox_status(outbox_time_entry)
+            })
+        session.commit()
+    return claimed
+
+
+def save_outbox_time_entry(outbox_time_entry, redmine=None, engine=None, max_attempts=8,
+                           backoff=timedelta(seconds=30), max_backoff=timedelta(hours=1)):
+    """Save the claimed time entry of the outbox to Redmine and db.
+
+    No session is open while the request to Redmine is made. A time entry which
+    Redmine already accepted is only written to db.
+
+    :param dict outbox_time_entry: The time entry returned by
+        :func:`claim_outbox_time_entries`
+    :param tracktime.redmine.RedmineWrapper redmine:
+    :param sqlalchemy.engine.Engine engine:
+    :param int max_attempts: Maximum number of attempts to save a time entry
+    :param datetime.timedelta backoff: Delay after the first failed attempt
+    :param datetime.timedelta max_backoff: Maximum delay between attempts
+    :return: Dictionary with information about the time entry if it is dropped or None
+    """
+    logger = logging.getLogger(__name__)
+    status = outbox_time_entry['status']
+    time_entry_id = outbox_time_entry['time_entry_id']
+    if time_entry_id is None:
+        time_entry = TimeEntry(
+            user=User(status['user_id'], outbox_time_entry['authkey']),
+            issue_id=status['issue_id'],
+            spent_on=status['spent_on'],
+            hours=status['hours'],
+            comments=status['comments'])
+        try:
+            time_entry_id = redmine.save_time_entry(time_entry)
+        except Exception as e:
+            logger.warning('Save of outbox time entry #%s to Redmine failed: %r',
+                           outbox_time_entry['id'], e)
+            attempts = outbox_time_entry['attempts']
+            if attempts < max_attempts:
+                delay = min(backoff * 2 ** (attempts - 1), max_backoff)
+                retry_outbox_time_entry(outbox_time_entry['id'], delay, repr(e), engine=engine)
+                return None
+            time_entry_id = None
+
+        if time_entry_id is None:
+            drop_outbox_time_entry(outbox_time_entry['id'], engine=engine)
+            return status
+
+    try:
+        move_outbox_time_entry(outbox_time_entry['id'], time_entry_id, engine=engine)
+    except Exception as e:
+        logger.error('Save of outbox time entry #%s to db failed, it is kept as #%s: %r',
+                     outbox_time_entry['id'], time_entry_id, e)
+        retry_outbox_time_entry(outbox_time_entry['id'], backoff, repr(e),
+                                time_entry_id=time_entry_id, engine=engine)
+    return None
+
+
+@db_time('move_outbox_time_entry')
+def move_outbox_time_entry(outbox_time_entry_id, time_entry_id, engine=None):
+    """Move the time entry which Redmine accepted from the outbox to the time entries.
+
+    The time entry may be already copied by a sync, so it is upserted.
+
+    :param int outbox_time_entry_id: ID time entry in the outbox
+    :param int time_entry_id: ID time entry in Redmine
+    :param sqlalchemy.engine.Engine engine:
+    """
+    with session_scope(engine) as session:
+        outbox_time_entry = session.query(OutboxTimeEntry).filter(
+            OutboxTimeEntry.id == outbox_time_entry_id).one()
+        _bulk_upsert(session, TimeEntry.__table__, [{
+            'id': time_entry_id,
+            'user_id': outbox_time_entry.user_id,
+            'issue_id': outbox_time_entry.issue_id,
+            'spent_on': outbox_time_entry.spent_on,
+            'hours': outbox_time_entry.hours,
+            'comments': outbox_time_entry.comments
+        }], update_columns=('spent_on', 'hours', 'comments'))
+        _refresh_recent_issues(session, outbox_time_entry.user_id, [outbox_time_entry.issue_id])
+        session.delete(outbox_time_entry)
+        session.commit()
+
+
+@db_time('retry_outbox_time_entry')
+def retry_outbox_time_entry(outbox_time_entry_id, delay, error, time_entry_id=None,
+                            engine=None):
+    """Schedule the next attempt to save the time entry of the outbox.
+
+    :param int outbox_time_entry_id: ID time entry in the outbox
+    :param datetime.timedelta delay: Delay of the next attempt
+    :param str error: Description of the error of the attempt
+    :param int time_entry_id: Optional. ID time entry if Redmine accepted it
+    :param sqlalchemy.engine.Engine engine:
+    """
+    values = {'next_attempt_at': datetime.utcnow() + delay, 'last_error': error}
+    if time_entry_id is not None:
+        values['time_entry_id'] = time_entry_id
+    table = OutboxTimeEntry.__table__
+    with session_scope(engine) as session:
+        session.execute(table.update().where(table.c.id == outbox_time_entry_id).values(values))
+        session.commit()
+
+
+@db_time('drop_outbox_time_entry')
+def drop_outbox_time_entry(outbox_time_entry_id, engine=None):
+    """Remove the time entry from the outbox.
+
+    :param int outbox_time_entry_id: ID time entry in the outbox
+    :param sqlalchemy.engine.Engine engine:
+    """
+    table = OutboxTimeEntry.__table__
+    with session_scope(engine) as session:
+        session.execute(table.delete().where(table.c.id == outbox_time_entry_id))
+        session.commit()
+
+
+def _outbox_status(outbox_time_entry):
+    issue = outbox_time_entry.issue
+    return {
+        'chat_id': outbox_time_entry.chat_id,
+        'user_id': outbox_time_entry.user_id,
+        'issue_id': outbox_time_entry.issue_id,
+        'issue_name': issue.name if issue is not None else '#{}'.format(
+            outbox_time_entry.issue_id),
+        'spent_on': outbox_time_entry.spent_on,
+        'hours': outbox_time_entry.hours,
+        'comments': outbox_time_entry.comments
+    }
+
+
+def _refresh_recent_issues(session, user_id, issue_ids):
+    """Recalculate rows of the user in ``user_recent_issue`` for the issues.
+
+    :param sqlalchemy.orm.Session session:
+    :param int user_id:
+    :param issue_ids: IDs of issues in which time entries of the user were changed
+    """
+    table = UserRecentIssue.__table__
+    issue_ids = list(issue_ids)
+    for i in range(0, len(issue_ids), _BULK_CHUNK_SIZE):
+        chunk = issue_ids[i:i + _BULK_CHUNK_SIZE]
+        session.execute(table.delete().where(
+            and_(table.c.user_id == user_id, table.c.issue_id.in_(chunk))))
+        session.execute(table.insert().from_select(
+            [c.name for c in table.columns], select_recent_issues(user_id, chunk)))
+
+
+def _bulk_upsert(session, table, rows, update_columns=()):
+    """Insert rows or update columns of rows which already exist by primary key ``id``.
+
+    SQLite and PostgreSQL use a single ``INSERT ... ON CONFLICT`` statement (``INSERT OR
+    REPLACE`` on SQLite when SQLAlchemy has no upsert for it), other databases use
+    one select of the existing ids and bulk insert and update statements.
+
+    :param sqlalchemy.orm.Session session:
+    :param sqlalchemy.Table table:
+    :param list rows: Dictionaries with values of all columns
+    :param tuple update_columns: Columns which are updated when the row already exists
+    """
+    if not rows:
+        return
+
+    dialect_name = session.bind.dialect.name
+    insert = _dialect_insert(dialect_name)
+    if insert is not None:
+        stmt = insert(table)
+        if update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[table.c.id],
+                set_={column: getattr(stmt.excluded, column) for column in update_columns})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[table.c.id])
+        session.execute(stmt, rows)
+        return
+
+    if dialect_name == 'sqlite':
+        stmt = table.insert().prefix_with('OR REPLACE' if update_columns else 'OR IGNORE')
+        session.execute(stmt, rows)
+        return
+
+    exists_ids = _exists_ids(session, table, [row['id'] for row in rows])
+    new_rows = [row for row in rows if row['id'] not in exists_ids]
+    if new_rows:
+        session.execute(table.insert(), new_rows)
+
+    updated_rows = [
+        dict({column: row[column] for column in update_columns}, _id=row['id'])
+        for row in rows if row['id'] in exists_ids
+    ]
+    if update_columns and updated_rows:
+        stmt = table.update().where(table.c.id == bindparam('_id'))
+        stmt = stmt.values({column: bindparam(column) for column in update_columns})
+        session.execute(stmt, updated_rows)
+
+
+def _exists_ids(session, table, ids):
+    """Return the set of IDs which are saved in the table.
+
+    :param sqlalchemy.orm.Session session:
+    :param sqlalchemy.Table table: Table with primary key ``id``
+    :param list ids:
+    :rtype: set
+    """
+    exists_ids = set()
+    for i in range(0, len(ids), _BULK_CHUNK_SIZE):
+        s = select([table.c.id]).where(table.c.id.in_(ids[i:i + _BULK_CHUNK_SIZE]))
+        exists_ids.update(r[0] for r in session.execute(s))
+    return exists_ids
+
+
+def _dialect_insert(dialect_name):
+    """Return the insert construct with ``ON CONFLICT`` support for the dialect or None."""
+    dialect = {'postgresql': postgresql, 'sqlite': sqlite}.get(dialect_name)
+    return getattr(dialect, 'insert', None)
+
+
+def _session_registry(engine) -> scoped_session:
+    """Return the thread-local session registry bound to the engine.
+
+    The registry is created once per engine and shared by all handlers.
     """
-    session = _create_session(engine=engine)
-    user = session.query(User).filter(User.id == state['user_id']).one()
-    time_entry = TimeEntry(
-        user=user,
-        issue_id=state['issue_id'],
-        spent_on=state['spent_on'],
-        hours=state['hours'],
-        comments=state['comments'])
-
-    time_entry.id = redmine.save_time_entry(time_entry)
-    if time_entry.id is None:
-        session.close()
-        return False
-
-    session.add(time_entry)
-    session.commit()
-    session.close()
-    return True
-
-
-def _create_session(engine) -> Session:
-    Session_ = sessionmaker()
-    Session_.configure(bind=engine)
-    return Session_()
+    with _session_registries_lock:
+        registry = _session_registries.get(engine)
+        if registry is None:
+            registry = scoped_session(sessionmaker(bind=engine))
+            _session_registries[engine] = registry
+        return registry
@@ -1,13 +1,118 @@
 """The module provides the message formatting and building."""
 
+import logging
+import threading
+from collections import OrderedDict
 from datetime import date, timedelta
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+from tracktime.dispatcher import default_dispatcher
+from tracktime.scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
 FINISH_ENTRY_TIME = 'Сейчас я знаю:\n' \
                     '{}\n' \
                     'Осталось подтвердить изменения или изменить комментарий.' \
                     ' А также можешь отказатся от помощи, щелкнув на /cancel'
+SET_SPENT_ON_ENTRY_TIME = 'Сейчас я знаю:\n' \
+                          '{}\n' \
+                          'Теперь нужно указать смещение на какой день нужно затрекать ' \
+                          'время. Но ты можешь отказатся от помощи, щелкнув на /cancel'
+SET_ISSUE_ENTRY_TIME = 'Сейчас я знаю:\n' \
+                       '{}\n' \
+                       'Теперь нужно указать в какую задачу нужно затрекать время. ' \
+                       'Но ты можешь отказатся от помощи, щелкнув на /cancel'
+SET_COMMENT_ENTRY_TIME = 'Сейчас я знаю:\n' \
+                         '{}\n' \
+                         'Теперь нужно написать комментарий или ты можешь отказатся от ' \
+                         'помощи, щелкнув на /cancel'
+SET_HOURS_ENTRY_TIME = 'Сейчас я знаю:\n' \
+                       '{}\n' \
+                       'Теперь нужно добавить время, сколько хочется затрекать время. ' \
+                       'Но ты можешь отказатся от помощи, щелкнув на /cancel'
+
+
+class _RenderCache:
+    """Cache of rendered keyboards and texts.
+
+    Keyboards are kept serialized to JSON, so they are not serialized again on
+    every request to Telegram. Entries which depend on the current date are
+    dropped at local midnight. Issue keyboards are kept per user and rendered
+    again when the issues of the user change.
+    """
+
+    def __init__(self, max_users=1024):
+        """Initialize cache.
+
+        :param int max_users: Maximum number of users whose issue keyboards are kept
+        """
+        self.max_users = max_users
+        self._static = {}
+        self._daily = {}
+        self._day = None
+        self._issues = OrderedDict()
+        self._lock = threading.Lock()
+
+    def static(self, key, render):
+        """Return the rendered value which never changes.
+
+        :param key: Hashable key of the value
+        :param callable render: Function without arguments which renders the value
+        """
+        value = self._static.get(key)
+        if value is None:
+            value = self._static.setdefault(key, render())
+        return value
+
+    def daily(self, key, render):
+        """Return the rendered value which is valid until local midnight.
+
+        :param key: Hashable key of the value
+        :param callable render: Function without arguments which renders the value
+        """
+        today = date.today()
+        with self._lock:
+            if self._day != today:
+                self._day = today
+                self._daily = {}
+            daily = self._daily
+        value = daily.get(key)
+        if value is None:
+            value = daily.setdefault(key, render())
+        return value
+
+    def issues(self, user_id, issues, render):
+        """Return the rendered issue keyboard of the user.
+
+        :param int user_id:
+        :param list issues: Actual issues of the user
+        :param callable render: Function of issues which renders the keyboard
+        """
+        signature = tuple((issue.id, issue.name) for issue in issues)
+        with self._lock:
+            entry = self._issues.get(user_id)
+            if entry is not None and entry[0] == signature:
+                self._issues.move_to_end(user_id)
+                return entry[1]
+
+        value = render(issues)
+        with self._lock:
+            self._issues[user_id] = (signature, value)
+            self._issues.move_to_end(user_id)
+            while len(self._issues) > self.max_users:
+                self._issues.popitem(last=False)
+        return value
+
+    def clear(self):
+        """Drop all rendered values."""
+        with self._lock:
+            self._static = {}
+            self._daily = {}
+            self._day = None
+            self._issues.clear()
+
+
+_render_cache = _RenderCache()
 
 
 def reply_welcome(message):
@@ -16,8 +121,8 @@ def reply_welcome(message):
     :param telegram.Message message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text('Для помощи обратитесь к команде /help, чтобы затрекать время '
-                              'выберите команду /track')
+    return _reply_text(message, 'Для помощи обратитесь к команде /help, чтобы затрекать время '
+                                'выберите команду /track')
 
 
 def reply_help(message):
@@ -26,7 +131,8 @@ def reply_help(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text(
+    return _reply_text(
+        message,
         'Команда /start позволит зарегестрироватся или сменить ключ от '
         'редмайна, а с помощью команды /track можно затрекать время, выполнив '
         'пошаговые инструкции')
@@ -38,7 +144,8 @@ def reply_start_redmine_settings(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text('Привет! Чтобы можно было воспользоватся ботом нужно его настроить')
+    return _reply_text(
+        message, 'Привет! Чтобы можно было воспользоватся ботом нужно его настроить')
 
 
 def reply_set_redmine_key(message):
@@ -47,7 +154,8 @@ def reply_set_redmine_key(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text(
+    return _reply_text(
+        message,
         'Пожалуйста введите ключ от redmine, который можно получить в профиле')
 
 
@@ -57,8 +165,8 @@ def reply_invalid_redmine_key(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text('Меня не обмануть, введи правильный ключ. Для повторного ввода '
-                              'используй команду /start')
+    return _reply_text(message, 'Меня не обмануть, введи правильный ключ. Для повторного ввода '
+                                'используй команду /start')
 
 
 def reply_save_redmine_settings(message):
@@ -67,7 +175,7 @@ def reply_save_redmine_settings(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text('Настройки подключения к redmine успешно сохранены')
+    return _reply_text(message, 'Настройки подключения к redmine успешно сохранены')
 
 
 def reply_start_time_entry(message):
@@ -76,7 +184,7 @@ def reply_start_time_entry(message):
     :param telegram.Message  message: A message to which you must respond
     :rtype: telegram.Message Response message
     """
-    return message.reply_text('Бот выручит тебя, только укажи куда мне затрекать время')
+    return _reply_text(message, 'Бот выручит тебя, только укажи куда мне затрекать время')
 
 
 def reply_set_spent_on_time_entry(message, status):
@@ -86,13 +194,9 @@ def reply_set_spent_on_time_entry(message, status):
     :param dict status: Data dictionary which contains time entry information
     :rtype: telegram.Message Response message
     """
-    text = 'Сейчас я знаю:\n' \
-           '{}\n' \
-           'Теперь нужно указать смещение на какой день нужно затрекать ' \
-           'время. Но ты можешь отказатся от помощи, щелкнув на /cancel'
-    text = text.format(_print_status_entry_time(status))
-    reply_markup = _create_last_7_day_keyboard()
-    return message.reply_text(text, reply_markup=reply_markup)
+    text = SET_SPENT_ON_ENTRY_TIME.format(_print_status_entry_time(status))
+    reply_markup = _render_cache.daily('last_7_day_keyboard', _create_last_7_day_keyboard)
+    return _reply_text(message, text, reply_markup=reply_markup)
 
 
 def _print_status_entry_time(status):
@@ -100,7 +204,9 @@ def _print_status_entry_time(status):
     if 'issue_name' in status:
         message.append('Задача - {}'.format(status['issue_name']))
     if 'spent_on' in status:
-        message.append('Дата - {}'.format(_russian_date(status['spent_on'])))
+        spent_on = status['spent_on']
+        message.append('Дата - {}'.format(
+            _render_cache.daily(('russian_date', spent_on), lambda: _russian_date(spent_on))))
     if 'hours' in status:
         message.append('Часов - {}'.format(status['hours']))
     if 'comments' in status:
@@ -117,32 +223,33 @@ def _create_last_7_day_keyboard():
         InlineKeyboardButton(_russian_date(d), callback_data=str(d))
         for d in _date_from_today(range(0, -8, -1))
     ]
-    return InlineKeyboardMarkup(_build_menu(buttons, n_cols=2))
+    return InlineKeyboardMarkup(_build_menu(buttons, n_cols=2)).to_json()
 
 
-def edit_set_issue_time_entry(message, status, issues):
+def edit_set_issue_time_entry(message, status, issues, user_id=None):
     """
     Edit the current message on response with setting task of the time entry.
 
     :param telegram.Message message: A message to which you need to edit
     :param dict status: Data dictionary which contains time entry information
     :param list issues:
+    :param int user_id: Optional. The keyboard is cached for the user while
+        the issues are the same
     :rtype: telegram.Message message: Response message
     """
-    text = 'Сейчас я знаю:\n' \
-           '{}\n' \
-           'Теперь нужно указать в какую задачу нужно затрекать время. ' \
-           'Но ты можешь отказатся от помощи, щелкнув на /cancel'
-    text = text.format(_print_status_entry_time(status))
-    reply_markup = _create_issue_keyboard(issues)
-    return message.bot.edit_message_text(
-        text, chat_id=message.chat.id, message_id=message.message_id, reply_markup=reply_markup)
+    text = SET_ISSUE_ENTRY_TIME.format(_print_status_entry_time(status))
+    if user_id is None:
+        reply_markup = _create_issue_keyboard(issues)
+    else:
+        reply_markup = _render_cache.issues(user_id, issues, _create_issue_keyboard)
+    return _edit_message_text(message, text, reply_markup=reply_markup)
 
 
 def _create_issue_keyboard(issues):
-    issues.reverse()
-    buttons = [InlineKeyboardButton(issue.name, callback_data=issue.id) for issue in issues]
-    return InlineKeyboardMarkup(_build_menu(buttons, n_cols=1))
+    buttons = [
+        InlineKeyboardButton(issue.name, callback_data=issue.id) for issue in reversed(issues)
+    ]
+    return InlineKeyboardMarkup(_build_menu(buttons, n_cols=1)).to_json()
 
 
 def edit_set_comment_time_entry(message, status):
@@ -155,13 +262,8 @@ def edit_set_comment_time_entry(message, status):
     :param dict status: Data dictionary which contains time entry information
     :rtype: telegram.Message message: Edited message
     """
-    text = 'Сейчас я знаю:\n' \
-           '{}\n' \
-           'Теперь нужно написать комментарий или ты можешь отказатся от ' \
-           'помощи, щелкнув на /cancel'
-    text = text.format(_print_status_entry_time(status))
-    return message.bot.edit_message_text(
-        text, chat_id=message.chat.id, message_id=message.message_id)
+    text = SET_COMMENT_ENTRY_TIME.format(_print_status_entry_time(status))
+    return _edit_message_text(message, text)
 
 
 def delete_message(chat, message_id):
@@ -171,7 +273,8 @@ def delete_message(chat, message_id):
     :param telegram.Chat chat: Chat, in which you want to delete  the message
     :param int message_id: The message id
     """
-    chat.bot.delete_message(chat_id=chat.id, message_id=message_id)
+    _send(chat.id, lambda: chat.bot.delete_message(chat_id=chat.id, message_id=message_id),
+          paced=False)
 
 
 def reply_set_hours_time_entry(message, status):
@@ -181,13 +284,9 @@ def reply_set_hours_time_entry(message, status):
     :param dict status: Data dictionary which contains time entry information
     :rtype: telegram.Message message: Response message
     """
-    text = 'Сейчас я знаю:\n' \
-           '{}\n' \
-           'Теперь нужно добавить время, сколько хочется затрекать время. ' \
-           'Но ты можешь отказатся от помощи, щелкнув на /cancel'
-    text = text.format(_print_status_entry_time(status))
-    reply_markup = _create_hours_keyboard(has_done_button=False)
-    return message.reply_text(text, reply_markup=reply_markup)
+    text = SET_HOURS_ENTRY_TIME.format(_print_status_entry_time(status))
+    reply_markup = _hours_keyboard(has_done_button=False)
+    return _reply_text(message, text, reply_markup=reply_markup)
 
 
 def _create_hours_keyboard(has_done_button=False):
@@ -202,7 +301,13 @@ def _create_hours_keyboard(has_done_button=False):
     else:
         buttons = _build_menu(buttons, n_cols=4)
 
-    return InlineKeyboardMarkup(buttons)
+    return InlineKeyboardMarkup(buttons).to_json()
+
+
+def _hours_keyboard(has_done_button):
+    return _render_cache.static(
+        ('hours_keyboard', has_done_button),
+        lambda: _create_hours_keyboard(has_done_button=has_done_button))
 
 
 def edit_set_hours_time_entry(message, status, has_done_button=False):
@@ -216,14 +321,9 @@ def edit_set_hours_time_entry(message, status, has_done_button=False):
 
     :rtype: telegram.Message message: Edited message
     """
-    text = 'Сейчас я знаю:\n' \
-           '{}\n' \
-           'Теперь нужно добавить время, сколько хочется затрекать время. ' \
-           'Но ты можешь отказатся от помощи, щелкнув на /cancel'
-    text = text.format(_print_status_entry_time(status))
-    reply_markup = _create_hours_keyboard(has_done_button=has_done_button)
-    return message.bot.edit_message_text(
-        text, chat_id=message.chat.id, message_id=message.message_id, reply_markup=reply_markup)
+    text = SET_HOURS_ENTRY_TIME.format(_print_status_entry_time(status))
+    reply_markup = _hours_keyboard(has_done_button=has_done_button)
+    return _edit_message_text(message, text, reply_markup=reply_markup)
 
 
 def edit_save_time_entry(message, status):
@@ -235,8 +335,25 @@ def edit_save_time_entry(message, status):
     """
     text = 'Бот выручит прямо сейчас:\n{}'
     text = text.format(_print_status_entry_time(status))
-    return message.bot.edit_message_text(
-        text, chat_id=message.chat.id, message_id=message.message_id)
+    return _edit_message_text(message, text)
+
+
+def send_failed_time_entry(bot, chat_id, status):
+    """Send the message that the time entry was not saved in Redmine.
+
+    :param telegram.Bot bot:
+    :param int chat_id: Chat to which you need to send the message
+    :param dict status: Data dictionary which contains time entry information
+    :return: Future of the sent message, the message is paced as a notification
+        and the caller does not wait for it
+    :rtype: concurrent.futures.Future
+    """
+    text = 'Редмайн не принял время, попробуй затрекать его заново через /track:\n{}'
+    text = text.format(_print_status_entry_time(status))
+    future = default_dispatcher().submit(
+        chat_id, lambda: bot.send_message(chat_id=chat_id, text=text), PRIORITY_BACKGROUND)
+    future.add_done_callback(_log_send_error)
+    return future
 
 
 def reply_cancel_time_entry(message):
@@ -245,7 +362,33 @@ def reply_cancel_time_entry(message):
     :param telegram.Message message: A message to which you must respond
     :rtype: telegram.Message message: Response message
     """
-    return message.reply_text('Бот пытался помочь, но не смог. Попробуй в следующий раз')
+    return _reply_text(message, 'Бот пытался помочь, но не смог. Попробуй в следующий раз')
+
+
+def _reply_text(message, text, **kwargs):
+    return _send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+
+def _edit_message_text(message, text, **kwargs):
+    return _send(message.chat_id, lambda: message.bot.edit_message_text(
+        text, chat_id=message.chat_id, message_id=message.message_id, **kwargs), paced=False)
+
+
+def _send(chat_id, request, priority=PRIORITY_INTERACTIVE, paced=True):
+    """Send the request to Telegram through the outbound dispatcher.
+
+    :param int chat_id:
+    :param callable request: Function without arguments which calls the Bot API
+    :param int priority:
+    :param bool paced: The request sends a new message to the chat
+    :return: The result of the request
+    """
+    return default_dispatcher().send(chat_id, request, priority, paced)
+
+
+def _log_send_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.getLogger(__name__).error('Send of a notification failed: %r', future.exception())
 
 
 def _build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
@@ -0,0 +1,451 @@
+"""This module contains the metrics of the application and their HTTP endpoint.
+
+Metrics are kept in memory and rendered in the Prometheus text format on
+request. Recording a value takes a lock and a few arithmetic operations, values
+which are cheap to read at any time, like the depth of queues, are computed
+only when the metrics are scraped.
+"""
+
+import abc
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    """Collection of metrics which are rendered together."""
+
+    def __init__(self):
+        """Initialize registry."""
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add the metric to the registry.
+
+        :param metric: :class:`Counter`, :class:`Gauge` or :class:`Histogram`
+        :return: The metric
+        """
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render all metrics in the Prometheus text format.
+
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+class _Metric(abc.ABC):
+    type = None
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        """Initialize metric.
+
+        :param str name: Name of the metric
+        :param str help: Description of the metric
+        :param labelnames: Names of labels of the metric
+        :param Registry registry: Optional. Registry of the metric. Default is :data:`REGISTRY`
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues):
+        """Return the metric with the values of labels.
+
+        :param labelvalues: Values of labels in the order of ``labelnames``
+        """
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError('Expected labels {}'.format(self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._child())
+        return child
+
+    def render(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        lines = []
+        for labelvalues, child in children:
+            labels = list(zip(self.labelnames, labelvalues))
+            lines.extend(child.render(self.name, labels))
+        return lines
+
+    @abc.abstractmethod
+    def _child(self):
+        """Return the value of one set of labels."""
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def render(self, name, labels):
+        return ['{}{} {}'.format(name, _format_labels(labels), _format_value(self.value))]
+
+
+class Counter(_Metric):
+    """Metric which only grows, for example the number of errors."""
+
+    type = 'counter'
+
+    def inc(self, amount=1):
+        """Increase the counter without labels."""
+        self.labels().inc(amount)
+
+    def _child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """Metric which goes up and down, for example the depth of a queue."""
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        """Initialize metric.
+
+        :param str name: Name of the metric
+        :param str help: Description of the metric
+        :param labelnames: Names of labels of the metric
+        :param Registry registry: Optional. Registry of the metric. Default is :data:`REGISTRY`
+        """
+        super().__init__(name, help, labelnames, registry)
+        self._function = None
+
+    def set_function(self, function):
+        """Compute the value of the gauge without labels by the function when it is rendered.
+
+        :param callable function: Function without arguments which returns a number
+        """
+        self._function = function
+
+    def inc(self, amount=1):
+        """Increase the gauge without labels."""
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        """Decrease the gauge without labels."""
+        self.labels().dec(amount)
+
+    def set(self, value):
+        """Set the value of the gauge without labels."""
+        self.labels().set(value)
+
+    def render(self):
+        """Render the samples of the gauge, the function is called when it is set."""
+        if self._function is not None:
+            return ['{} {}'.format(self.name, _format_value(self._function()))]
+        return super().render()
+
+    def _child(self):
+        return _Value()
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def render(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'), ), counts):
+            count += bucket_count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + [('le', _format_value(bound))]), count))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), _format_value(total)))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+        return lines
+
+
+class Histogram(_Metric):
+    """Metric which counts observed values in buckets, for example latencies."""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        """Initialize metric.
+
+        :param str name: Name of the metric
+        :param str help: Description of the metric
+        :param labelnames: Names of labels of the metric
+        :param buckets: Upper bounds of buckets in ascending order
+        :param Registry registry: Optional. Registry of the metric. Default is :data:`REGISTRY`
+        """
+        self.buckets = tuple(float(b) for b in buckets)
+        super().__init__(name, help, labelnames, registry)
+
+    def observe(self, value):
+        """Observe the value without labels."""
+        self.labels().observe(value)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+
+HANDLER_SECONDS = Histogram(
+    'tracktime_handler_seconds', 'Time of conversation steps.', ['step'])
+HANDLER_ERRORS = Counter(
+    'tracktime_handler_errors_total', 'Number of conversation steps which failed.', ['step'])
+HANDLERS_IN_PROGRESS = Gauge(
+    'tracktime_handlers_in_progress', 'Number of run_async workers busy with handlers.')
+RUN_ASYNC_WORKERS = Gauge(
+    'tracktime_run_async_workers', 'Number of run_async workers.')
+JOB_QUEUE_DEPTH = Gauge(
+    'tracktime_job_queue_depth', 'Number of jobs in the job queue.')
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    'tracktime_scheduler_queue_depth', 'Number of tasks waiting in the sync scheduler.')
+DISPATCHER_QUEUE_DEPTH = Gauge(
+    'tracktime_dispatcher_queue_depth', 'Number of requests waiting to be sent to Telegram.')
+REDMINE_SECONDS = Histogram(
+    'tracktime_redmine_seconds', 'Time of calls of the Redmine wrapper.', ['method'])
+REDMINE_ERRORS = Counter(
+    'tracktime_redmine_errors_total', 'Number of calls of the Redmine wrapper which failed.',
+    ['method'])
+DB_SECONDS = Histogram(
+    'tracktime_db_seconds', 'Time of database statements per call of a handlers function.',
+    ['function'])
+DB_STATEMENTS = Counter(
+    'tracktime_db_statements_total', 'Number of database statements per handlers function.',
+    ['function'])
+
+
+def conversation_step(step):
+    """Decorate the conversation step to record its time, errors and busy workers.
+
+    The decorator must be applied under ``run_async``, so it runs on the worker.
+
+    :param str step: Name of the conversation step
+    """
+    seconds = HANDLER_SECONDS.labels(step)
+    errors = HANDLER_ERRORS.labels(step)
+    in_progress = HANDLERS_IN_PROGRESS.labels()
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            in_progress.inc()
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started_at)
+                in_progress.dec()
+
+        return wrapped
+
+    return decorator
+
+
+def redmine_call(method):
+    """Decorate the method of a Redmine wrapper to record its time and errors.
+
+    Coroutine functions are supported.
+
+    :param str method: Name of the method
+    """
+    seconds = REDMINE_SECONDS.labels(method)
+    errors = REDMINE_ERRORS.labels(method)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapped_async(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    seconds.observe(time.perf_counter() - started_at)
+
+            return wrapped_async
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                seconds.observe(time.perf_counter() - started_at)
+
+        return wrapped
+
+    return decorator
+
+
+_db_local = threading.local()
+
+
+def db_time(function):
+    """Decorate the handlers function to record the time of its database statements.
+
+    Statements are timed only on engines passed to :func:`instrument_engine`. The
+    time of statements of nested decorated functions is added to the callers too.
+
+    :param str function: Name of the function
+    """
+    seconds = DB_SECONDS.labels(function)
+    statements = DB_STATEMENTS.labels(function)
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            frames = getattr(_db_local, 'frames', None)
+            if frames is None:
+                frames = _db_local.frames = []
+            frame = [function, 0.0, 0]
+            frames.append(frame)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                frames.pop()
+                if frame[2]:
+                    seconds.observe(frame[1])
+                    statements.inc(frame[2])
+
+        return wrapped
+
+    return decorator
+
+
+def instrument_engine(engine):
+    """Time statements of the engine for :func:`db_time`.
+
+    The start of a statement is kept on its execution context, so nothing is
+    left behind when the statement fails. Statements executed without a
+    context are not timed.
+
+    :param sqlalchemy.engine.Engine engine:
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.metrics_started_at = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started_at = getattr(context, 'metrics_started_at', None)
+        if started_at is None:
+            return
+        elapsed = time.perf_counter() - started_at
+        for frame in getattr(_db_local, 'frames', ()):
+            frame[1] += elapsed
+            frame[2] += 1
+
+
+def current_db_function():
+    """Return the name of the innermost function decorated by :func:`db_time` in the thread.
+
+    :return: Name of the function or None
+    """
+    frames = getattr(_db_local, 'frames', None)
+    return frames[-1][0] if frames else None
+
+
+def start_http_server(port, listen='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics in the Prometheus text format in a background thread.
+
+    :param int port: Port of the endpoint
+    :param str listen: Address of the endpoint
+    :param Registry registry: Optional. Registry of the metrics
+    :rtype: http.server.ThreadingHTTPServer
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((listen, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
+    return server
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
@@ -1,6 +1,11 @@
 """This module contains the models described in the database tables."""
 
-from sqlalchemy import Column, Date, Float, ForeignKey, Integer, String, Text
+import functools
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, Date, DateTime, Float, ForeignKey, func, Index, inspect, \
+    Integer, select, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -13,19 +18,24 @@ class User(Base):
     __tablename__ = 'user'
     id = Column(Integer, primary_key=True)
     authkey = Column(String(30))
+    redmine_user_id = Column(Integer)
+    synced_at = Column(DateTime)
 
     def __repr__(self):
         """Represent the user object."""
         return 'User#{} {}'.format(self.id, self.authkey)
 
-    def __init__(self, id, authkey=''):
+    def __init__(self, id, authkey='', redmine_user_id=None):
         """Initialize object.
 
         :param int id: ID user in telegram
         :param str authkey: Authorization key in Redmine
+        :param int redmine_user_id: ID user in Redmine which owns the authorization key
         """
         self.id = id
         self.authkey = authkey
+        self.redmine_user_id = redmine_user_id
+        self.synced_at = None
 
 
 class Issue(Base):
@@ -53,6 +63,10 @@ class TimeEntry(Base):
     """Represent the table time_entry in a database."""
 
     __tablename__ = 'time_entry'
+    __table_args__ = (
+        Index('ix_time_entry_user_id_issue_id_id', 'user_id', 'issue_id', 'id'),
+        Index('ix_time_entry_user_id_spent_on', 'user_id', 'spent_on'),
+    )
     id = Column(Integer, primary_key=True)
     spent_on = Column(Date)
     hours = Column(Float, nullable=False)
@@ -87,11 +101,274 @@ class TimeEntry(Base):
         self.comments = comments
 
 
+_TimeEntryRecord = namedtuple('TimeEntryRecord', 'id issue_id spent_on hours comments')
+
+
+class TimeEntryRecord(_TimeEntryRecord):
+    """Time entry received from Redmine which is not bound to a database.
+
+    Records are compared with the saved time entries on sync, so they are kept
+    much lighter than :class:`TimeEntry` objects.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_redmine(cls, r_time_entry):
+        """Build the record from the time entry decoded from a response of Redmine.
+
+        :param dict r_time_entry: Time entry with an issue as it is in the response
+        :rtype: TimeEntryRecord
+        """
+        return cls(r_time_entry['id'], r_time_entry['issue']['id'],
+                   _parse_date(r_time_entry['spent_on']), r_time_entry['hours'],
+                   r_time_entry.get('comments'))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(value):
+    """Parse the date of the Redmine API, dates repeat a lot, so they are cached."""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class UserRecentIssue(Base):
+    """Represent the table user_recent_issue in a database.
+
+    The table is maintained on every write of time entries and contains the
+    aggregated time entries of the user by issue.
+    """
+
+    __tablename__ = 'user_recent_issue'
+    __table_args__ = (Index('ix_user_recent_issue_user_id_last_time_entry_id', 'user_id',
+                            'last_time_entry_id', 'time_entry_count'),)
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    issue_id = Column(Integer, ForeignKey('issue.id'), primary_key=True)
+    last_time_entry_id = Column(Integer, nullable=False)
+    time_entry_count = Column(Integer, nullable=False)
+    issue_name = Column(Text, nullable=False)
+
+    def __repr__(self):
+        """Represent the user recent issue object."""
+        return 'UserRecentIssue#{} {}'.format(self.user_id, self.issue_id)
+
+    def __init__(self, user_id, issue_id, last_time_entry_id, time_entry_count, issue_name):
+        """Initialize object.
+
+        :param int user_id: ID user in telegram
+        :param int issue_id: ID issue in redmine
+        :param int last_time_entry_id: ID the last time entry of the user in the issue
+        :param int time_entry_count: Number of time entries of the user in the issue
+        :param str issue_name: Name issue in redmine
+        """
+        self.user_id = user_id
+        self.issue_id = issue_id
+        self.last_time_entry_id = last_time_entry_id
+        self.time_entry_count = time_entry_count
+        self.issue_name = issue_name
+
+
+def select_recent_issues(user_id=None, issue_ids=None):
+    """Build the select of aggregated time entries in the columns order of ``user_recent_issue``.
+
+    :param int user_id: Optional. Aggregate only time entries of the user
+    :param issue_ids: Optional. Aggregate only time entries in the issues
+    :rtype: sqlalchemy.sql.Select
+    """
+    s = select([
+        TimeEntry.user_id, TimeEntry.issue_id,
+        func.max(TimeEntry.id),
+        func.count(),
+        Issue.name
+    ])
+    s = s.select_from(TimeEntry.__table__.join(Issue.__table__))
+    if user_id is not None:
+        s = s.where(TimeEntry.user_id == user_id)
+    if issue_ids is not None:
+        s = s.where(TimeEntry.issue_id.in_(issue_ids))
+    return s.group_by(TimeEntry.user_id, TimeEntry.issue_id, Issue.name)
+
+
+class OutboxTimeEntry(Base):
+    """Represent the table time_entry_outbox in a database.
+
+    The table contains time entries which are saved locally and wait to be
+    saved in Redmine. A time entry which Redmine accepted but which was not
+    written to the time entries keeps the ID time entry in Redmine.
+    """
+
+    __tablename__ = 'time_entry_outbox'
+    __table_args__ = (Index('ix_time_entry_outbox_next_attempt_at', 'next_attempt_at'),)
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer)
+    spent_on = Column(Date)
+    hours = Column(Float, nullable=False)
+    comments = Column(Text)
+    attempts = Column(Integer, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    last_error = Column(Text)
+    time_entry_id = Column(Integer)
+
+    user_id = Column(Integer, ForeignKey('user.id'), nullable=False)
+    user = relationship('User')
+
+    issue_id = Column(Integer, ForeignKey('issue.id'))
+    issue = relationship('Issue')
+
+    def __repr__(self):
+        """Represent the outbox time entry object."""
+        return 'OutboxTimeEntry#{} {}h {}'.format(self.id, self.hours, self.spent_on)
+
+    def __init__(self, user_id, issue_id, spent_on, hours, comments=None, chat_id=None,
+                 next_attempt_at=None):
+        """Initialize object.
+
+        :param int user_id: ID user in telegram who owns the time entry
+        :param int issue_id: ID issue on which to track time entry
+        :param datetime.date spent_on: The date on which to track time entry
+        :param float hours: Number of hours to track time entry
+        :param str comments: Description of time entry
+        :param int chat_id: ID chat in telegram to notify about a failure
+        :param datetime.datetime next_attempt_at: Time of the next attempt to save in Redmine
+        """
+        self.user_id = user_id
+        self.issue_id = issue_id
+        self.spent_on = spent_on
+        self.hours = hours
+        self.comments = comments
+        self.chat_id = chat_id
+        self.attempts = 0
+        self.next_attempt_at = next_attempt_at or datetime.utcnow()
+        self.last_error = None
+        self.time_entry_id = None
+
+
+class BackfillCheckpoint(Base):
+    """Represent the table backfill_checkpoint in a database.
+
+    The table contains the progress of the backfill of the history of time
+    entries of the user, so an interrupted backfill is resumed from it.
+    """
+
+    __tablename__ = 'backfill_checkpoint'
+    user_id = Column(Integer, ForeignKey('user.id'), primary_key=True)
+    started_at = Column(DateTime, nullable=False)
+    spent_on = Column(Date)
+    time_entry_count = Column(Integer, nullable=False)
+    completed_at = Column(DateTime)
+
+    def __repr__(self):
+        """Represent the backfill checkpoint object."""
+        return 'BackfillCheckpoint#{} {}'.format(self.user_id, self.spent_on)
+
+    def __init__(self, user_id, started_at=None):
+        """Initialize object.
+
+        :param int user_id: ID user in telegram
+        :param datetime.datetime started_at: Time of the start of the backfill
+        """
+        self.user_id = user_id
+        self.started_at = started_at or datetime.utcnow()
+        self.spent_on = None
+        self.time_entry_count = 0
+        self.completed_at = None
+
+
+class SchemaVersion(Base):
+    """Represent the table schema_version in a database."""
+
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+
+    def __repr__(self):
+        """Represent the schema version object."""
+        return 'SchemaVersion#{}'.format(self.version)
+
+    def __init__(self, version):
+        """Initialize object.
+
+        :param int version: Number of applied migrations
+        """
+        self.version = version
+
+
 def initialize_tables(engine):
-    """Create tables which not exists in a database.
+    """Create tables which not exists in a database and migrate the existing tables.
 
     :param sqlalchemy.engine.Engine engine:
     """
-    for model in [User, Issue, TimeEntry]:
+    for model in [User, Issue, TimeEntry, UserRecentIssue, OutboxTimeEntry, BackfillCheckpoint,
+                  SchemaVersion]:
         if not engine.dialect.has_table(engine, model.__table__.name):
             model.__table__.create(bind=engine)
+
+    migrate(engine)
+
+
+def migrate(engine):
+    """Apply migrations which were not applied to a database yet.
+
+    Every migration is idempotent because the tables created by the current
+    models already have the latest schema.
+
+    :param sqlalchemy.engine.Engine engine:
+    :return: The schema version after migration
+    """
+    table = SchemaVersion.__table__
+    version = engine.execute(table.select()).scalar() or 0
+    for migration in _MIGRATIONS[version:]:
+        migration(engine)
+
+    if version < len(_MIGRATIONS):
+        engine.execute(table.delete())
+        engine.execute(table.insert().values(version=len(_MIGRATIONS)))
+    return len(_MIGRATIONS)
+
+
+def _add_user_columns(engine):
+    _add_missing_columns(engine, User.__table__)
+
+
+def _add_time_entry_indexes(engine):
+    _add_missing_indexes(engine, TimeEntry.__table__)
+
+
+def _fill_user_recent_issues(engine):
+    table = UserRecentIssue.__table__
+    engine.execute(table.delete())
+    engine.execute(table.insert().from_select([c.name for c in table.columns],
+                                              select_recent_issues()))
+
+
+def _add_outbox_columns(engine):
+    _add_missing_columns(engine, OutboxTimeEntry.__table__)
+
+
+def _add_missing_columns(engine, table):
+    """Add nullable columns which were added to the model after the table was created.
+
+    :param sqlalchemy.engine.Engine engine:
+    :param sqlalchemy.Table table:
+    """
+    exists_columns = {c['name'] for c in inspect(engine).get_columns(table.name)}
+    quote = engine.dialect.identifier_preparer.quote
+    for column in table.columns:
+        if column.name in exists_columns or not column.nullable:
+            continue
+        engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            quote(table.name), quote(column.name), column.type.compile(dialect=engine.dialect)))
+
+
+def _add_missing_indexes(engine, table):
+    """Create indexes which were added to the model after the table was created.
+
+    :param sqlalchemy.engine.Engine engine:
+    :param sqlalchemy.Table table:
+    """
+    exists_indexes = {i['name'] for i in inspect(engine).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in exists_indexes:
+            index.create(bind=engine)
+
+
+_MIGRATIONS = [_add_user_columns, _add_time_entry_indexes, _fill_user_recent_issues,
+               _add_outbox_columns]
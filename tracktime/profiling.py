@@ -0,0 +1,196 @@
+"""This module contains opt-in profiling of a running process.
+
+Calls of functions decorated with :func:`profiled` are sampled under
+:mod:`cProfile` with the configured rate and the statistics are aggregated per
+name. Allocations are traced with :mod:`tracemalloc` when it is started. A dump
+of the hot functions and the allocation sites is written on a signal, so a slow
+or growing process can be diagnosed without a restart.
+"""
+
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import random
+import signal
+import threading
+import tracemalloc
+from datetime import datetime
+
+
+class Profiler:
+    """Sampling profiler of named calls."""
+
+    def __init__(self, sample_rate=0.0, top=30, output_dir='.'):
+        """Initialize profiler.
+
+        :param float sample_rate: Share of calls which are profiled, ``0`` disables profiling
+        :param int top: Number of functions and allocation sites in the dump
+        :param str output_dir: Directory of dumps
+        """
+        self.sample_rate = sample_rate
+        self.top = top
+        self.output_dir = output_dir
+        self._stats = {}
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+        self._snapshot = None
+
+    def profiled(self, name, func, *args, **kwargs):
+        """Call the function and profile the call if it is sampled.
+
+        Only one call is profiled at a time, calls in other threads are not
+        sampled while it runs.
+
+        :param str name: Name under which the statistics are aggregated
+        :param callable func:
+        :return: The result of the function
+        """
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return func(*args, **kwargs)
+        if not self._active.acquire(blocking=False):
+            return func(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            self._active.release()
+            self._add(name, profile)
+
+    def start_tracemalloc(self, frames=10):
+        """Start tracing allocations.
+
+        :param int frames: Number of frames kept in a traceback of an allocation
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def dump(self, path=None):
+        """Write the hot functions and the allocation sites to the file.
+
+        The allocation sites are compared with the previous dump, so the growth
+        of memory between dumps is visible.
+
+        :param str path: Optional. Path of the file. By default a new file in ``output_dir``
+        :return: Path of the file
+        """
+        if path is None:
+            path = os.path.join(self.output_dir, 'profile-{}.txt'.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+        stream = io.StringIO()
+        stream.write('Sample rate {}\n\n'.format(self.sample_rate))
+        with self._lock:
+            for name in sorted(self._stats):
+                stream.write('=== {} ({} sampled calls)\n'.format(name, self._calls[name]))
+                stats = self._stats[name]
+                stats.stream = stream
+                stats.sort_stats('cumulative').print_stats(self.top)
+        stream.write(self._dump_tracemalloc())
+
+        with open(path, 'w') as f:
+            f.write(stream.getvalue())
+        return path
+
+    def reset(self):
+        """Drop the aggregated statistics and the previous snapshot of allocations."""
+        with self._lock:
+            self._stats = {}
+            self._calls = {}
+            self._snapshot = None
+
+    def _add(self, name, profile):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                self._stats[name] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            self._calls[name] = self._calls.get(name, 0) + 1
+
+    def _dump_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            return ''
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        with self._lock:
+            previous, self._snapshot = self._snapshot, snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['=== Allocations, current {} KiB, peak {} KiB'.format(
+            current // 1024, peak // 1024)]
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:self.top])
+        if previous is not None:
+            lines.append('')
+            lines.append('=== Growth since the previous dump')
+            lines.extend(str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:self.top])
+        lines.append('')
+        return '\n'.join(lines)
+
+
+_default_profiler = Profiler()
+
+
+def default_profiler():
+    """Return the profiler used by :func:`profiled`.
+
+    :rtype: Profiler
+    """
+    return _default_profiler
+
+
+def set_default_profiler(profiler):
+    """Replace the profiler used by :func:`profiled`.
+
+    :param Profiler profiler:
+    """
+    global _default_profiler
+    _default_profiler = profiler
+
+
+def profiled(name):
+    """Decorate the function to sample its calls by the default profiler.
+
+    :param str name: Name under which the statistics are aggregated
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            return _default_profiler.profiled(name, func, *args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR2', None)):
+    """Dump the default profiler on the signal.
+
+    The dump is written by a background thread, so the signal does not
+    interrupt the main thread for long.
+
+    :param int signum: Number of the signal. Default is ``SIGUSR2``
+    """
+    logger = logging.getLogger(__name__)
+
+    def dump():
+        try:
+            logger.info('Profile is written to %s', _default_profiler.dump())
+        except Exception:
+            logger.exception('Profile is not written')
+
+    def handle(signum, frame):
+        threading.Thread(target=dump, name='ProfilerDump', daemon=True).start()
+
+    signal.signal(signum, handle)
@@ -0,0 +1,162 @@
+"""This module contains the log of database statements with their timings.
+
+Statements are timed by engine events, normalized, so statements which differ
+only by values or the length of ``IN`` lists are aggregated together, and
+attributed to the ``handlers`` function which executed them. Statements slower
+than the threshold are logged at once, the aggregate is written on demand.
+"""
+
+import logging
+import os
+import re
+import signal
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+from tracktime.metrics import current_db_function
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)')
+_ROW_LIST = re.compile(r'(\(\.\.\.\))(?:\s*,\s*\(\.\.\.\))+')
+
+
+class QueryLog:
+    """Aggregate of executed statements."""
+
+    def __init__(self, slow_threshold=0.5, output_dir='.', max_statements=1000):
+        """Initialize log.
+
+        :param float slow_threshold: Number of seconds after which a statement is logged
+        :param str output_dir: Directory of dumps
+        :param int max_statements: Maximum number of distinct normalized statements,
+            statements over it are aggregated as ``<other>``
+        """
+        self.slow_threshold = slow_threshold
+        self.output_dir = output_dir
+        self.max_statements = max_statements
+        self._statements = {}
+        self._normalized = {}
+        self._lock = threading.Lock()
+
+    def instrument(self, engine):
+        """Time statements of the engine.
+
+        The start of a statement is kept on its execution context, so nothing
+        is left behind when the statement fails. Statements executed without a
+        context are not timed.
+
+        :param sqlalchemy.engine.Engine engine:
+        """
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if context is not None:
+                context.querylog_started_at = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started_at = getattr(context, 'querylog_started_at', None)
+            if started_at is not None:
+                self.record(statement, time.perf_counter() - started_at, current_db_function())
+
+    def record(self, statement, elapsed, function=None):
+        """Add the executed statement to the aggregate.
+
+        :param str statement: SQL of the statement
+        :param float elapsed: Number of seconds the statement took
+        :param str function: Optional. Name of the function which executed the statement
+        """
+        function = function or '<unknown>'
+        normalized = self._normalize(statement)
+        with self._lock:
+            key = (normalized, function)
+            entry = self._statements.get(key)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    key = ('<other>', function)
+                    entry = self._statements.get(key)
+                if entry is None:
+                    entry = self._statements[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+        if elapsed >= self.slow_threshold:
+            logging.getLogger(__name__).warning(
+                'Slow statement %.3fs in %s: %s', elapsed, function, normalized)
+
+    def statements(self):
+        """Return the aggregate sorted by the total time.
+
+        :return: List of dicts with keys statement, function, count, total and max
+        """
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._statements.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return [{
+            'statement': statement,
+            'function': function,
+            'count': count,
+            'total': total,
+            'max': max_
+        } for (statement, function), (count, total, max_) in items]
+
+    def dump(self, path=None):
+        """Write the aggregate to the file.
+
+        :param str path: Optional. Path of the file. By default a new file in ``output_dir``
+        :return: Path of the file
+        """
+        if path is None:
+            path = os.path.join(self.output_dir, 'queries-{}.txt'.format(
+                datetime.now().strftime('%Y%m%d-%H%M%S')))
+
+        with open(path, 'w') as f:
+            f.write('{:>8} {:>10} {:>10} {:>10}  {}\n'.format(
+                'count', 'total, s', 'mean, ms', 'max, ms', 'function: statement'))
+            for s in self.statements():
+                f.write('{:>8} {:>10.3f} {:>10.3f} {:>10.3f}  {}: {}\n'.format(
+                    s['count'], s['total'], s['total'] / s['count'] * 1000, s['max'] * 1000,
+                    s['function'], s['statement']))
+        return path
+
+    def reset(self):
+        """Drop the aggregate."""
+        with self._lock:
+            self._statements = {}
+
+    def _normalize(self, statement):
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized = _WHITESPACE.sub(' ', statement).strip()
+            normalized = _LITERAL.sub('?', normalized)
+            normalized = _PARAMETER_LIST.sub('(...)', normalized)
+            normalized = _ROW_LIST.sub(r'\1', normalized)
+            if len(self._normalized) < self.max_statements * 10:
+                self._normalized[statement] = normalized
+        return normalized
+
+
+def dump_on_signal(query_log, signum=getattr(signal, 'SIGUSR1', None)):
+    """Write the aggregate of the query log on the signal.
+
+    The aggregate is written by a background thread.
+
+    :param QueryLog query_log:
+    :param int signum: Number of the signal. Default is ``SIGUSR1``
+    """
+    logger = logging.getLogger(__name__)
+
+    def dump():
+        try:
+            logger.info('Statements are written to %s', query_log.dump())
+        except Exception:
+            logger.exception('Statements are not written')
+
+    def handle(signum, frame):
+        threading.Thread(target=dump, name='QueryLogDump', daemon=True).start()
+
+    signal.signal(signum, handle)
@@ -1,20 +1,130 @@
 """This module contain the wrapper for the redminelib library."""
 
+import threading
+import time
+from collections import OrderedDict
+
 from redminelib import Redmine
-from redminelib.exceptions import AuthError
+from redminelib.exceptions import AuthError, ForbiddenError, ResourceNotFoundError, \
+    ValidationError
+from requests.adapters import HTTPAdapter
+
+from tracktime.metrics import redmine_call
+from tracktime.models import Issue, TimeEntryRecord
+
+
+class RedmineClientPool:
+    """Bounded pool of :class:`redminelib.Redmine` clients keyed by url and authorization key.
+
+    Every client keeps its own HTTP session, so the keep-alive connections are reused
+    between calls instead of opening a new connection with a TLS handshake each time.
+    The least recently used clients are evicted when the pool is full and the clients
+    which were not used for ``idle_timeout`` seconds are evicted on the next access.
+    The total number of open sockets never exceeds ``max_clients * max_connections``.
+    """
+
+    def __init__(self, max_clients=64, max_connections=2, idle_timeout=300):
+        """Initialize pool.
+
+        :param int max_clients: Maximum number of clients kept in the pool
+        :param int max_connections: Maximum number of keep-alive connections per client
+        :param float idle_timeout: Number of seconds after which an unused client is evicted
+        """
+        self.max_clients = max_clients
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, url, authkey):
+        """Get a client from the pool or create it if not exists.
+
+        :param str url: The redmine url
+        :param str authkey: Authorization key in Redmine
+        :rtype: redminelib.Redmine
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+
+            key = (url, authkey)
+            if key in self._clients:
+                redmine, _ = self._clients.pop(key)
+            else:
+                redmine = self._create_client(url, authkey)
+            self._clients[key] = (redmine, now)
+
+            while len(self._clients) > self.max_clients:
+                _, (evicted, _) = self._clients.popitem(last=False)
+                _close_client(evicted)
+
+            return redmine
+
+    def discard(self, url, authkey):
+        """Remove the client from the pool and close its connections.
+
+        :param str url: The redmine url
+        :param str authkey: Authorization key in Redmine
+        """
+        with self._lock:
+            item = self._clients.pop((url, authkey), None)
+        if item is not None:
+            _close_client(item[0])
 
-from tracktime.models import Issue, TimeEntry
+    def clear(self):
+        """Remove all clients from the pool and close their connections."""
+        with self._lock:
+            clients = [redmine for redmine, _ in self._clients.values()]
+            self._clients.clear()
+        for redmine in clients:
+            _close_client(redmine)
+
+    def __len__(self):
+        """Return the number of clients in the pool."""
+        return len(self._clients)
+
+    def _evict_idle(self, now):
+        while self._clients:
+            key, (redmine, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self._clients[key]
+            _close_client(redmine)
+
+    def _create_client(self, url, authkey):
+        redmine = Redmine(url=url, key=authkey)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.max_connections, pool_block=True)
+        redmine.engine.session.mount('http://', adapter)
+        redmine.engine.session.mount('https://', adapter)
+        return redmine
+
+
+def _close_client(redmine):
+    redmine.engine.session.close()
+
+
+_default_pool = RedmineClientPool()
 
 
 class RedmineWrapper:
     """Wrapper for working with the :class:`redminelib.Redmine`."""
 
-    def __init__(self, redmine_url):
+    page_size = 100
+
+    def __init__(self, redmine_url, pool=None, user_id_ttl=3600):
         """Initialize wrapper.
 
         :param str redmine_url: The redmine url
+        :param RedmineClientPool pool: Optional. The pool of clients. By default all wrappers
+            share the same pool.
+        :param float user_id_ttl: Number of seconds while the resolved ID user is cached
         """
         self.url = redmine_url
+        self.pool = pool if pool is not None else _default_pool
+        self.user_id_ttl = user_id_ttl
+        self._user_ids = {}
+        self._user_ids_lock = threading.Lock()
 
     def check_authkey(self, authkey):
         """Check authorization key.
@@ -22,20 +132,54 @@ class RedmineWrapper:
         :param string authkey: Authorization key to check
         :return: True if authorization key is correct
         """
-        redmine = Redmine(url=self.url, key=authkey)
+        return self.get_user_id(authkey) is not None
+
+    @redmine_call('get_user_id')
+    def get_user_id(self, authkey):
+        """Get ID user in Redmine which owns the authorization key.
+
+        The resolved ID is cached for ``user_id_ttl`` seconds.
+
+        :param string authkey: Authorization key in Redmine
+        :return: ID user or None if authorization key is not correct
+        """
+        now = time.monotonic()
+        with self._user_ids_lock:
+            cached = self._user_ids.get(authkey)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        redmine = self._client(authkey)
         try:
-            redmine.auth()
-            return True
+            r_user_id = redmine.auth().id
         except AuthError:
-            return False
+            self.forget_user_id(authkey)
+            self.pool.discard(self.url, authkey)
+            return None
+
+        with self._user_ids_lock:
+            self._user_ids[authkey] = (r_user_id, now + self.user_id_ttl)
+        return r_user_id
+
+    def forget_user_id(self, authkey):
+        """Remove the resolved ID user from the cache.
 
+        :param string authkey: Authorization key in Redmine
+        """
+        with self._user_ids_lock:
+            self._user_ids.pop(authkey, None)
+
+    @redmine_call('save_time_entry')
     def save_time_entry(self, time_entry):
         """Save time entry in Redmine.
 
+        Errors of the connection and the server are raised, so the caller can retry.
+
         :param tracktime.models.TimeEntry time_entry: The object whose data need to save
-        :return: ID time entry if save time entry into Redmine is successful
+        :return: ID time entry if save time entry into Redmine is successful or None
+            if Redmine rejected the time entry
         """
-        redmine = Redmine(url=self.url, key=time_entry.user.authkey)
+        redmine = self._client(time_entry.user.authkey)
         try:
             redmine_time_entry = redmine.time_entry.create(
                 issue_id=time_entry.issue_id,
@@ -43,36 +187,108 @@ class RedmineWrapper:
                 spent_on=time_entry.spent_on,
                 comments=time_entry.comments)
             return redmine_time_entry.id
-        except AuthError:
+        except (AuthError, ForbiddenError, ResourceNotFoundError, ValidationError):
             return None
 
-    def get_all_time_entry(self, user, spent_on=None):
+    @redmine_call('get_all_time_entry')
+    def get_all_time_entry(self, user, spent_on=None, from_date=None, updated_since=None):
         """Get all time entry from redmine for user.
 
+        The saved ID user in Redmine is used, nothing is requested when it is not
+        known. If Redmine rejects the authorization key then the time entries which
+        were received before are returned.
+
         :param tracktime.models.User user:
         :param spent_on:
-        :rtype: list
+        :param datetime.date from_date: Optional. Only time entries spent on this date or later
+        :param datetime.date updated_since: Optional. Only time entries updated on this date
+            or later
+        :return: List of :class:`tracktime.models.TimeEntryRecord`
 
         """
-        redmine = Redmine(url=self.url, key=user.authkey)
+        time_entries = list()
         try:
-            time_entries = list()
-            r_user_id = redmine.auth().id
-            r_time_entries = redmine.time_entry.filter(user_id=r_user_id, spent_on=spent_on)
-            for r_time_entry in r_time_entries:
-                if 'issue' in dir(r_time_entry):
-                    time_entry = TimeEntry(
-                        id=r_time_entry.id,
-                        user=user,
-                        issue_id=r_time_entry.issue.id,
-                        spent_on=r_time_entry.spent_on,
-                        hours=r_time_entry.hours,
-                        comments=r_time_entry.comments)
-                    time_entries.append(time_entry)
-            return time_entries
+            time_entries.extend(self.iter_time_entries(user, spent_on, from_date, updated_since))
         except AuthError:
-            return list()
+            pass
+        return time_entries
+
+    def iter_time_entries(self, user, spent_on=None, from_date=None, updated_since=None):
+        """Yield time entries of the user from Redmine requesting them page by page.
+
+        Only one page of time entries is kept in memory. Time entries are yielded
+        as records decoded right from the response, time entries without an issue
+        are skipped. Nothing is requested when the ID user in Redmine is not known.
+        The user is not changed, the caller forgets the ID user when Redmine
+        rejects the authorization key.
+
+        :param tracktime.models.User user:
+        :param spent_on:
+        :param datetime.date from_date: Optional. Only time entries spent on this date or later
+        :param datetime.date updated_since: Optional. Only time entries updated on this date
+            or later
+        :return: Iterator of :class:`tracktime.models.TimeEntryRecord`
+        :raises redminelib.exceptions.AuthError: If Redmine rejected the authorization key
+        """
+        if user.redmine_user_id is None:
+            return
+
+        filters = dict(user_id=user.redmine_user_id, spent_on=spent_on)
+        if from_date is not None:
+            filters['from_date'] = from_date
+        if updated_since is not None:
+            filters['updated_on'] = '>={}'.format(updated_since)
+        try:
+            offset = 0
+            while True:
+                time_entries, total_count = self._get_time_entry_page(
+                    user.authkey, offset, filters)
+                yield from time_entries
+                offset += self.page_size
+                if offset >= total_count:
+                    return
+        except AuthError:
+            self.forget_user_id(user.authkey)
+            raise
+
+    def get_time_entry_page(self, user, offset=0, from_date=None):
+        """Get one page of time entries of the user in the order of the date they are spent on.
 
+        Unlike :meth:`get_all_time_entry` only one request is made and errors are
+        raised, so the caller can stream the history page by page and resume it.
+
+        :param tracktime.models.User user: The user whose ID user in Redmine is known
+        :param int offset: Number of time entries which are skipped
+        :param datetime.date from_date: Optional. Only time entries spent on this date or later
+        :return: Tuple of the list of :class:`tracktime.models.TimeEntryRecord` of the page
+            and the total number of time entries in Redmine. The page has at most
+            ``page_size`` time entries.
+        :raises redminelib.exceptions.AuthError: If Redmine rejected the authorization key
+        """
+        filters = dict(user_id=user.redmine_user_id)
+        if from_date is not None:
+            filters['from_date'] = from_date
+        return self._get_time_entry_page(user.authkey, offset, filters)
+
+    @redmine_call('get_time_entry_page')
+    def _get_time_entry_page(self, authkey, offset, filters):
+        """Request one page of time entries in the order of the date they are spent on.
+
+        Responses are read as raw dictionaries, so no resource objects are built.
+
+        :return: Tuple of the list of records and the total number of time entries
+        """
+        redmine = self._client(authkey)
+        r_time_entries = redmine.time_entry.filter(
+            sort='spent_on', offset=offset, limit=self.page_size, **filters)
+        time_entries = [
+            TimeEntryRecord.from_redmine(r_time_entry)
+            for r_time_entry in r_time_entries.values()
+            if r_time_entry.get('issue') is not None
+        ]
+        return time_entries, r_time_entries.total_count
+
+    @redmine_call('get_issue')
     def get_issue(self, user, issue_id):
         """Get issue from from by id.
 
@@ -81,9 +297,41 @@ class RedmineWrapper:
         :rtype: tracktime.models.Issue
 
         """
-        redmine = Redmine(url=self.url, key=user.authkey)
+        redmine = self._client(user.authkey)
         try:
             r_issue = redmine.issue.get(issue_id)
             return Issue(r_issue.id, r_issue.subject)
         except AuthError:
             return None
+
+    @redmine_call('get_issues')
+    def get_issues(self, user, issue_ids, chunk_size=100):
+        """Get issues from Redmine by ids using bulk requests.
+
+        Issues are requested by chunks through the filter by several ids, so the
+        number of requests is ``len(issue_ids) / chunk_size``. Issues which the user
+        can not see are skipped.
+
+        :param tracktime.models.User user:
+        :param issue_ids: IDs of issues in Redmine
+        :param int chunk_size: Maximum number of issues in one request
+        :rtype: list
+
+        """
+        issue_ids = sorted(issue_ids)
+        redmine = self._client(user.authkey)
+        issues = list()
+        try:
+            for i in range(0, len(issue_ids), chunk_size):
+                chunk = issue_ids[i:i + chunk_size]
+                r_issues = redmine.issue.filter(
+                    issue_id=','.join(str(issue_id) for issue_id in chunk),
+                    status_id='*',
+                    limit=len(chunk))
+                issues.extend(Issue(r_issue.id, r_issue.subject) for r_issue in r_issues)
+        except AuthError:
+            pass
+        return issues
+
+    def _client(self, authkey):
+        return self.pool.get(self.url, authkey)
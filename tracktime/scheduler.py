@@ -0,0 +1,250 @@
+"""This module contains the scheduler which runs synchronizations with Redmine."""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class TokenBucket:
+    """Token bucket which limits the rate of operations."""
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        """Initialize bucket.
+
+        :param float rate: Number of tokens which are added per second
+        :param int capacity: Maximum number of tokens in the bucket
+        :param callable clock: Function which returns the current time in seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token from the bucket and wait for it if the bucket is empty."""
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            time.sleep(delay)
+
+    def try_acquire(self):
+        """Take one token from the bucket if it is not empty.
+
+        :return: 0 if the token is taken, otherwise the number of seconds after which
+            the token can be taken
+        :rtype: float
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class SyncScheduler:
+    """Run synchronization tasks with bounded concurrency and priorities.
+
+    Tasks are run by ``concurrency`` threads in order of priority and then in
+    order of submission, so the interactive tasks jump ahead of the background
+    ones. Background tasks never occupy more than ``background_concurrency``
+    threads, the rest are kept for interactive tasks. A task is not queued twice
+    while it waits for its turn. Tasks which share a budget, for example one
+    Redmine, are started no faster than ``rate`` tasks per second.
+    """
+
+    def __init__(self, concurrency=4, rate=None, burst=1, background_concurrency=None,
+                 max_background_queue=None):
+        """Initialize scheduler.
+
+        :param int concurrency: Number of tasks which run concurrently
+        :param float rate: Optional. Number of tasks started per second per budget
+        :param int burst: Number of tasks per budget which can start without waiting
+        :param int background_concurrency: Optional. Number of background tasks which run
+            concurrently. Default is one less than ``concurrency``
+        :param int max_background_queue: Optional. Number of queued background tasks after
+            which new background tasks are rejected
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        if background_concurrency is None:
+            background_concurrency = max(concurrency - 1, 1)
+        self.background_concurrency = background_concurrency
+        self.max_background_queue = max_background_queue
+        self._queue = []
+        self._entries = {}
+        self._queued_background = 0
+        self._running_background = 0
+        self._counter = itertools.count()
+        self._buckets = {}
+        self._threads = []
+        self._stopped = False
+        self._condition = threading.Condition()
+
+    def submit(self, key, task, priority=PRIORITY_BACKGROUND, budget=None):
+        """Queue the task unless a task with the same key is already queued.
+
+        A queued task is moved to the higher priority when it is submitted again
+        with that priority. A background task is rejected when the queue is full.
+
+        :param str key: The unique name of the task
+        :param callable task: Function without arguments
+        :param int priority: :data:`PRIORITY_INTERACTIVE` or :data:`PRIORITY_BACKGROUND`
+        :param str budget: Optional. Name of the rate budget, for example the redmine url
+        :return: True if the task was queued
+        """
+        with self._condition:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] <= priority:
+                    return False
+                self._discard(entry)
+            elif priority == PRIORITY_BACKGROUND and self._is_full():
+                return False
+
+            entry = [priority, next(self._counter), key, task, budget, True]
+            self._entries[key] = entry
+            if priority == PRIORITY_BACKGROUND:
+                self._queued_background += 1
+            heapq.heappush(self._queue, entry)
+            self._start()
+            self._condition.notify_all()
+            return True
+
+    def rate_limit(self, budget):
+        """Return the token bucket of the rate budget shared by tasks.
+
+        Work which is not run as a task of the scheduler can take tokens of the
+        same budget, so it is limited together with tasks.
+
+        :param str budget: Name of the rate budget, for example the redmine url
+        :return: :class:`TokenBucket` or None if the rate is not limited
+        """
+        if not self.rate:
+            return None
+        return self._bucket(budget)
+
+    def is_full(self):
+        """Check that the queue does not accept background tasks.
+
+        :rtype: bool
+        """
+        with self._condition:
+            return self._is_full()
+
+    def __len__(self):
+        """Return the number of queued tasks."""
+        return len(self._entries)
+
+    def stop(self):
+        """Stop the threads after the running tasks, the queued tasks are dropped."""
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._entries.clear()
+            self._queued_background = 0
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _start(self):
+        while len(self._threads) < self.concurrency:
+            thread = threading.Thread(
+                target=self._run, name='SyncScheduler-{}'.format(len(self._threads)), daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _is_full(self):
+        return (self.max_background_queue is not None
+                and self._queued_background >= self.max_background_queue)
+
+    def _discard(self, entry):
+        entry[-1] = None
+        if entry[0] == PRIORITY_BACKGROUND:
+            self._queued_background -= 1
+
+    def _next(self):
+        with self._condition:
+            while True:
+                if self._stopped:
+                    return None
+                entry = self._pick()
+                if entry is not None:
+                    return entry
+                self._condition.wait()
+
+    def _pick(self):
+        """Take the next task which can run, must be called with the condition held.
+
+        :return: The entry of the task or None if no task can run now
+        """
+        while self._queue and self._queue[0][-1] is None:
+            heapq.heappop(self._queue)
+        if self._queue and (self._queue[0][0] != PRIORITY_BACKGROUND
+                            or self._running_background < self.background_concurrency):
+            entry = heapq.heappop(self._queue)
+            del self._entries[entry[2]]
+            if entry[0] == PRIORITY_BACKGROUND:
+                self._queued_background -= 1
+                self._running_background += 1
+            return entry
+        return None
+
+    def _done(self, entry):
+        if entry[0] == PRIORITY_BACKGROUND:
+            with self._condition:
+                self._running_background -= 1
+                self._condition.notify_all()
+
+    def _bucket(self, budget):
+        with self._condition:
+            bucket = self._buckets.get(budget)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[budget] = bucket
+            return bucket
+
+    def _run(self):
+        logger = logging.getLogger(__name__)
+        while True:
+            entry = self._next()
+            if entry is None:
+                return
+
+            _, _, key, task, budget, _ = entry
+            try:
+                bucket = self.rate_limit(budget) if budget is not None else None
+                if bucket is not None:
+                    bucket.acquire()
+                task()
+            except Exception:
+                logger.exception('Task "%s" failed', key)
+            finally:
+                self._done(entry)
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def default_scheduler():
+    """Return the scheduler shared by handlers which were created without a scheduler.
+
+    :rtype: SyncScheduler
+    """
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = SyncScheduler()
+        return _default_scheduler